@@ -0,0 +1,53 @@
+"""Operator endpoints for inspecting in-process caches and upstream state.
+
+Every route requires an ``X-Admin-Token`` header matching the
+``ADMIN_API_KEY`` environment variable; without it the routes are disabled.
+Apps expose their caches by setting ``app.state.caches`` to a dict of
+objects providing ``stats()`` and ``invalidate(key=None)``, and upstream
+components (routing, coalescing, ...) by setting ``app.state.upstream`` to a
+dict of objects providing ``stats()``.
+"""
+import hmac
+import os
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+
+
+def require_admin_token(x_admin_token: Optional[str] = Header(None)) -> None:
+    admin_key = os.getenv("ADMIN_API_KEY")
+    if not admin_key:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), admin_key.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin_token)])
+
+
+def _get_cache(request: Request, name: str) -> Any:
+    cache = getattr(request.app.state, "caches", {}).get(name)
+    if cache is None:
+        raise HTTPException(status_code=404, detail=f"Unknown cache: {name}")
+    return cache
+
+
+@router.get("/cache")
+async def cache_stats(request: Request) -> Dict[str, Any]:
+    """Return size and hit/miss counters for every cache."""
+    caches = getattr(request.app.state, "caches", {})
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+@router.post("/cache/{name}/invalidate")
+async def invalidate_cache(request: Request, name: str, key: Optional[str] = None) -> Dict[str, Any]:
+    """Drop one entry (``?key=...``) or the whole cache."""
+    _get_cache(request, name).invalidate(key)
+    return {"cache": name, "invalidated": key or "all"}
+
+
+@router.get("/upstream")
+async def upstream_stats(request: Request) -> Dict[str, Any]:
+    """Return routing, latency and coalescing counters for the upstream LLM calls."""
+    upstream = getattr(request.app.state, "upstream", {})
+    return {name: component.stats() for name, component in upstream.items()}
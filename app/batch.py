@@ -0,0 +1,148 @@
+"""Processing of many API chat turns in one request."""
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional
+
+from app.cache import ChatbotConfigCache, SessionCache
+from app.completions import ChatCompletions
+from app.context import ContextBuilder
+from app.history import HistoryCache
+from app.llm_client import UpstreamError
+from app.settings import env_int
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem(NamedTuple):
+    api_key: str
+    assistant_id: str
+    session_id: str
+    user_messages: List[str]
+
+
+def _result(item: BatchItem, status_code: int, reply: Optional[str] = None, error: Optional[str] = None) -> Dict[str, Any]:
+    return {"session_id": item.session_id, "status_code": status_code, "reply": reply, "error": error}
+
+
+class BatchChat:
+    """Answers a batch of chat turns with as few database round trips as possible.
+
+    Each distinct assistant's API key is checked once, the owners of
+    uncached sessions are read with one query and uncached histories with
+    another (split and paged by the Supabase backend for large batches).
+    Turns then run concurrently, at most ``BATCH_CONCURRENCY``
+    upstream calls at a time; turns of the same session run in order, each
+    seeing the replies before it. Every turn is saved through ``save_turn``
+    and ``flush`` writes them all with one bulk insert before the results
+    are returned.
+
+    Each item gets its own result; a bad key, a foreign session or an
+    upstream failure only fails that item. Callers should reject batches
+    longer than ``max_items`` (``BATCH_MAX_ITEMS``).
+    """
+
+    def __init__(
+        self,
+        storage: Any,
+        chatbots: ChatbotConfigCache,
+        sessions: SessionCache,
+        history: HistoryCache,
+        merge_pending: Callable[[str, List[Dict[str, Any]]], List[Dict[str, Any]]],
+        context: ContextBuilder,
+        completions: ChatCompletions,
+        save_turn: Callable[[str, List[str], str, Optional[str]], Awaitable[None]],
+        flush: Callable[[], Awaitable[None]],
+        concurrency: Optional[int] = None,
+        max_items: Optional[int] = None,
+    ):
+        self.storage = storage
+        self.chatbots = chatbots
+        self.sessions = sessions
+        self.history = history
+        self.merge_pending = merge_pending
+        self.context = context
+        self.completions = completions
+        self.save_turn = save_turn
+        self.flush = flush
+        self.concurrency = concurrency or env_int("BATCH_CONCURRENCY", 8)
+        self.max_items = max_items or env_int("BATCH_MAX_ITEMS", 500)
+
+    async def _owners(self, session_ids: List[str]) -> Dict[str, str]:
+        owners = {session_id: self.sessions.get(session_id) for session_id in session_ids}
+        missing = [session_id for session_id, owner in owners.items() if owner is None]
+        if missing:
+            for session_id, chatbot_id in (await self.storage.get_session_owners(missing)).items():
+                owners[session_id] = chatbot_id
+                self.sessions.put(session_id, chatbot_id)
+        return owners
+
+    async def _histories(self, session_ids: List[str]) -> Dict[str, List[Dict[str, str]]]:
+        histories = {session_id: self.history.get(session_id) for session_id in session_ids}
+        missing = [session_id for session_id, history in histories.items() if history is None]
+        if missing:
+            grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            for row in await self.storage.get_histories(missing):
+                grouped[row["session_id"]].append(row)
+            for session_id in missing:
+                rows = self.merge_pending(session_id, grouped[session_id])
+                histories[session_id] = [{"role": row["role"], "content": row["content"]} for row in rows]
+                self.history.put(session_id, histories[session_id])
+        return histories
+
+    async def run(self, items: List[BatchItem]) -> List[Dict[str, Any]]:
+        """Answer every item; returns one result dict per item, in order."""
+        results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+        # One key check per assistant and key
+        pairs = sorted({(item.assistant_id, item.api_key) for item in items})
+        checks = await asyncio.gather(*(self.chatbots.verify_api_key(*pair) for pair in pairs))
+        valid = {pair for pair, ok in zip(pairs, checks) if ok}
+        for i, item in enumerate(items):
+            if (item.assistant_id, item.api_key) not in valid:
+                results[i] = _result(item, 403, error="Invalid API key or assistant ID")
+
+        session_ids = sorted({item.session_id for i, item in enumerate(items) if results[i] is None})
+        owners = await self._owners(session_ids)
+        for i, item in enumerate(items):
+            if results[i] is None and owners.get(item.session_id) != item.assistant_id:
+                results[i] = _result(item, 404, error="Session not found or does not belong to the assistant")
+
+        pending: Dict[str, List[int]] = defaultdict(list)
+        for i, item in enumerate(items):
+            if results[i] is None:
+                pending[item.session_id].append(i)
+        histories = await self._histories(sorted(pending))
+        chatbots = {assistant_id: await self.chatbots.get(assistant_id) for assistant_id, _ in valid}
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def answer(session_id: str, indexes: List[int]) -> None:
+            history = histories[session_id]
+            for i in indexes:
+                item = items[i]
+                chatbot = chatbots[item.assistant_id]
+                new_messages = [{"role": "user", "content": content} for content in item.user_messages]
+                try:
+                    messages = await self.context.build(session_id, chatbot, history, new_messages)
+                    async with limit:
+                        completion = await self.completions.complete(chatbot, messages, title="AI Chatbot SaaS")
+                    await self.save_turn(session_id, item.user_messages, completion.reply, completion.model)
+                except UpstreamError as e:
+                    status_code = 503 if e.retry_after is not None else 500
+                    results[i] = _result(item, status_code, error=f"Error communicating with AI service: {e.detail}")
+                    continue
+                except Exception as e:
+                    logger.error(f"Error in batch chat item for session {session_id}: {str(e)}", exc_info=True)
+                    results[i] = _result(item, 500, error="An unexpected error occurred")
+                    continue
+                history = history + new_messages + [{"role": "assistant", "content": completion.reply}]
+                results[i] = _result(item, 200, reply=completion.reply)
+
+        await asyncio.gather(*(answer(session_id, indexes) for session_id, indexes in pending.items()))
+
+        try:
+            await self.flush()
+        except Exception as e:
+            # The turns stay journaled and the background writer retries them
+            logger.error(f"Error flushing batch chat turns: {str(e)}")
+        return results
@@ -0,0 +1,211 @@
+"""In-process caches for hot, rarely changing database rows."""
+import asyncio
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from app.settings import env_float, env_int
+
+MISSING = object()
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries expire after a time-to-live.
+
+    Safe to share between the event loop and worker threads.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = MISSING) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def discard_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """Drop every entry whose key matches ``predicate``."""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+def _key_digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+class ChatbotConfigCache:
+    """Caches ``chatbots`` rows (api_key, model_name, ...) keyed by chatbot id.
+
+    ``loader`` fetches a row from the database and returns ``None`` if the
+    chatbot does not exist; missing chatbots and rejected API keys are cached
+    for ``negative_ttl`` seconds so repeated bad requests skip the database.
+    Call ``invalidate`` after rotating a key or changing a chatbot's model.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+        maxsize: Optional[int] = None,
+        ttl: Optional[float] = None,
+        negative_ttl: Optional[float] = None,
+    ):
+        self.loader = loader
+        self.negative_ttl = negative_ttl or env_float("CHATBOT_CACHE_NEGATIVE_TTL", 30.0)
+        maxsize = maxsize or env_int("CHATBOT_CACHE_SIZE", 1024)
+        self._configs = TTLCache(maxsize, ttl or env_float("CHATBOT_CACHE_TTL", 300.0))
+        self._rejected_keys = TTLCache(maxsize, self.negative_ttl)
+        self._loading: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+
+    async def _lookup(self, chatbot_id: str) -> Tuple[Optional[Dict[str, Any]], bool]:
+        config = self._configs.get(chatbot_id)
+        if config is not MISSING:
+            return config, True
+        return await self.refresh(chatbot_id), False
+
+    def peek(self, chatbot_id: str) -> Any:
+        """Return the cached config (``None`` for a missing chatbot) or ``MISSING``."""
+        return self._configs.get(chatbot_id)
+
+    async def get(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
+        """Return the chatbot's config, or ``None`` if it does not exist."""
+        config, _ = await self._lookup(chatbot_id)
+        return config
+
+    async def refresh(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
+        """Re-read a chatbot from the database and cache the result.
+
+        Concurrent refreshes of the same chatbot share a single query.
+        """
+        loading = self._loading.get(chatbot_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(chatbot_id))
+            self._loading[chatbot_id] = loading
+            loading.add_done_callback(lambda _: self._loading.pop(chatbot_id, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
+        config = await self.loader(chatbot_id)
+        self.put(chatbot_id, config)
+        return config
+
+    def put(self, chatbot_id: str, config: Optional[Dict[str, Any]]) -> None:
+        self._configs.set(chatbot_id, config, ttl=None if config is not None else self.negative_ttl)
+
+    def is_rejected(self, chatbot_id: str, api_key: str) -> bool:
+        """Whether ``api_key`` was rejected for this chatbot within ``negative_ttl``."""
+        return self._rejected_keys.get((chatbot_id, _key_digest(api_key)), False)
+
+    def reject(self, chatbot_id: str, api_key: str) -> None:
+        self._rejected_keys.set((chatbot_id, _key_digest(api_key)), True)
+
+    async def verify_api_key(self, chatbot_id: str, api_key: str) -> bool:
+        """Check ``api_key`` against the chatbot's key."""
+        if self.is_rejected(chatbot_id, api_key):
+            return False
+        config, cached = await self._lookup(chatbot_id)
+        if config is not None and not _key_matches(config, api_key) and cached:
+            # The cached key may predate a rotation; re-read once before rejecting
+            config = await self.refresh(chatbot_id)
+        if config is not None and _key_matches(config, api_key):
+            return True
+        self.reject(chatbot_id, api_key)
+        return False
+
+    def invalidate(self, chatbot_id: Optional[str] = None) -> None:
+        """Forget one chatbot (or every chatbot when ``chatbot_id`` is None)."""
+        if chatbot_id is None:
+            self._configs.clear()
+            self._rejected_keys.clear()
+            return
+        self._configs.pop(chatbot_id)
+        self._rejected_keys.discard_where(lambda key: key[0] == chatbot_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"configs": self._configs.stats(), "rejected_keys": self._rejected_keys.stats()}
+
+
+def _key_matches(config: Dict[str, Any], api_key: str) -> bool:
+    expected = config.get("api_key") or ""
+    return hmac.compare_digest(expected.encode(), api_key.encode())
+
+
+class SessionCache:
+    """Maps session ids to their chatbot id, evicting sessions that go idle.
+
+    A session's chatbot never changes after creation, so entries are written
+    when the session is created and refreshed on every lookup; a session
+    unused for ``idle_ttl`` seconds (or pushed out by LRU) is dropped and
+    re-read from the database on its next message.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, idle_ttl: Optional[float] = None):
+        self._sessions = TTLCache(
+            maxsize or env_int("SESSION_CACHE_SIZE", 10000),
+            idle_ttl or env_float("SESSION_CACHE_IDLE_TTL", 1800.0),
+        )
+
+    def get(self, session_id: str) -> Optional[str]:
+        """Return the session's chatbot id and record activity, or None on a miss."""
+        entry = self._sessions.get(session_id, None)
+        if entry is None:
+            return None
+        self.put(session_id, entry["chatbot_id"])
+        return entry["chatbot_id"]
+
+    def put(self, session_id: str, chatbot_id: str) -> None:
+        self._sessions.set(session_id, {"chatbot_id": chatbot_id, "last_activity": time.time()})
+
+    def last_activity(self, session_id: str) -> Optional[float]:
+        """Return the Unix time of the session's last cached activity."""
+        entry = self._sessions.get(session_id, None)
+        return entry["last_activity"] if entry else None
+
+    def invalidate(self, session_id: Optional[str] = None) -> None:
+        if session_id is None:
+            self._sessions.clear()
+        else:
+            self._sessions.pop(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._sessions.stats()
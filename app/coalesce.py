@@ -0,0 +1,99 @@
+"""Coalescing of identical concurrent upstream calls (single-flight)."""
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+
+def _consume_exception(future: "asyncio.Future[Any]") -> None:
+    # Avoid "exception was never retrieved" when every waiter has gone away
+    if not future.cancelled():
+        future.exception()
+
+
+class _SharedStream:
+    """One upstream stream replayed to every subscriber, late joiners included."""
+
+    def __init__(self, deltas: AsyncIterator[Any]):
+        self.parts: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(deltas))
+
+    async def _pump(self, deltas: AsyncIterator[Any]) -> None:
+        try:
+            async for delta in deltas:
+                self.parts.append(delta)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[Any]:
+        sent = 0
+        while True:
+            while sent < len(self.parts):
+                yield self.parts[sent]
+                sent += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """Lets concurrent callers with the same key share one in-flight call.
+
+    The first caller starts the call; callers arriving while it runs await
+    the same result (or exception) instead of starting their own. A
+    caller that disconnects does not cancel the call for the others. Once
+    the call finishes the key is released, so results are never reused
+    afterwards; caching is a separate concern.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.coalesced = 0
+        self._futures: Dict[Hashable, "asyncio.Future[Any]"] = {}
+        self._streams: Dict[Hashable, _SharedStream] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        """Return ``await func()``, sharing the call with concurrent callers of ``key``."""
+        future = self._futures.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self._futures[key] = future
+            future.add_done_callback(lambda _: self._futures.pop(key, None))
+            future.add_done_callback(_consume_exception)
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+    def stream(self, key: Hashable, func: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """Iterate ``func()``, sharing the stream with concurrent callers of ``key``.
+
+        A caller joining a stream that is already underway first receives the
+        items produced so far.
+        """
+        shared = self._streams.get(key)
+        if shared is None:
+            self.calls += 1
+            shared = self._streams[key] = _SharedStream(func())
+            shared.task.add_done_callback(lambda _: self._streams.pop(key, None))
+        else:
+            self.coalesced += 1
+        return shared.subscribe()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._futures) + len(self._streams),
+        }
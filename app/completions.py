@@ -0,0 +1,243 @@
+"""The upstream completion call used by the chat endpoints, with response caching."""
+import hashlib
+import json
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from app.cache import MISSING, TTLCache
+from app.coalesce import SingleFlight
+from app.limiter import UpstreamUnavailable
+from app.routing import ModelRouter
+from app.scheduler import API, FairScheduler
+from app.semantic_cache import SemanticCache
+from app.settings import env_float, env_int
+
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 1000
+
+
+def normalize_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Lower-case messages and collapse whitespace so trivially different prompts match."""
+    return [
+        {"role": m["role"].strip().lower(), "content": " ".join(m["content"].split()).casefold()}
+        for m in messages
+    ]
+
+
+class ResponseCache:
+    """Exact-match cache of assistant replies.
+
+    Entries are keyed by chatbot id and a SHA-256 digest of the model,
+    temperature, max_tokens and the normalized message list, so only
+    identical conversations (typically the same opening question) share a
+    reply. Bounded by ``RESPONSE_CACHE_SIZE`` entries, each kept for
+    ``RESPONSE_CACHE_TTL`` seconds.
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, ttl: Optional[float] = None):
+        self._replies = TTLCache(
+            maxsize or env_int("RESPONSE_CACHE_SIZE", 1000),
+            ttl or env_float("RESPONSE_CACHE_TTL", 3600.0),
+        )
+
+    @staticmethod
+    def key(
+        chatbot_id: str,
+        model: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+    ) -> Hashable:
+        payload = json.dumps(
+            [model, temperature, max_tokens, normalize_messages(messages)],
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+        return chatbot_id, hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        reply = self._replies.get(key)
+        return None if reply is MISSING else reply
+
+    def set(self, key: Hashable, reply: str) -> None:
+        if reply:
+            self._replies.set(key, reply)
+
+    def invalidate(self, chatbot_id: Optional[str] = None) -> None:
+        """Forget one chatbot's replies (or every reply when ``chatbot_id`` is None)."""
+        if chatbot_id is None:
+            self._replies.clear()
+        else:
+            self._replies.discard_where(lambda key: key[0] == chatbot_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._replies.stats()
+
+
+def _opening_question(messages: List[Dict[str, str]]) -> Optional[str]:
+    """The user's question if ``messages`` is the first turn of a conversation."""
+    if len(messages) == 1 and messages[0]["role"] == "user":
+        return messages[0]["content"]
+    return None
+
+
+class Completion(NamedTuple):
+    """An assistant reply and the model that produced it (None when served from a cache)."""
+
+    reply: str
+    model: Optional[str]
+
+
+class CompletionStream:
+    """Async iterator of reply deltas; ``model`` is set once the answering model is known."""
+
+    def __init__(self, deltas: Callable[["CompletionStream"], AsyncIterator[str]]):
+        self.model: Optional[str] = None
+        self._deltas = deltas(self)
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._deltas
+
+
+class ChatCompletions:
+    """Produces the assistant reply for a chat turn.
+
+    Chatbots with ``cache_responses`` enabled are answered from
+    ``responses`` when an identical conversation was answered recently.
+    Chatbots with ``semantic_cache`` enabled also have opening questions
+    answered from ``semantic`` when a similar question was answered before.
+    Everything else goes upstream through ``router``, where concurrent
+    requests from the same chatbot and traffic class for the same models and
+    messages share one call. Upstream calls are admitted by ``scheduler``,
+    fairly across chatbots and with ``priority`` (``API`` or ``WIDGET``)
+    deciding the traffic class. Callers still save the turn either way.
+    """
+
+    def __init__(
+        self,
+        router: ModelRouter,
+        responses: ResponseCache,
+        semantic: Optional[SemanticCache] = None,
+        scheduler: Optional[FairScheduler] = None,
+    ):
+        self.router = router
+        self.responses = responses
+        self.semantic = semantic
+        self.scheduler = scheduler or FairScheduler()
+        self.inflight = SingleFlight()
+
+    def _cached(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+    ) -> Tuple[Optional[str], Callable[[str], None]]:
+        """Look the reply up in the enabled caches.
+
+        Returns the cached reply (or None) and a function that stores a fresh
+        reply in those caches.
+        """
+        key = None
+        if chatbot.get("cache_responses"):
+            key = self.responses.key(chatbot["id"], chatbot["model_name"], messages, temperature, max_tokens)
+            reply = self.responses.get(key)
+            if reply is not None:
+                return reply, lambda reply: None
+        question = None
+        if self.semantic is not None and chatbot.get("semantic_cache"):
+            question = _opening_question(messages)
+            if question is not None:
+                reply = self.semantic.get(chatbot["id"], question)
+                if reply is not None:
+                    if key is not None:
+                        self.responses.set(key, reply)
+                    return reply, lambda reply: None
+
+        def remember(reply: str) -> None:
+            if key is not None:
+                self.responses.set(key, reply)
+            if question is not None:
+                self.semantic.add(chatbot["id"], question, reply)
+
+        return None, remember
+
+    def check_available(self, chatbot: Dict[str, Any], priority: str = API) -> None:
+        """Raise ``UpstreamUnavailable`` now if the call would be shed or no model can take it."""
+        retry_after = self.scheduler.retry_after(chatbot["id"], priority)
+        if retry_after is not None:
+            raise UpstreamUnavailable("Too many requests queued for the AI service", retry_after)
+        self.router.check_available(chatbot)
+
+    def _flight_key(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        priority: str,
+    ) -> Hashable:
+        """Identifies upstream calls that are guaranteed to send the same requests.
+
+        Calls are only shared within one chatbot and traffic class, so each
+        tenant's call is scheduled, charged and cached under its own settings.
+        """
+        routing = [self.router.attempts_for(chatbot), chatbot.get("hedge_percentile")]
+        payload = json.dumps([routing, temperature, max_tokens, messages], separators=(",", ":"), ensure_ascii=False)
+        return chatbot["id"], priority, hashlib.sha256(payload.encode()).hexdigest()
+
+    async def complete(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        title: str = "AI Chatbot SaaS",
+        temperature: float = DEFAULT_TEMPERATURE,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+        priority: str = API,
+    ) -> Completion:
+        """Return the reply to ``messages``; raises ``UpstreamError`` on failure."""
+        reply, remember = self._cached(chatbot, messages, temperature, max_tokens)
+        if reply is not None:
+            return Completion(reply, None)
+
+        async def call() -> Completion:
+            async with self.scheduler.slot(chatbot["id"], priority):
+                reply, model = await self.router.complete(
+                    chatbot, messages, title=title, temperature=temperature, max_tokens=max_tokens
+                )
+            remember(reply)
+            return Completion(reply, model)
+
+        return await self.inflight.do(self._flight_key(chatbot, messages, temperature, max_tokens, priority), call)
+
+    def stream(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        title: str = "AI Chatbot SaaS",
+        temperature: float = DEFAULT_TEMPERATURE,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+        priority: str = API,
+    ) -> CompletionStream:
+        """Stream the reply as it is generated; a cached reply arrives as one delta."""
+        reply, remember = self._cached(chatbot, messages, temperature, max_tokens)
+
+        async def call() -> AsyncIterator[Tuple[str, str]]:
+            parts = []
+            async with self.scheduler.slot(chatbot["id"], priority):
+                async for model, delta in self.router.stream(
+                    chatbot, messages, title=title, temperature=temperature, max_tokens=max_tokens
+                ):
+                    parts.append(delta)
+                    yield model, delta
+            remember("".join(parts))
+
+        async def deltas(stream: CompletionStream) -> AsyncIterator[str]:
+            if reply is not None:
+                yield reply
+                return
+            key = self._flight_key(chatbot, messages, temperature, max_tokens, priority)
+            async for model, delta in self.inflight.stream(key, call):
+                stream.model = model
+                yield delta
+
+        return CompletionStream(deltas)
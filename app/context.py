@@ -0,0 +1,301 @@
+"""Token-budgeted context assembly with an incrementally updated rolling summary."""
+import asyncio
+import logging
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from app.cache import MISSING, TTLCache
+from app.completions import ChatCompletions
+from app.llm_client import UpstreamError
+from app.scheduler import BACKGROUND
+from app.settings import env_int, parse_mapping
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional dependency
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# Tokens added per message for role and separators by chat templates
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an assistant. "
+    "Merge the new messages into the current summary. Keep facts, names, decisions, user "
+    "preferences and open questions; drop greetings and small talk. "
+    "Reply with the updated summary only."
+)
+
+_encodings: Dict[str, Any] = {}
+
+
+def _encoding_for(model: str) -> Any:
+    encoding = _encodings.get(model)
+    if encoding is None:
+        try:
+            # OpenRouter model ids are "<provider>/<model>"
+            encoding = tiktoken.encoding_for_model(model.split("/")[-1])
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        _encodings[model] = encoding
+    return encoding
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Count the tokens of ``text`` for ``model``.
+
+    Uses tiktoken when installed and falls back to ~4 characters per token.
+    """
+    if tiktoken is not None:
+        try:
+            return len(_encoding_for(model).encode(text, disallowed_special=()))
+        except Exception:
+            # Encoding files can be unavailable offline; fall through to the estimate
+            pass
+    return len(text) // 4 + 1
+
+
+def message_tokens(message: Dict[str, str], model: str) -> int:
+    return count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS
+
+
+class SummaryStore:
+    """Cached access to the per-session rolling summary.
+
+    ``loader`` returns ``{"summary", "summarized_messages"}`` or None, and
+    ``saver`` upserts it; ``summarized_messages`` counts how many of the
+    session's oldest messages the summary already covers.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], Awaitable[Optional[Dict[str, Any]]]],
+        saver: Callable[[str, str, int], Awaitable[None]],
+        maxsize: Optional[int] = None,
+        ttl: float = 1800.0,
+    ):
+        self.loader = loader
+        self.saver = saver
+        self._summaries = TTLCache(maxsize or env_int("SUMMARY_CACHE_SIZE", 10000), ttl)
+
+    async def get(self, session_id: str) -> Dict[str, Any]:
+        summary = self._summaries.get(session_id)
+        if summary is MISSING:
+            summary = await self.loader(session_id) or {"summary": "", "summarized_messages": 0}
+            self._summaries.set(session_id, summary)
+        return summary
+
+    async def save(self, session_id: str, summary: str, summarized_messages: int) -> None:
+        await self.saver(session_id, summary, summarized_messages)
+        self._summaries.set(session_id, {"summary": summary, "summarized_messages": summarized_messages})
+
+    def invalidate(self, session_id: Optional[str] = None) -> None:
+        if session_id is None:
+            self._summaries.clear()
+        else:
+            self._summaries.pop(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return self._summaries.stats()
+
+
+class ContextBuilder:
+    """Builds the message list sent upstream within a per-model token budget.
+
+    The newest turns are kept verbatim until the budget is spent. Older turns
+    are represented by a rolling summary stored once per session. When turns
+    fall out of the window they are folded into that summary in the
+    background, together with enough older turns to free half the budget, so
+    each update only summarizes messages not yet covered and runs once every
+    few turns rather than on every message (the summary may lag the window by
+    one turn). Sessions that fit in the budget never touch the summary store.
+
+    Summaries are generated through ``completions`` at ``BACKGROUND``
+    priority, so they respect open circuits and count against the chatbot's
+    share of upstream capacity without displacing its live traffic.
+
+    The budget defaults to ``CONTEXT_MAX_TOKENS`` and can be set per model
+    with ``CONTEXT_MODEL_MAX_TOKENS=model=tokens,...``. ``history`` may be
+    the newest part of a session only (a ``History`` with an ``offset``, as
+    cached for long sessions); its older messages are then represented by
+    the summary alone. If the summary does not reach ``offset`` yet, the
+    messages in between are read with ``history_loader`` before they are
+    folded in; without it (or if it fails) the summary is left as it is
+    rather than skipping them.
+    """
+
+    def __init__(
+        self,
+        completions: ChatCompletions,
+        summaries: SummaryStore,
+        max_tokens: Optional[int] = None,
+        model_max_tokens: Optional[Dict[str, int]] = None,
+        summary_model: Optional[str] = None,
+        summary_max_tokens: Optional[int] = None,
+        history_loader: Optional[Callable[[str], Awaitable[List[Dict[str, Any]]]]] = None,
+    ):
+        self.completions = completions
+        self.summaries = summaries
+        self.history_loader = history_loader
+        self.max_tokens = max_tokens or env_int("CONTEXT_MAX_TOKENS", 3000)
+        self.model_max_tokens = (
+            model_max_tokens
+            if model_max_tokens is not None
+            else {
+                model: int(limit)
+                for model, limit in parse_mapping(os.getenv("CONTEXT_MODEL_MAX_TOKENS")).items()
+            }
+        )
+        self.summary_model = summary_model or os.getenv("CONTEXT_SUMMARY_MODEL")
+        self.summary_max_tokens = summary_max_tokens or env_int("CONTEXT_SUMMARY_MAX_TOKENS", 400)
+        self._summarizing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def budget_for(self, model: str) -> int:
+        return self.model_max_tokens.get(model, self.max_tokens)
+
+    def _window_start(self, history: List[Dict[str, str]], model: str, budget: int) -> int:
+        """Index of the oldest history message that still fits in ``budget``."""
+        used = 0
+        start = len(history)
+        while start > 0:
+            used += message_tokens(history[start - 1], model)
+            if used > budget:
+                break
+            start -= 1
+        return start
+
+    async def build(
+        self,
+        session_id: str,
+        chatbot: Dict[str, Any],
+        history: List[Dict[str, str]],
+        new_messages: List[Dict[str, str]],
+    ) -> List[Dict[str, str]]:
+        """Return the messages to send upstream for this turn of ``chatbot``."""
+        model = chatbot["model_name"]
+        budget = self.budget_for(model) - sum(message_tokens(m, model) for m in new_messages)
+        start = self._window_start(history, model, budget)
+        # Messages before ``offset`` are not in ``history``; indices below are relative to it
+        offset = getattr(history, "offset", 0)
+        if start == 0 and offset == 0:
+            return history + new_messages
+
+        try:
+            stored = await self.summaries.get(session_id)
+        except Exception as e:
+            logger.error(f"Error loading conversation summary: {str(e)}")
+            stored = {"summary": "", "summarized_messages": 0}
+
+        covered = max(stored["summarized_messages"] - offset, 0)
+        context: List[Dict[str, str]] = []
+        if stored["summary"]:
+            summary_message = {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{stored['summary']}",
+            }
+            context.append(summary_message)
+            start = max(
+                start,
+                min(covered, len(history)),
+                self._window_start(history, model, budget - message_tokens(summary_message, model)),
+            )
+
+        if covered < start or stored["summarized_messages"] < offset:
+            # Fold everything but the newest half of the budget, so the next
+            # update is only needed once that headroom has been used up (and
+            # any messages between the summary and the cached history)
+            upto = max(start, self._window_start(history, model, budget // 2))
+            self._schedule_summary(session_id, chatbot, history, stored, covered, offset, upto)
+        return context + list(history[start:]) + new_messages
+
+    def _schedule_summary(
+        self,
+        session_id: str,
+        chatbot: Dict[str, Any],
+        history: List[Dict[str, str]],
+        stored: Dict[str, Any],
+        covered: int,
+        offset: int,
+        upto: int,
+    ) -> None:
+        if session_id in self._summarizing:
+            return
+        self._summarizing.add(session_id)
+        task = asyncio.create_task(
+            self._update_summary(session_id, chatbot, history[covered:upto], stored, offset + covered, offset + upto)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _summarizer(self, chatbot: Dict[str, Any]) -> Dict[str, Any]:
+        """The chatbot's models (or ``CONTEXT_SUMMARY_MODEL``) for summary calls, without caching or hedging."""
+        if self.summary_model:
+            return {"id": chatbot["id"], "model_name": self.summary_model}
+        return {"id": chatbot["id"], "model_name": chatbot["model_name"], "fallback_models": chatbot.get("fallback_models")}
+
+    async def _update_summary(
+        self,
+        session_id: str,
+        chatbot: Dict[str, Any],
+        new_messages: List[Dict[str, str]],
+        stored: Dict[str, Any],
+        first: int,
+        summarized_messages: int,
+    ) -> None:
+        """Fold ``new_messages`` (from message ``first`` on) into the stored summary.
+
+        The summary then covers ``summarized_messages`` messages.
+        """
+        try:
+            if first > stored["summarized_messages"]:
+                missing = await self._load_messages(session_id, stored["summarized_messages"], first)
+                if missing is None:
+                    return
+                new_messages = missing + new_messages
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in new_messages)
+            prompt = [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {
+                    "role": "user",
+                    "content": f"Current summary:\n{stored['summary'] or '(none)'}\n\nNew messages:\n{transcript}",
+                },
+            ]
+            completion = await self.completions.complete(
+                self._summarizer(chatbot),
+                prompt,
+                title="AI Chatbot Summarizer",
+                temperature=0.2,
+                max_tokens=self.summary_max_tokens,
+                priority=BACKGROUND,
+            )
+            await self.summaries.save(session_id, completion.reply.strip(), summarized_messages)
+        except UpstreamError as e:
+            logger.warning(f"Could not update conversation summary: {e.detail}")
+        except Exception as e:
+            logger.error(f"Error updating conversation summary: {str(e)}", exc_info=True)
+        finally:
+            self._summarizing.discard(session_id)
+
+    async def _load_messages(self, session_id: str, start: int, end: int) -> Optional[List[Dict[str, str]]]:
+        """Messages ``start:end`` of the session, which are older than its cached history."""
+        if self.history_loader is not None:
+            try:
+                messages = await self.history_loader(session_id)
+            except Exception as e:
+                logger.error(f"Error loading history for the conversation summary: {str(e)}")
+            else:
+                if len(messages) >= end:
+                    return [{"role": m["role"], "content": m["content"]} for m in messages[start:end]]
+        logger.warning(
+            f"Messages {start}-{end} of session {session_id} are not in the cached history; "
+            "leaving its conversation summary as it is"
+        )
+        return None
+
+    def invalidate(self, session_id: Optional[str] = None) -> None:
+        self.summaries.invalidate(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"summaries": self.summaries.stats(), "summarizing": len(self._summarizing)}
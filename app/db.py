@@ -0,0 +1,64 @@
+"""Non-blocking access to the synchronous supabase-py client."""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from app.settings import env_int
+
+
+class AsyncDB:
+    """Runs blocking supabase-py queries on a bounded thread pool.
+
+    Build the query as usual and await ``execute`` instead of calling
+    ``.execute()`` directly, so the event loop keeps serving other requests
+    while PostgREST answers::
+
+        response = await db.execute(supabase.table("chatbots").select("*").eq("id", chatbot_id))
+
+    ``max_workers`` (``SUPABASE_MAX_WORKERS``) caps how many queries run at once.
+
+    The client is built by ``client_factory`` in ``connect`` (called at
+    startup, off the event loop) or on first use, so importing the app does
+    no client setup or network I/O.
+    """
+
+    def __init__(self, client_factory: Callable[[], Any], max_workers: Optional[int] = None):
+        self.client_factory = client_factory
+        self.max_workers = max_workers or env_int("SUPABASE_MAX_WORKERS", 32)
+        self._client: Any = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def client(self) -> Any:
+        """The supabase-py client, created on first use."""
+        if self._client is None:
+            self._client = self.client_factory()
+        return self._client
+
+    async def connect(self) -> None:
+        """Create the client on the thread pool."""
+        if self._client is None:
+            client = await self.run(self.client_factory)
+            if self._client is None:
+                self._client = client
+
+    async def ping(self) -> None:
+        """Run a trivial query; raises if the database cannot be reached."""
+        await self.execute(self.client.table("chatbots").select("id").limit(1))
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Call ``func`` on the database thread pool."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="supabase")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def execute(self, query: Any) -> Any:
+        """Execute a supabase-py query builder without blocking the event loop."""
+        return await self.run(query.execute)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
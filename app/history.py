@@ -0,0 +1,196 @@
+"""Write-through, in-memory cache of per-session conversation history."""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+from app.settings import env_float, env_int
+
+# Rough per-message overhead (dict, keys, role string) added to the content length
+MESSAGE_OVERHEAD_BYTES = 64
+
+
+def _message_size(message: Dict[str, str]) -> int:
+    return len(message["content"]) + MESSAGE_OVERHEAD_BYTES
+
+
+class History(list):
+    """A session's messages, oldest first, of which the oldest ``offset`` were left out.
+
+    Long sessions are cached as their newest messages only; ``ContextBuilder``
+    uses ``offset`` to line them up with the rolling summary. Concatenating
+    keeps the offset.
+    """
+
+    def __init__(self, messages: Iterable[Dict[str, str]] = (), offset: int = 0):
+        super().__init__(messages)
+        self.offset = offset
+
+    def __add__(self, other: List[Dict[str, str]]) -> "History":
+        return History(list.__add__(self, other), self.offset)
+
+
+class _Entry:
+    __slots__ = ("messages", "offset", "size", "last_access")
+
+    def __init__(self, messages: List[Dict[str, str]], offset: int = 0):
+        self.messages = messages
+        self.offset = offset
+        self.size = sum(_message_size(m) for m in messages)
+        self.last_access = time.monotonic()
+
+
+class HistoryCache:
+    """Per-session conversation history, loaded once and appended on each turn.
+
+    Only a miss reads the ``conversations`` table; afterwards every saved turn
+    is appended here as well. Memory is bounded by a global byte budget
+    (least recently used sessions are evicted first) and sessions idle for
+    ``idle_ttl`` seconds are dropped. A session that outgrows the per-session
+    caps keeps only its newest messages (returned as a ``History`` with an
+    ``offset``); keep the caps well above the context window so the window
+    is always served from the tail.
+
+    The cache is per process and only sees turns saved through it. With
+    several workers or instances, route each session to one of them (sticky
+    sessions), or a session that moves between them may be answered from
+    history that misses turns saved elsewhere until its entry goes idle.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        max_messages_per_session: Optional[int] = None,
+        max_bytes_per_session: Optional[int] = None,
+        idle_ttl: Optional[float] = None,
+    ):
+        self.max_bytes = max_bytes or env_int("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+        self.max_messages_per_session = max_messages_per_session or env_int(
+            "HISTORY_CACHE_MAX_MESSAGES_PER_SESSION", 200
+        )
+        self.max_bytes_per_session = max_bytes_per_session or env_int(
+            "HISTORY_CACHE_MAX_BYTES_PER_SESSION", 256 * 1024
+        )
+        self.idle_ttl = idle_ttl or env_float("HISTORY_CACHE_IDLE_TTL", 1800.0)
+        self.hits = 0
+        self.misses = 0
+        self._sessions: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        # Sessions currently being loaded -> whether a turn was appended meanwhile
+        self._loading: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[History]:
+        """Return a copy of the cached history, or None on a miss."""
+        with self._lock:
+            self._evict_idle()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self.hits += 1
+            return History(entry.messages, entry.offset)
+
+    async def get_or_load(
+        self,
+        session_id: str,
+        loader: Callable[[str], Awaitable[List[Dict[str, str]]]],
+    ) -> List[Dict[str, str]]:
+        """Return the session's history, calling ``loader`` only on a miss."""
+        messages = self.get(session_id)
+        if messages is not None:
+            return messages
+        return await self.load(session_id, loader)
+
+    async def load(
+        self,
+        session_id: str,
+        loader: Callable[[str], Awaitable[List[Dict[str, str]]]],
+    ) -> List[Dict[str, str]]:
+        """Call ``loader`` and cache its result, bypassing the cache lookup."""
+        self._loading.setdefault(session_id, False)
+        try:
+            messages = [{"role": m["role"], "content": m["content"]} for m in await loader(session_id)]
+            # Don't cache a snapshot that missed a turn appended while loading
+            if not self._loading.get(session_id):
+                self.put(session_id, messages)
+        finally:
+            self._loading.pop(session_id, None)
+        return messages
+
+    def put(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        entry = _Entry(
+            [{"role": m["role"], "content": m["content"]} for m in messages], getattr(messages, "offset", 0)
+        )
+        self._trim(entry)
+        with self._lock:
+            self._remove(session_id)
+            self._sessions[session_id] = entry
+            self._bytes += entry.size
+            self._enforce_budget()
+
+    def append(self, session_id: str, messages: List[Dict[str, str]]) -> None:
+        """Record newly saved messages; a no-op for sessions that aren't cached."""
+        with self._lock:
+            if session_id in self._loading:
+                self._loading[session_id] = True
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return
+            for message in messages:
+                message = {"role": message["role"], "content": message["content"]}
+                entry.messages.append(message)
+                entry.size += _message_size(message)
+                self._bytes += _message_size(message)
+            entry.last_access = time.monotonic()
+            self._sessions.move_to_end(session_id)
+            self._bytes -= self._trim(entry)
+            self._enforce_budget()
+
+    def invalidate(self, session_id: Optional[str] = None) -> None:
+        with self._lock:
+            if session_id is None:
+                self._sessions.clear()
+                self._bytes = 0
+            else:
+                self._remove(session_id)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _trim(self, entry: _Entry) -> int:
+        """Drop the oldest messages beyond the per-session caps, keeping at least one; returns the bytes freed."""
+        freed = 0
+        while len(entry.messages) > 1 and (
+            len(entry.messages) > self.max_messages_per_session or entry.size > self.max_bytes_per_session
+        ):
+            size = _message_size(entry.messages.pop(0))
+            entry.size -= size
+            entry.offset += 1
+            freed += size
+        return freed
+
+    def _remove(self, session_id: str) -> None:
+        entry = self._sessions.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            session_id, entry = next(iter(self._sessions.items()))
+            if entry.last_access > deadline:
+                break
+            self._remove(session_id)
+
+    def _enforce_budget(self) -> None:
+        while self._bytes > self.max_bytes and self._sessions:
+            self._remove(next(iter(self._sessions)))
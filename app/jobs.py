@@ -0,0 +1,358 @@
+"""Asynchronous chat turns: submitted as jobs, answered by a worker pool, polled or delivered by webhook."""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import httpx
+from fastapi import HTTPException
+
+from app.llm_client import UpstreamError
+from app.settings import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+# Fields of a job returned to clients and sent to webhooks
+PUBLIC_FIELDS = ("session_id", "status", "reply", "model", "error", "status_code", "created_at", "completed_at")
+
+
+def public_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {"job_id": job["id"], **{field: job.get(field) for field in PUBLIC_FIELDS}}
+
+
+class WebhookRejected(ValueError):
+    """A webhook URL that may not be called (wrong scheme, host not allowed, private address)."""
+
+
+def _is_public(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    # Excludes loopback, private, link-local (cloud metadata), shared and reserved ranges
+    return ip.is_global and not ip.is_multicast
+
+
+class MemoryJobStore:
+    """Jobs in process memory; a stand-in for ``chat_jobs`` in tests and single-worker setups.
+
+    Jobs are lost on restart and not visible to other workers.
+    """
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+
+    async def create(self, job: Dict[str, Any]) -> None:
+        self._jobs[job["id"]] = dict(job)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    async def claim(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = self._jobs.get(job_id)
+        if job is None or job["status"] != "queued":
+            return None
+        job.update(status="running", updated_at=datetime.utcnow().isoformat())
+        return dict(job)
+
+    async def finish(self, job_id: str, fields: Dict[str, Any]) -> None:
+        self._jobs[job_id].update(fields)
+
+    async def queued(self, limit: int) -> List[str]:
+        return [job_id for job_id, job in self._jobs.items() if job["status"] == "queued"][:limit]
+
+    async def requeue_stale(self, before: str) -> int:
+        stale = [job for job in self._jobs.values() if job["status"] == "running" and job["updated_at"] < before]
+        for job in stale:
+            job.update(status="queued", updated_at=datetime.utcnow().isoformat())
+        return len(stale)
+
+
+class DatabaseJobStore:
+    """Jobs in the ``chat_jobs`` table (see ``init_db.sql``), shared by every worker."""
+
+    def __init__(self, storage: Any):
+        self.storage = storage
+
+    async def create(self, job: Dict[str, Any]) -> None:
+        await self.storage.create_job(job)
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.storage.get_job(job_id)
+
+    async def claim(self, job_id: str) -> Optional[Dict[str, Any]]:
+        # Only one worker can move a job out of "queued"
+        return await self.storage.claim_job(job_id, {"status": "running", "updated_at": datetime.utcnow().isoformat()})
+
+    async def finish(self, job_id: str, fields: Dict[str, Any]) -> None:
+        await self.storage.update_job(job_id, fields)
+
+    async def queued(self, limit: int) -> List[str]:
+        return await self.storage.queued_job_ids(limit)
+
+    async def requeue_stale(self, before: str) -> int:
+        """Hand jobs left ``running`` since before ``before`` back to the queue; returns how many."""
+        return await self.storage.requeue_stale_jobs(before, {"status": "queued", "updated_at": datetime.utcnow().isoformat()})
+
+
+def job_store_from_env(storage: Any) -> Any:
+    """``MemoryJobStore`` when ``CHAT_JOBS_STORE=memory``, else ``DatabaseJobStore`` on ``storage``."""
+    if os.getenv("CHAT_JOBS_STORE", "database").strip().lower() == "memory":
+        return MemoryJobStore()
+    return DatabaseJobStore(storage)
+
+
+class ChatJobQueue:
+    """Bounded worker pool answering chat jobs in the background.
+
+    ``submit`` stores a queued job and returns at once; ``JOB_WORKERS``
+    workers then claim jobs and call ``process(job)``, which returns the
+    ``Completion`` for the turn. Jobs of the same session run in submission
+    order. The outcome is stored for polling and, when the job has a
+    ``webhook_url``, POSTed there (retried ``JOB_WEBHOOK_RETRIES`` times and
+    signed with ``JOB_WEBHOOK_SECRET`` when set). Webhooks only go to hosts
+    resolving to public addresses, checked on every delivery and connected
+    to by the checked address, and redirects are not followed. With
+    ``JOB_WEBHOOK_ALLOWED_HOSTS`` set, only those hosts are called (and they
+    may be private).
+
+    At most ``JOB_MAX_QUEUE`` jobs wait per worker process; beyond that
+    ``submit`` raises 503. Jobs still queued when a worker stops are picked
+    up again on the next start, as are jobs left ``running`` for longer
+    than ``JOB_LEASE_TIMEOUT`` seconds by a worker that died; keep that well
+    above the longest a chat turn can take, or another worker may answer a
+    job that is still running.
+    """
+
+    def __init__(
+        self,
+        store: Any,
+        process: Callable[[Dict[str, Any]], Awaitable[Any]],
+        workers: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        webhook_timeout: Optional[float] = None,
+        webhook_retries: Optional[int] = None,
+    ):
+        self.store = store
+        self.process = process
+        self.workers = workers or env_int("JOB_WORKERS", 4)
+        self.max_queue = max_queue or env_int("JOB_MAX_QUEUE", 1000)
+        self.webhook_timeout = webhook_timeout or env_float("JOB_WEBHOOK_TIMEOUT", 10.0)
+        self.webhook_retries = env_int("JOB_WEBHOOK_RETRIES", 3) if webhook_retries is None else webhook_retries
+        self.webhook_secret = os.getenv("JOB_WEBHOOK_SECRET")
+        self.lease_timeout = env_float("JOB_LEASE_TIMEOUT", 600.0)
+        self.webhook_allowed_hosts = {
+            host.strip().lower() for host in os.getenv("JOB_WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+        }
+        self.completed = 0
+        self.failed = 0
+        self._queue: Optional["asyncio.Queue[str]"] = None
+        self._tasks: List[asyncio.Task] = []
+        self._http: Optional[httpx.AsyncClient] = None
+        self._session_locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+        self._webhooks: Set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        """Start the workers and queue jobs left over from a previous run."""
+        self._queue = asyncio.Queue()
+        self._http = httpx.AsyncClient(timeout=self.webhook_timeout, follow_redirects=False)
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+        try:
+            before = (datetime.utcnow() - timedelta(seconds=self.lease_timeout)).isoformat()
+            stale = await self.store.requeue_stale(before)
+            if stale:
+                logger.warning(f"Requeued {stale} chat jobs left running by a stopped worker")
+            leftover = await self.store.queued(self.max_queue)
+        except Exception as e:
+            logger.error(f"Error loading queued chat jobs: {str(e)}")
+            return
+        for job_id in leftover:
+            self._queue.put_nowait(job_id)
+        if leftover:
+            logger.info(f"Resuming {len(leftover)} queued chat jobs")
+
+    async def stop(self) -> None:
+        for task in self._tasks + list(self._webhooks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, *self._webhooks, return_exceptions=True)
+        self._tasks = []
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    async def submit(
+        self,
+        session_id: str,
+        chatbot_id: str,
+        user_messages: List[str],
+        webhook_url: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Store and queue a chat turn; returns the job."""
+        if self._queue is None or self._queue.qsize() >= self.max_queue:
+            raise HTTPException(
+                status_code=503,
+                detail="Too many chat jobs queued",
+                headers={"Retry-After": "5"},
+            )
+        now = datetime.utcnow().isoformat()
+        job = {
+            "id": str(uuid.uuid4()),
+            "session_id": session_id,
+            "chatbot_id": chatbot_id,
+            "status": "queued",
+            "user_messages": user_messages,
+            "webhook_url": webhook_url,
+            "created_at": now,
+            "updated_at": now,
+        }
+        await self.store.create(job)
+        self._queue.put_nowait(job["id"])
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.store.get(job_id)
+
+    def check_webhook_url(self, url: str) -> httpx.URL:
+        """Parse ``url`` and raise ``WebhookRejected`` unless it may be called, as far as is known without DNS."""
+        try:
+            parsed = httpx.URL(url)
+        except Exception:
+            raise WebhookRejected("webhook_url is not a valid URL")
+        if parsed.scheme not in ("http", "https") or not parsed.host:
+            raise WebhookRejected("webhook_url must be an http(s) URL")
+        host = parsed.host.lower()
+        if self.webhook_allowed_hosts:
+            if host not in self.webhook_allowed_hosts:
+                raise WebhookRejected("webhook_url host is not allowed")
+            return parsed
+        try:
+            private = not _is_public(host)
+        except ValueError:
+            private = host == "localhost" or host.endswith(".localhost")
+        if private:
+            raise WebhookRejected("webhook_url must point to a public address")
+        return parsed
+
+    async def _webhook_target(self, url: str) -> Tuple[httpx.URL, Dict[str, str], Dict[str, Any]]:
+        """The URL to POST to, pinned to a checked address, with the headers and extensions that go with it.
+
+        The host is resolved here, at send time, and the request connects to
+        the address that was checked, so DNS cannot point it elsewhere later.
+        """
+        parsed = self.check_webhook_url(url)
+        host = parsed.host
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        addresses = [info[4][0] for info in infos]
+        if not addresses:
+            raise OSError(f"No address for {host}")
+        if host.lower() not in self.webhook_allowed_hosts and not all(_is_public(address) for address in addresses):
+            raise WebhookRejected("webhook_url must point to a public address")
+        headers = {"Host": parsed.netloc.decode("ascii")}
+        extensions = {"sni_hostname": host} if parsed.scheme == "https" else {}
+        return parsed.copy_with(host=addresses[0]), headers, extensions
+
+    async def _work(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Error running chat job {job_id}: {str(e)}", exc_info=True)
+            finally:
+                self._queue.task_done()
+
+    @asynccontextmanager
+    async def _in_order(self, session_id: str) -> AsyncIterator[None]:
+        lock, users = self._session_locks.get(session_id, (asyncio.Lock(), 0))
+        self._session_locks[session_id] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._session_locks[session_id]
+            if users == 1:
+                del self._session_locks[session_id]
+            else:
+                self._session_locks[session_id] = (lock, users - 1)
+
+    async def _run(self, job_id: str) -> None:
+        job = await self.store.claim(job_id)
+        if job is None:
+            return  # Claimed by another worker or gone
+        try:
+            async with self._in_order(job["session_id"]):
+                try:
+                    completion = await self.process(job)
+                    outcome = {"status": "succeeded", "reply": completion.reply, "model": completion.model, "status_code": 200}
+                except HTTPException as e:
+                    outcome = {"status": "failed", "error": str(e.detail), "status_code": e.status_code}
+                except UpstreamError as e:
+                    outcome = {
+                        "status": "failed",
+                        "error": f"Error communicating with AI service: {e.detail}",
+                        "status_code": 503 if e.retry_after is not None else 500,
+                    }
+                except Exception as e:
+                    logger.error(f"Unexpected error in chat job {job_id}: {str(e)}", exc_info=True)
+                    outcome = {"status": "failed", "error": "An unexpected error occurred", "status_code": 500}
+        except asyncio.CancelledError:
+            # Stopping, while running or still waiting for the session's earlier
+            # jobs: hand the job back so the next start picks it up again
+            await self.store.finish(job_id, {"status": "queued", "updated_at": datetime.utcnow().isoformat()})
+            raise
+        now = datetime.utcnow().isoformat()
+        outcome.update(updated_at=now, completed_at=now)
+        await self.store.finish(job_id, outcome)
+        if outcome["status"] == "succeeded":
+            self.completed += 1
+        else:
+            self.failed += 1
+        job.update(outcome)
+        if job.get("webhook_url"):
+            # Deliver in the background so slow webhooks don't hold up the workers
+            task = asyncio.create_task(self._notify(job))
+            self._webhooks.add(task)
+            task.add_done_callback(self._webhooks.discard)
+
+    async def _notify(self, job: Dict[str, Any]) -> None:
+        """POST the job's outcome to its webhook, retrying with backoff."""
+        body = json.dumps(public_job(job)).encode()
+        headers = {"Content-Type": "application/json"}
+        if self.webhook_secret:
+            signature = hmac.new(self.webhook_secret.encode(), body, hashlib.sha256).hexdigest()
+            headers["X-Webhook-Signature"] = f"sha256={signature}"
+        for attempt in range(self.webhook_retries + 1):
+            try:
+                url, target_headers, extensions = await self._webhook_target(job["webhook_url"])
+                response = await self._http.post(
+                    url, content=body, headers={**headers, **target_headers}, extensions=extensions
+                )
+                if response.status_code < 400:
+                    return
+                logger.warning(f"Webhook for chat job {job['id']} returned {response.status_code}")
+            except WebhookRejected as e:
+                logger.error(f"Not calling the webhook of chat job {job['id']}: {str(e)}")
+                return
+            except (httpx.HTTPError, OSError) as e:
+                logger.warning(f"Webhook for chat job {job['id']} failed: {str(e)}")
+            if attempt < self.webhook_retries:
+                await asyncio.sleep(2 ** attempt)
+        logger.error(f"Giving up on webhook for chat job {job['id']}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue": self.max_queue,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,243 @@
+"""Adaptive per-model concurrency limits and circuit breakers for upstream calls."""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional
+
+from app.llm_client import UpstreamError
+from app.settings import env_float, env_int
+
+
+class UpstreamUnavailable(UpstreamError):
+    """Raised without calling upstream when a model is overloaded or its circuit is open."""
+
+    def __init__(self, detail: str, retry_after: float):
+        super().__init__(detail, status_code=503)
+        self.retry_after = retry_after
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Whether ``error`` signals an unhealthy upstream rather than a bad request."""
+    if not isinstance(error, UpstreamError) or isinstance(error, UpstreamUnavailable):
+        return False
+    return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by observed latency.
+
+    Each successful call that is not much slower than the long-run average
+    latency (``LIMITER_LATENCY_TOLERANCE`` times the EWMA) raises the limit
+    by ``1/limit``, i.e. by about one per round of calls. Slow calls and
+    upstream failures multiply it by ``LIMITER_BACKOFF``. Calls over the
+    limit wait in a FIFO queue of at most ``LIMITER_MAX_QUEUE`` entries for up
+    to ``LIMITER_QUEUE_TIMEOUT`` seconds; beyond that they are rejected.
+    """
+
+    def __init__(
+        self,
+        initial_limit: Optional[float] = None,
+        min_limit: Optional[float] = None,
+        max_limit: Optional[float] = None,
+        backoff: Optional[float] = None,
+        tolerance: Optional[float] = None,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ):
+        self.min_limit = min_limit or env_float("LIMITER_MIN_LIMIT", 2.0)
+        self.max_limit = max_limit or env_float("LIMITER_MAX_LIMIT", 64.0)
+        self.limit = initial_limit or env_float("LIMITER_INITIAL_LIMIT", 16.0)
+        self.backoff = backoff or env_float("LIMITER_BACKOFF", 0.9)
+        self.tolerance = tolerance or env_float("LIMITER_LATENCY_TOLERANCE", 2.0)
+        self.max_queue = env_int("LIMITER_MAX_QUEUE", 100) if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout or env_float("LIMITER_QUEUE_TIMEOUT", 5.0)
+        self.in_flight = 0
+        self.rejected = 0
+        self.latency_ewma: Optional[float] = None
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def saturated(self) -> bool:
+        """Whether a new call would be rejected right away."""
+        return self.in_flight >= self.limit and len(self._waiters) >= self.max_queue
+
+    async def acquire(self) -> None:
+        """Take a slot, waiting in the queue if needed; raises ``UpstreamUnavailable``."""
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamUnavailable("Too many requests queued for the AI service", self.queue_timeout)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                waiter.cancel()
+                self.rejected += 1
+                raise UpstreamUnavailable("Timed out waiting for the AI service", self.queue_timeout)
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()  # Granted just as we were cancelled
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    def release(self, latency: Optional[float] = None, failed: bool = False) -> None:
+        """Return a slot and adapt the limit to the call's outcome.
+
+        ``latency`` is None for calls that carry no latency signal (cancelled
+        calls, streams); those leave the limit unchanged unless ``failed``.
+        """
+        if failed:
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        elif latency is not None:
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            if latency > self.latency_ewma * self.tolerance:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            elif self.in_flight >= self.limit / 2:
+                # Only grow while the current limit is actually being used
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.latency_ewma += 0.05 * (latency - self.latency_ewma)
+        self._release_slot()
+
+    def _release_slot(self) -> None:
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.in_flight += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+            "latency_ewma": self.latency_ewma,
+        }
+
+
+class CircuitBreaker:
+    """Opens after consecutive upstream failures and lets one probe through after a cool-down.
+
+    ``CIRCUIT_FAILURE_THRESHOLD`` consecutive failures open the circuit for
+    ``CIRCUIT_RESET_TIMEOUT`` seconds, during which calls fail fast. Then a
+    single probe is let through: success closes the circuit, failure opens
+    it again.
+    """
+
+    def __init__(self, failure_threshold: Optional[int] = None, reset_timeout: Optional[float] = None):
+        self.failure_threshold = failure_threshold or env_int("CIRCUIT_FAILURE_THRESHOLD", 5)
+        self.reset_timeout = reset_timeout or env_float("CIRCUIT_RESET_TIMEOUT", 30.0)
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def retry_after(self) -> Optional[float]:
+        """Seconds until a call may be attempted, or None if one may go now."""
+        if self.state == "closed":
+            return None
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == "open" and remaining > 0:
+            return remaining
+        return 1.0 if self._probing else None
+
+    def before_call(self) -> None:
+        retry_after = self.retry_after()
+        if retry_after is not None:
+            raise UpstreamUnavailable("The AI service is temporarily unavailable", retry_after)
+        if self.state != "closed":
+            self.state = "half_open"
+            self._probing = True
+
+    def record(self, failed: bool) -> None:
+        probe, self._probing = self._probing, False
+        if not failed:
+            self.state = "closed"
+            self.failures = 0
+            return
+        self.failures += 1
+        if probe or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def release_probe(self) -> None:
+        """Give up a probe that ended without an outcome (e.g. it was cancelled)."""
+        self._probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class UpstreamGuard:
+    """Per-model ``AdaptiveLimiter`` and ``CircuitBreaker`` around upstream calls."""
+
+    def __init__(self):
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def limiter(self, model: str) -> AdaptiveLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = AdaptiveLimiter()
+        return self._limiters[model]
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker()
+        return self._breakers[model]
+
+    def retry_after(self, model: str) -> Optional[float]:
+        """Seconds until ``model`` can take a call, or None if it can take one now."""
+        retry_after = self.breaker(model).retry_after()
+        if retry_after is None and self.limiter(model).saturated():
+            retry_after = self.limiter(model).queue_timeout
+        return retry_after
+
+    @asynccontextmanager
+    async def slot(self, model: str, measure_latency: bool = True) -> AsyncIterator[None]:
+        """Hold one of ``model``'s concurrency slots for the duration of a call.
+
+        Raises ``UpstreamUnavailable`` without calling upstream when the
+        circuit is open or the queue is full.
+        """
+        breaker = self.breaker(model)
+        limiter = self.limiter(model)
+        breaker.before_call()
+        try:
+            await limiter.acquire()
+        except BaseException:
+            breaker.release_probe()
+            raise
+        started = time.monotonic()
+        try:
+            yield
+        except BaseException as e:
+            if isinstance(e, UpstreamError):
+                failed = is_upstream_failure(e)
+                breaker.record(failed)
+                limiter.release(None, failed=failed)
+            else:
+                breaker.release_probe()
+                limiter.release()
+            raise
+        breaker.record(False)
+        limiter.release(time.monotonic() - started if measure_latency else None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {**self.limiter(model).stats(), "circuit": self.breaker(model).stats()}
+            for model in sorted(set(self._limiters) | set(self._breakers))
+        }
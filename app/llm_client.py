@@ -0,0 +1,188 @@
+"""Shared async client for the OpenRouter chat completions API."""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:  # pragma: no cover - depends on the installed extras
+    HTTP2_AVAILABLE = False
+
+from app.settings import env_float, env_int, parse_mapping
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+
+class UpstreamError(Exception):
+    """Raised when OpenRouter cannot produce a completion."""
+
+    # Seconds after which the caller may retry, when known
+    retry_after: Optional[float] = None
+
+    def __init__(self, detail: str, status_code: Optional[int] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code
+
+
+class OpenRouterClient:
+    """Pooled, non-blocking client for OpenRouter chat completions.
+
+    One ``httpx.AsyncClient`` is shared by every chat turn, so upstream
+    connections stay alive (and are multiplexed over HTTP/2 when ``h2`` is
+    installed) instead of being re-opened per request. The number of
+    in-flight requests per model is capped with a semaphore.
+
+    Pool settings default to the ``OPENROUTER_*`` environment variables.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str],
+        referer: str = "https://pros.tools",
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        timeout: Optional[float] = None,
+        per_model_concurrency: Optional[int] = None,
+        model_concurrency: Optional[Dict[str, int]] = None,
+    ):
+        self.api_key = api_key
+        self.referer = referer
+        self.max_connections = max_connections or env_int("OPENROUTER_MAX_CONNECTIONS", 100)
+        self.max_keepalive_connections = max_keepalive_connections or env_int(
+            "OPENROUTER_MAX_KEEPALIVE_CONNECTIONS", 20
+        )
+        self.keepalive_expiry = keepalive_expiry or env_float("OPENROUTER_KEEPALIVE_EXPIRY", 60.0)
+        self.timeout = timeout or env_float("OPENROUTER_TIMEOUT", 30.0)
+        self.per_model_concurrency = per_model_concurrency or env_int(
+            "OPENROUTER_MAX_CONCURRENCY_PER_MODEL", 64
+        )
+        self.model_concurrency = (
+            model_concurrency
+            if model_concurrency is not None
+            else {
+                model: int(limit)
+                for model, limit in parse_mapping(os.getenv("OPENROUTER_MODEL_CONCURRENCY")).items()
+            }
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_keepalive_connections,
+                    keepalive_expiry=self.keepalive_expiry,
+                ),
+                timeout=httpx.Timeout(self.timeout, connect=10.0),
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "HTTP-Referer": self.referer,
+                },
+            )
+        return self._client
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(model)
+        if semaphore is None:
+            limit = self.model_concurrency.get(model, self.per_model_concurrency)
+            semaphore = asyncio.Semaphore(limit)
+            self._semaphores[model] = semaphore
+        return semaphore
+
+    async def chat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        title: str = "AI Chatbot SaaS",
+        temperature: float = 0.7,
+        max_tokens: int = 1000,
+    ) -> str:
+        """Return the assistant's reply for ``messages``."""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+        async with self._semaphore(model):
+            try:
+                response = await self._get_client().post(
+                    OPENROUTER_URL, json=payload, headers={"X-Title": title}
+                )
+                logger.debug(f"OpenRouter response status: {response.status_code}")
+                response.raise_for_status()
+                return response.json()["choices"][0]["message"]["content"]
+            except httpx.HTTPStatusError as e:
+                detail = f"{e}\nResponse status: {e.response.status_code}\nResponse body: {e.response.text}"
+                raise UpstreamError(detail, status_code=e.response.status_code) from e
+            except httpx.HTTPError as e:
+                raise UpstreamError(str(e) or e.__class__.__name__) from e
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                raise UpstreamError(f"Malformed response from AI service: {e}") from e
+
+    async def stream_chat_completion(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        title: str = "AI Chatbot SaaS",
+        temperature: float = 0.7,
+        max_tokens: int = 1000,
+    ) -> AsyncIterator[str]:
+        """Yield the assistant's reply for ``messages`` as content deltas."""
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "stream": True,
+        }
+        async with self._semaphore(model):
+            try:
+                async with self._get_client().stream(
+                    "POST", OPENROUTER_URL, json=payload, headers={"X-Title": title}
+                ) as response:
+                    logger.debug(f"OpenRouter stream status: {response.status_code}")
+                    if response.is_error:
+                        body = (await response.aread()).decode(errors="replace")
+                        raise UpstreamError(
+                            f"Response status: {response.status_code}\nResponse body: {body}",
+                            status_code=response.status_code,
+                        )
+                    async for line in response.aiter_lines():
+                        # Skip blank lines and SSE comments such as ": OPENROUTER PROCESSING"
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            break
+                        chunk = json.loads(data)
+                        if "error" in chunk:
+                            error = chunk["error"]
+                            message = error.get("message", str(error)) if isinstance(error, dict) else str(error)
+                            raise UpstreamError(message)
+                        choices = chunk.get("choices") or []
+                        delta = choices[0].get("delta", {}).get("content") if choices else None
+                        if delta:
+                            yield delta
+            except httpx.HTTPError as e:
+                raise UpstreamError(str(e) or e.__class__.__name__) from e
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                raise UpstreamError(f"Malformed response from AI service: {e}") from e
+
+    async def aclose(self) -> None:
+        """Close the underlying connection pool."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
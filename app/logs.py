@@ -0,0 +1,155 @@
+"""Logging setup: records are sampled and queued on the request path, then formatted and written by a background thread."""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import re
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, Optional
+
+from app.settings import env_float, env_int
+
+REDACTED = "[redacted]"
+
+# Secrets that may end up in messages: OpenRouter keys, bearer tokens, JWTs
+# (Supabase keys) and ``api_key=...`` / ``"api_key": "..."`` pairs
+_SECRETS = re.compile(
+    r"sk-[A-Za-z0-9_-]{8,}"
+    r"|(?i:bearer)\s+[A-Za-z0-9._~+/=-]+"
+    r"|eyJ[A-Za-z0-9_-]+\.[A-Za-z0-9_-]+\.[A-Za-z0-9_-]*"
+    r"|(?<=api_key=)[^&\s,}]+"
+    r"|(?<=api_key': ')[^']+"
+    r"|(?<=api_key\": \")[^\"]+"
+)
+
+# Attributes every LogRecord has; anything else was passed with ``extra=``
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+
+
+def redact(text: str, max_length: int) -> str:
+    """Mask secrets in ``text`` and cut it to ``max_length`` characters."""
+    text = _SECRETS.sub(REDACTED, text)
+    if len(text) > max_length:
+        text = f"{text[:max_length]}... [{len(text) - max_length} more chars]"
+    return text
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of each level; warnings and errors are always kept."""
+
+    def __init__(self, rates: Dict[int, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with long or secret-bearing values truncated and redacted."""
+
+    def __init__(self, max_length: int):
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": redact(record.getMessage(), self.max_length),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = redact(value, self.max_length) if isinstance(value, str) else value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            # Tracebacks are kept whole apart from secrets
+            entry["exception"] = _SECRETS.sub(REDACTED, record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The plain ``time - logger - level - message`` format, redacted and truncated."""
+
+    def __init__(self, max_length: int):
+        super().__init__("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        self.max_length = max_length
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        record.message = redact(record.message, self.max_length)
+        return super().formatMessage(record)
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.exc_text:
+            record.exc_text = _SECRETS.sub(REDACTED, record.exc_text)
+        return super().format(record)
+
+
+class _OffThreadHandler(QueueHandler):
+    """Queues records for the listener thread without formatting them on the request path."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Resolve the message and traceback now, while their arguments are still
+        # valid; formatting, redaction and I/O happen on the listener thread
+        message = record.getMessage()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg, record.args, record.exc_info = message, None, None
+        return record
+
+
+def configure_logging() -> None:
+    """Route all logging through a queue to a background writer thread.
+
+    ``LOG_LEVEL`` sets the level (default INFO; httpx and httpcore stay at
+    WARNING unless ``LOG_HTTP_CLIENTS`` is set). ``LOG_FORMAT=text`` writes
+    plain lines instead of JSON. ``LOG_SAMPLE_DEBUG`` and ``LOG_SAMPLE_INFO``
+    keep that fraction of DEBUG/INFO records. Messages longer than
+    ``LOG_MAX_LENGTH`` characters are truncated and secrets are masked.
+    Calling it again replaces the previous setup.
+    """
+    global _listener
+    max_length = env_int("LOG_MAX_LENGTH", 1000)
+    formatter: logging.Formatter
+    if os.getenv("LOG_FORMAT", "json").strip().lower() == "text":
+        formatter = TextFormatter(max_length)
+    else:
+        formatter = JsonFormatter(max_length)
+    output = logging.StreamHandler()
+    output.setFormatter(formatter)
+
+    records: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    handler = _OffThreadHandler(records)
+    handler.addFilter(SamplingFilter({
+        logging.DEBUG: env_float("LOG_SAMPLE_DEBUG", 1.0),
+        logging.INFO: env_float("LOG_SAMPLE_INFO", 1.0),
+    }))
+
+    if _listener is not None:
+        _listener.stop()
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").strip().upper())
+    http_level = logging.NOTSET if os.getenv("LOG_HTTP_CLIENTS") else logging.WARNING
+    for name in ("httpx", "httpcore", "hpack"):
+        logging.getLogger(name).setLevel(http_level)
+
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def _stop_listener() -> None:
+    # Write out whatever is still queued
+    if _listener is not None:
+        _listener.stop()
@@ -1,27 +1,67 @@
-from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
-import requests
+from typing import List, Optional, Dict, Any, Tuple
 import os
-from supabase import create_client, Client
 from dotenv import load_dotenv
+from contextlib import asynccontextmanager
 import uuid
+import asyncio
+import math
+import time
 from datetime import datetime
 import logging
 
+from app import admin
+from app.batch import BatchChat, BatchItem
+from app.cache import ChatbotConfigCache, SessionCache
+from app.completions import ChatCompletions, Completion, ResponseCache
+from app.context import ContextBuilder, SummaryStore
+from app.history import HistoryCache
+from app.jobs import ChatJobQueue, WebhookRejected, job_store_from_env, public_job
+from app.llm_client import OpenRouterClient, UpstreamError
+from app.logs import configure_logging
+from app.metrics import Metrics, MetricsMiddleware, router as metrics_router
+from app.persistence import WriteBehindWriter, conversation_row
+from app.profiling import RequestProfiler
+from app.ratelimit import RateLimiter
+from app.routing import ModelRouter
+from app.scheduler import WIDGET
+from app.semantic_cache import SemanticCache
+from app.startup import Readiness, warm_chatbot_cache
+from app.storage import storage_from_env
+from app.streaming import receive_chat_messages, relay_chat_socket, sse_response, upstream_error_event
+from app.turns import ChatTurnPreparer
+
+# Load environment variables (before logging, which is configured from them)
+load_dotenv()
+
 # Configure logging
-logging.basicConfig(level=logging.INFO)
+configure_logging()
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await storage.connect()
+    await persistence.start()
+    await chat_jobs.start()
+    # Checked in the background: the server listens at once and /ready reports when it can take traffic
+    readiness.start(storage.ping, lambda: warm_chatbot_cache(storage, chatbot_cache))
+    try:
+        yield
+    finally:
+        await readiness.stop()
+        await chat_jobs.stop()
+        await persistence.stop()
+        await storage.close()
+        await llm_client.aclose()
 
 app = FastAPI(
     title="SaaS AI Chatbot API",
     description="API for the SaaS AI Chatbot service",
     version="1.0.0",
-    openapi_url="/openapi.json"
+    openapi_url="/openapi.json",
+    lifespan=lifespan
 )
 
 # Enable CORS for widget access
@@ -33,19 +73,40 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Supabase setup
+metrics = Metrics()
+app.state.metrics = metrics
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+app.include_router(metrics_router)
+
+profiler = RequestProfiler()
+
+# Storage setup: Supabase by default, or a direct Postgres pool (STORAGE_BACKEND=postgres)
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+storage = storage_from_env(SUPABASE_URL, SUPABASE_KEY)
+persistence = WriteBehindWriter(storage)
+app.state.persistence = persistence
+readiness = Readiness()
 
 # OpenRouter API key
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
+llm_client = OpenRouterClient(OPENROUTER_API_KEY)
+
+SESSION_BULK_MAX = int(os.getenv("SESSION_BULK_MAX", "1000"))
 
 # Schemas
 class CreateSessionRequest(BaseModel):
     api_key: str
     assistant_id: str
 
+class BulkCreateSessionRequest(BaseModel):
+    api_key: str
+    assistant_id: str
+    count: int = Field(..., ge=1, le=SESSION_BULK_MAX)
+
+class BulkCreateSessionResponse(BaseModel):
+    session_ids: List[str]
+
 class Message(BaseModel):
     role: str
     content: str
@@ -56,6 +117,7 @@ class ChatRequest(BaseModel):
     type: str
     assistant_id: str
     messages: List[Message]
+    stream: bool = False
 
 class CreateWidgetSessionRequest(BaseModel):
     chatbot_id: str
@@ -63,6 +125,7 @@ class CreateWidgetSessionRequest(BaseModel):
 class WidgetChatRequest(BaseModel):
     session_id: str
     message: str
+    stream: bool = False
 
 class ErrorResponse(BaseModel):
     detail: str
@@ -75,129 +138,360 @@ class ValidationError(BaseModel):
 class HTTPValidationError(BaseModel):
     detail: List[ValidationError]
 
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+
+class BatchChatResult(BaseModel):
+    session_id: str
+    status_code: int
+    reply: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
+
+class ChatJobRequest(ChatRequest):
+    webhook_url: Optional[str] = None
+
+class ChatJobResponse(BaseModel):
+    job_id: str
+    session_id: str
+    status: str
+    reply: Optional[str] = None
+    model: Optional[str] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: Optional[str] = None
+    completed_at: Optional[str] = None
+
+async def fetch_chatbot(chatbot_id: str) -> Optional[Dict[str, Any]]:
+    """Load a chatbot's configuration row"""
+    return await storage.get_chatbot(chatbot_id)
+
+chatbot_cache = ChatbotConfigCache(fetch_chatbot)
+session_cache = SessionCache()
+history_cache = HistoryCache()
+app.state.caches = {"chatbots": chatbot_cache, "sessions": session_cache, "history": history_cache}
+app.include_router(admin.router)
+
+async def get_session_chatbot_id(session_id: str) -> Optional[str]:
+    """Resolve a session's chatbot id, hitting the database only on a cache miss"""
+    chatbot_id = session_cache.get(session_id)
+    if chatbot_id is None:
+        chatbot_id = await storage.get_session_owner(session_id)
+        if chatbot_id is None:
+            return None
+        session_cache.put(session_id, chatbot_id)
+    return chatbot_id
+
+async def fetch_history(session_id: str) -> List[Dict[str, str]]:
+    """Load a session's conversation history, oldest first"""
+    return persistence.merge_pending(session_id, await storage.get_history(session_id))
+
+chat_turns = ChatTurnPreparer(storage, chatbot_cache, session_cache, history_cache, persistence.merge_pending)
+rate_limiter = RateLimiter()
+
+async def fetch_summary(session_id: str) -> Optional[Dict[str, Any]]:
+    """Load a session's rolling summary of older turns"""
+    return await storage.get_summary(session_id)
+
+async def save_summary(session_id: str, summary: str, summarized_messages: int) -> None:
+    """Store a session's rolling summary of older turns"""
+    await storage.save_summary({
+        "session_id": session_id,
+        "summary": summary,
+        "summarized_messages": summarized_messages,
+        "updated_at": datetime.utcnow().isoformat()
+    })
+
+async def fetch_opening_turns(chatbot_id: str, limit: int) -> List[Tuple[str, str]]:
+    """Load the first question and answer of a chatbot's most recent sessions"""
+    return await storage.opening_turns(chatbot_id, limit)
+
+completions = ChatCompletions(ModelRouter(llm_client), ResponseCache(), SemanticCache(fetch_opening_turns))
+app.state.caches["responses"] = completions.responses
+app.state.caches["semantic"] = completions.semantic
+app.state.upstream = {"routing": completions.router, "limits": completions.router.guard, "coalescing": completions.inflight, "scheduling": completions.scheduler}
+context_builder = ContextBuilder(completions, SummaryStore(fetch_summary, save_summary), history_loader=fetch_history)
+app.state.caches["summaries"] = context_builder
+
+async def save_conversation(session_id: str, user_messages: List[str], ai_response: str, model: Optional[str] = None) -> None:
+    """Queue the user messages and assistant reply of one chat turn for saving"""
+    rows = [conversation_row(session_id, "user", content) for content in user_messages]
+    rows.append(conversation_row(session_id, "assistant", ai_response, model))
+    persistence.enqueue(session_id, rows)
+    history_cache.append(session_id, rows)
+
+batch_chat = BatchChat(
+    storage, chatbot_cache, session_cache, history_cache, persistence.merge_pending, context_builder, completions, save_conversation, persistence.flush
+)
+
+async def run_chat_job(job: Dict[str, Any]) -> Completion:
+    """Answer a turn submitted to /api/chat/jobs"""
+    chatbot = await chatbot_cache.get(job["chatbot_id"])
+    if not chatbot:
+        raise HTTPException(status_code=404, detail="Chatbot not found")
+    prev_messages = await history_cache.get_or_load(job["session_id"], fetch_history)
+    messages = await context_builder.build(
+        job["session_id"], chatbot, prev_messages, [{"role": "user", "content": content} for content in job["user_messages"]]
+    )
+    completion = await completions.complete(chatbot, messages)
+    await save_conversation(job["session_id"], job["user_messages"], completion.reply, completion.model)
+    return completion
+
+chat_jobs = ChatJobQueue(job_store_from_env(storage), run_chat_job)
+app.state.upstream["jobs"] = chat_jobs
+
+def upstream_error(e: UpstreamError) -> HTTPException:
+    """503 with Retry-After when the upstream is shedding load, else 500"""
+    if e.retry_after is not None:
+        return HTTPException(status_code=503, detail=f"Error with AI: {e.detail}", headers={"Retry-After": str(math.ceil(e.retry_after))})
+    return HTTPException(status_code=500, detail=f"Error with AI: {e.detail}")
+
 # Health check
 @app.get("/health", response_model=str)
 async def health_check():
     return "OK"
 
+# Readiness probe: 503 until the database has answered and the caches are warm
+@app.get("/ready", response_model=str)
+async def readiness_check():
+    if not readiness.ready:
+        raise HTTPException(status_code=503, detail=readiness.detail)
+    return "READY"
+
 # Create a chat session (API)
 @app.post("/api/chat/session", response_model=str, status_code=201)
 async def create_session(request: CreateSessionRequest):
     """Create a new chat session"""
-    response = supabase.table("chatbots").select("id").eq("id", request.assistant_id).eq("api_key", request.api_key).execute()
-    if not response.data:
+    if not await chatbot_cache.verify_api_key(request.assistant_id, request.api_key):
         raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
     session_id = str(uuid.uuid4())
-    supabase.table("sessions").insert({
+    await storage.create_sessions([{
         "session_id": session_id,
         "chatbot_id": request.assistant_id,
         "created_at": datetime.utcnow().isoformat()
-    }).execute()
+    }])
+    session_cache.put(session_id, request.assistant_id)
     return session_id
 
+# Create many chat sessions (API) with one key check and one multi-row insert
+@app.post("/api/chat/session/bulk", response_model=BulkCreateSessionResponse, status_code=201)
+async def create_sessions_bulk(request: BulkCreateSessionRequest):
+    """Create up to SESSION_BULK_MAX chat sessions at once"""
+    if not await chatbot_cache.verify_api_key(request.assistant_id, request.api_key):
+        raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+    await rate_limiter.check(request.assistant_id, api_key=request.api_key, chatbot=chatbot_cache.peek(request.assistant_id))
+    now = datetime.utcnow().isoformat()
+    session_ids = [str(uuid.uuid4()) for _ in range(request.count)]
+    await storage.create_sessions([
+        {"session_id": session_id, "chatbot_id": request.assistant_id, "created_at": now} for session_id in session_ids
+    ])
+    for session_id in session_ids:
+        session_cache.put(session_id, request.assistant_id)
+    return {"session_ids": session_ids}
+
 # Send a message (API)
 @app.post("/api/chat", response_model=str)
-async def chat(request: ChatRequest):
+@profiler.wrap(lambda request: chatbot_cache.peek(request.assistant_id))
+async def chat(request: ChatRequest, x_profile_token: Optional[str] = Header(None, include_in_schema=False)):
     """Process a chat message"""
-    response = supabase.table("chatbots").select("model_name").eq("id", request.assistant_id).eq("api_key", request.api_key).execute()
-    if not response.data:
-        raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
-    model_name = response.data[0]["model_name"]
-    session_response = supabase.table("sessions").select("session_id").eq("session_id", request.session_id).eq("chatbot_id", request.assistant_id).execute()
-    if not session_response.data:
-        raise HTTPException(status_code=404, detail="Session not found or does not belong to the assistant")
-    prev_messages = supabase.table("conversations").select("role", "content").eq("session_id", request.session_id).order("timestamp").execute().data
-    messages = [{"role": msg["role"], "content": msg["content"]} for msg in prev_messages]
-    messages.extend([{"role": msg.role, "content": msg.content} for msg in request.messages if msg.role == "user"])
-    try:
-        openrouter_response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": "https://pros.tools",
-                "X-Title": "AI Chatbot SaaS"
-            },
-            json={
-                "model": model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
+    # The key and chatbot limits are only charged once the key is verified
+    await rate_limiter.peek_session(request.session_id, chatbot=chatbot_cache.peek(request.assistant_id))
+    with metrics.stage("chat", "prepare"):
+        chatbot, prev_messages = await chat_turns.prepare(request.api_key, request.assistant_id, request.session_id)
+    with metrics.stage("chat", "rate_limit"):
+        await rate_limiter.check(request.assistant_id, session_id=request.session_id, api_key=request.api_key, chatbot=chatbot)
+    model_name = chatbot["model_name"]
+    user_messages = [msg.content for msg in request.messages if msg.role == "user"]
+    with metrics.stage("chat", "context"):
+        messages = await context_builder.build(
+            request.session_id, chatbot, prev_messages, [{"role": "user", "content": content} for content in user_messages]
         )
-        openrouter_response.raise_for_status()
-        ai_response = openrouter_response.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error with AI: {str(e)}")
-    for msg in request.messages:
-        if msg.role == "user":
-            supabase.table("conversations").insert({
-                "session_id": request.session_id,
-                "role": "user",
-                "content": msg.content,
-                "timestamp": datetime.utcnow().isoformat()
-            }).execute()
-    supabase.table("conversations").insert({
-        "session_id": request.session_id,
-        "role": "assistant",
-        "content": ai_response,
-        "timestamp": datetime.utcnow().isoformat()
-    }).execute()
-    return ai_response
+    if request.stream:
+        try:
+            completions.check_available(chatbot)
+        except UpstreamError as e:
+            raise upstream_error(e)
+        stream = completions.stream(chatbot, messages)
+        started = time.perf_counter()
+
+        async def finish_stream(reply: str) -> None:
+            metrics.observe("chat", "upstream", time.perf_counter() - started, stream.model or "cache")
+            with metrics.stage("chat", "persistence"):
+                await save_conversation(request.session_id, user_messages, reply, stream.model)
+
+        return sse_response(stream, finish_stream)
+    try:
+        with metrics.stage("chat", "upstream", model_name) as stage:
+            completion = await completions.complete(chatbot, messages)
+            stage.model = completion.model or "cache"
+    except UpstreamError as e:
+        raise upstream_error(e)
+    with metrics.stage("chat", "persistence"):
+        await save_conversation(request.session_id, user_messages, completion.reply, completion.model)
+    return completion.reply
+
+# Send many messages (API), possibly across sessions and assistants
+@app.post("/api/chat/batch", response_model=BatchChatResponse)
+async def chat_batch(request: BatchChatRequest):
+    """Process a batch of chat messages; each item gets its own status_code and reply or error"""
+    if len(request.items) > batch_chat.max_items:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {batch_chat.max_items} items")
+    for assistant_id, api_key in sorted({(item.assistant_id, item.api_key) for item in request.items}):
+        # Items with a bad key get their 403 from batch_chat.run without charging the chatbot's limits
+        if await chatbot_cache.verify_api_key(assistant_id, api_key):
+            await rate_limiter.check(assistant_id, api_key=api_key, chatbot=chatbot_cache.peek(assistant_id))
+    results = await batch_chat.run([
+        BatchItem(item.api_key, item.assistant_id, item.session_id, [msg.content for msg in item.messages if msg.role == "user"])
+        for item in request.items
+    ])
+    return {"results": results}
+
+# Send a message (API) and collect the reply later, by polling or webhook
+@app.post("/api/chat/jobs", response_model=ChatJobResponse, status_code=202)
+async def submit_chat_job(request: ChatJobRequest):
+    """Queue a chat message; returns the job at once"""
+    if request.webhook_url:
+        try:
+            chat_jobs.check_webhook_url(request.webhook_url)
+        except WebhookRejected as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    await rate_limiter.peek_session(request.session_id, chatbot=chatbot_cache.peek(request.assistant_id))
+    chatbot, _ = await chat_turns.prepare(request.api_key, request.assistant_id, request.session_id)
+    await rate_limiter.check(request.assistant_id, session_id=request.session_id, api_key=request.api_key, chatbot=chatbot)
+    job = await chat_jobs.submit(
+        request.session_id, request.assistant_id, [msg.content for msg in request.messages if msg.role == "user"], request.webhook_url
+    )
+    return public_job(job)
+
+@app.get("/api/chat/jobs/{job_id}", response_model=ChatJobResponse)
+async def get_chat_job(job_id: str):
+    """Poll a chat job: queued, running, succeeded (with reply) or failed (with error and status_code)"""
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
+    job = await chat_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return public_job(job)
 
 # Create a session for widget
 @app.post("/api/chat/widget/session", response_model=str)
 async def create_widget_session(request: CreateWidgetSessionRequest):
     """Create a new session for the widget"""
-    response = supabase.table("chatbots").select("id").eq("id", request.chatbot_id).execute()
-    if not response.data:
+    if not await chatbot_cache.get(request.chatbot_id):
         raise HTTPException(status_code=404, detail="Chatbot not found")
     session_id = str(uuid.uuid4())
-    supabase.table("sessions").insert({
+    await storage.create_sessions([{
         "session_id": session_id,
         "chatbot_id": request.chatbot_id,
         "created_at": datetime.utcnow().isoformat()
-    }).execute()
+    }])
+    session_cache.put(session_id, request.chatbot_id)
     return session_id
 
 # Send a message for widget
 @app.post("/api/chat/widget", response_model=str)
-async def widget_chat(request: WidgetChatRequest):
+@profiler.wrap(lambda request: chatbot_cache.peek(session_cache.get(request.session_id) or ""))
+async def widget_chat(request: WidgetChatRequest, x_profile_token: Optional[str] = Header(None, include_in_schema=False)):
     """Process a widget chat message"""
-    session_response = supabase.table("sessions").select("chatbot_id").eq("session_id", request.session_id).execute()
-    if not session_response.data:
-        raise HTTPException(status_code=404, detail="Session not found")
-    chatbot_id = session_response.data[0]["chatbot_id"]
-    chatbot_response = supabase.table("chatbots").select("model_name").eq("id", chatbot_id).execute()
-    if not chatbot_response.data:
-        raise HTTPException(status_code=404, detail="Chatbot not found")
-    model_name = chatbot_response.data[0]["model_name"]
-    prev_messages = supabase.table("conversations").select("role", "content").eq("session_id", request.session_id).order("timestamp").execute().data
-    messages = [{"role": msg["role"], "content": msg["content"]} for msg in prev_messages]
-    messages.append({"role": "user", "content": request.message})
+    cached_chatbot_id = session_cache.get(request.session_id)
+    await rate_limiter.peek_session(request.session_id, chatbot=chatbot_cache.peek(cached_chatbot_id) if cached_chatbot_id else None)
+
+    async def load_history() -> List[Dict[str, str]]:
+        with metrics.stage("widget_chat", "history"):
+            return await history_cache.get_or_load(request.session_id, fetch_history)
+
+    history_task = asyncio.ensure_future(load_history())
     try:
-        openrouter_response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": "https://pros.tools",
-                "X-Title": "AI Chatbot SaaS"
-            },
-            json={
-                "model": model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
+        with metrics.stage("widget_chat", "session"):
+            chatbot_id = await get_session_chatbot_id(request.session_id)
+        if not chatbot_id:
+            raise HTTPException(status_code=404, detail="Session not found")
+        with metrics.stage("widget_chat", "model"):
+            chatbot = await chatbot_cache.get(chatbot_id)
+        if not chatbot:
+            raise HTTPException(status_code=404, detail="Chatbot not found")
+        # The chatbot's limit is only charged once the session is known to belong to it
+        with metrics.stage("widget_chat", "rate_limit"):
+            await rate_limiter.check(chatbot_id, session_id=request.session_id, chatbot=chatbot)
+    except BaseException:
+        history_task.cancel()
+        raise
+    model_name = chatbot["model_name"]
+    prev_messages = await history_task
+    with metrics.stage("widget_chat", "context"):
+        messages = await context_builder.build(
+            request.session_id, chatbot, prev_messages, [{"role": "user", "content": request.message}]
         )
-        openrouter_response.raise_for_status()
-        ai_response = openrouter_response.json()["choices"][0]["message"]["content"]
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error with AI: {str(e)}")
-    supabase.table("conversations").insert([
-        {"session_id": request.session_id, "role": "user", "content": request.message, "timestamp": datetime.utcnow().isoformat()},
-        {"session_id": request.session_id, "role": "assistant", "content": ai_response, "timestamp": datetime.utcnow().isoformat()}
-    ]).execute()
-    return ai_response
+    if request.stream:
+        try:
+            completions.check_available(chatbot, WIDGET)
+        except UpstreamError as e:
+            raise upstream_error(e)
+        stream = completions.stream(chatbot, messages, priority=WIDGET)
+        started = time.perf_counter()
+
+        async def finish_stream(reply: str) -> None:
+            metrics.observe("widget_chat", "upstream", time.perf_counter() - started, stream.model or "cache")
+            with metrics.stage("widget_chat", "persistence"):
+                await save_conversation(request.session_id, [request.message], reply, stream.model)
+
+        return sse_response(stream, finish_stream)
+    try:
+        with metrics.stage("widget_chat", "upstream", model_name) as stage:
+            completion = await completions.complete(chatbot, messages, priority=WIDGET)
+            stage.model = completion.model or "cache"
+    except UpstreamError as e:
+        raise upstream_error(e)
+    with metrics.stage("widget_chat", "persistence"):
+        await save_conversation(request.session_id, [request.message], completion.reply, completion.model)
+    return completion.reply
+
+# Widget chat over a WebSocket: the session, model and history are resolved once per connection
+@app.websocket("/api/chat/widget/ws")
+async def widget_chat_socket(websocket: WebSocket, session_id: Optional[str] = None, chatbot_id: Optional[str] = None):
+    """Stream widget replies over a WebSocket; see the README for the frame format"""
+    await websocket.accept()
+    try:
+        if session_id:
+            chatbot_id, history = await asyncio.gather(
+                get_session_chatbot_id(session_id), history_cache.get_or_load(session_id, fetch_history)
+            )
+            if not chatbot_id:
+                raise HTTPException(status_code=404, detail="Session not found")
+        elif chatbot_id:
+            session_id, history = await create_widget_session(CreateWidgetSessionRequest(chatbot_id=chatbot_id)), []
+        else:
+            raise HTTPException(status_code=400, detail="session_id or chatbot_id is required")
+        chatbot = await chatbot_cache.get(chatbot_id)
+        if not chatbot:
+            raise HTTPException(status_code=404, detail="Chatbot not found")
+    except HTTPException as he:
+        await websocket.close(code=4000 + he.status_code, reason=str(he.detail))
+        return
+    try:
+        await websocket.send_json({"type": "session", "session_id": session_id})
+        async for message in receive_chat_messages(websocket):
+            try:
+                await rate_limiter.check(chatbot_id, session_id=session_id, chatbot=chatbot)
+                completions.check_available(chatbot, WIDGET)
+            except HTTPException as he:
+                retry_after = (he.headers or {}).get("Retry-After")
+                await websocket.send_json({"type": "error", "detail": he.detail, **({"retry_after": int(retry_after)} if retry_after else {})})
+                continue
+            except UpstreamError as e:
+                await websocket.send_json({"type": "error", **upstream_error_event(e)})
+                continue
+            messages = await context_builder.build(session_id, chatbot, history, [{"role": "user", "content": message}])
+            stream = completions.stream(chatbot, messages, priority=WIDGET)
+            reply = await relay_chat_socket(websocket, stream, lambda reply: save_conversation(session_id, [message], reply, stream.model))
+            if reply is not None:
+                history = history + [{"role": "user", "content": message}, {"role": "assistant", "content": reply}]
+    except WebSocketDisconnect:
+        pass
 
 if __name__ == "__main__":
     import uvicorn
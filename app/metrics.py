@@ -0,0 +1,220 @@
+"""In-process request metrics in the Prometheus text exposition format.
+
+Apps set ``app.state.metrics`` to a ``Metrics`` instance, wrap themselves
+in ``MetricsMiddleware`` and include ``router`` for ``GET /metrics``.
+Request handlers time their stages with ``metrics.stage(...)``; cache,
+upstream and persistence counters are read from ``app.state.caches``,
+``app.state.upstream`` (see ``app.admin``) and ``app.state.persistence``
+when the endpoint is scraped, so they cost nothing per request.
+"""
+import hmac
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+
+
+class _Stage:
+    """Times a ``with`` block into a stage histogram; ``model`` may be updated inside the block."""
+
+    __slots__ = ("metrics", "endpoint", "name", "model", "started")
+
+    def __init__(self, metrics: "Metrics", endpoint: str, name: str, model: Optional[str]):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.name = name
+        self.model = model
+
+    def __enter__(self) -> "_Stage":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.metrics.observe(self.endpoint, self.name, time.perf_counter() - self.started, self.model)
+
+
+class Metrics:
+    """Latency histograms per chat stage and per route, and response status counters.
+
+    Recording is a dict lookup and a bisect on the event loop thread, with no
+    locks or I/O, so metrics stay on in production.
+    """
+
+    def __init__(self):
+        self._stages: Dict[Labels, _Histogram] = {}
+        self._requests: Dict[Labels, _Histogram] = {}
+        self._responses: Dict[Labels, int] = {}
+
+    def stage(self, endpoint: str, name: str, model: Optional[str] = None) -> _Stage:
+        """Context manager timing one stage (``"history"``, ``"upstream"``, ...) of an endpoint."""
+        return _Stage(self, endpoint, name, model)
+
+    def observe(self, endpoint: str, name: str, seconds: float, model: Optional[str] = None) -> None:
+        labels: Labels = (("endpoint", endpoint), ("stage", name))
+        if model is not None:
+            labels += (("model", model),)
+        histogram = self._stages.get(labels)
+        if histogram is None:
+            histogram = self._stages[labels] = _Histogram()
+        histogram.observe(seconds)
+
+    def observe_request(self, route: str, method: str, status: int, seconds: float) -> None:
+        labels: Labels = (("route", route), ("method", method))
+        histogram = self._requests.get(labels)
+        if histogram is None:
+            histogram = self._requests[labels] = _Histogram()
+        histogram.observe(seconds)
+        key = labels + (("status", str(status)),)
+        self._responses[key] = self._responses.get(key, 0) + 1
+
+    def render(self, caches: Dict[str, Any], upstream: Dict[str, Any], persistence: Any = None) -> str:
+        lines: List[str] = []
+        _histogram(lines, "chat_stage_duration_seconds", "Duration of each stage of a chat request.", self._stages)
+        _histogram(
+            lines, "http_request_duration_seconds", "Duration of HTTP requests, including streamed bodies.", self._requests
+        )
+        _counter(lines, "http_responses_total", "HTTP responses by route and status code.", self._responses)
+
+        hits: Dict[Labels, int] = {}
+        misses: Dict[Labels, int] = {}
+        for name, cache in caches.items():
+            for path, stats in _hit_stats(name, cache.stats()):
+                hits[(("cache", path),)] = stats["hits"]
+                misses[(("cache", path),)] = stats["misses"]
+        _counter(lines, "cache_hits_total", "Cache lookups answered from the cache.", hits)
+        _counter(lines, "cache_misses_total", "Cache lookups that went to the database.", misses)
+
+        routing = upstream.get("routing")
+        if routing is not None:
+            stats = routing.stats()
+            answered = {(("model", model),): count for model, count in stats["answered"].items()}
+            failures = {(("model", model),): count for model, count in stats["failures"].items()}
+            _counter(lines, "upstream_answered_total", "Upstream completions answered, by model.", answered)
+            _counter(lines, "upstream_errors_total", "Failed upstream calls, by model.", failures)
+        scheduling = upstream.get("scheduling")
+        if scheduling is not None:
+            shed = {(("priority", priority),): count for priority, count in scheduling.stats()["shed"].items()}
+            _counter(lines, "scheduler_shed_total", "Upstream calls shed by the fair scheduler.", shed)
+        if persistence is not None:
+            stats = persistence.stats()
+            lines.append("# HELP persistence_pending_turns Chat turns journaled but not written to the database yet.")
+            lines.append("# TYPE persistence_pending_turns gauge")
+            lines.append(f"persistence_pending_turns {stats['pending_turns'] + stats['in_flight_turns']}")
+            _counter(lines, "persistence_write_failures_total", "Failed writes of chat turns.", {(): stats["write_failures"]})
+            _counter(
+                lines,
+                "persistence_dead_lettered_turns_total",
+                "Chat turns given up on and moved to the dead-letter file.",
+                {(): stats["dead_lettered_turns"]},
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _hit_stats(path: str, stats: Dict[str, Any]) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """``(path, stats)`` for every dict with hit/miss counters in a cache's (possibly nested) stats."""
+    if "hits" in stats and "misses" in stats:
+        yield path, stats
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            yield from _hit_stats(f"{path}.{key}", value)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(labels: Labels) -> str:
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}" if labels else ""
+
+
+def _counter(lines: List[str], name: str, description: str, values: Dict[Labels, int]) -> None:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} counter")
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_format(labels)} {value}")
+
+
+def _histogram(lines: List[str], name: str, description: str, histograms: Dict[Labels, _Histogram]) -> None:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float("inf"),), histogram.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{name}_bucket{_format(labels + (('le', le),))} {cumulative}")
+        lines.append(f"{name}_sum{_format(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_format(labels)} {cumulative}")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the duration and status of every HTTP request.
+
+    Requests are labelled with the name of the endpoint function that handled
+    them (e.g. ``chat``), which keeps path parameters out of the labels.
+    """
+
+    def __init__(self, app: Any, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get("endpoint")
+            route = getattr(endpoint, "__name__", "unmatched")
+            self.metrics.observe_request(route, scope["method"], status, time.perf_counter() - started)
+
+
+def require_metrics_token(authorization: Optional[str] = Header(None)) -> None:
+    token = os.getenv("METRICS_TOKEN")
+    if not token:
+        return
+    if not authorization or not hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        raise HTTPException(status_code=403, detail="Invalid metrics token")
+
+
+router = APIRouter(tags=["metrics"], dependencies=[Depends(require_metrics_token)])
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """Prometheus scrape endpoint; requires ``Authorization: Bearer $METRICS_TOKEN`` when that is set."""
+    state = request.app.state
+    body = state.metrics.render(
+        getattr(state, "caches", {}), getattr(state, "upstream", {}), getattr(state, "persistence", None)
+    )
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,287 @@
+"""Write-behind persistence of chat turns backed by a local append-only journal."""
+import asyncio
+import glob
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from app.settings import env_bool, env_float, env_int
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _try_lock(handle: Any) -> bool:
+    """Take an exclusive, non-blocking lock on an open journal file."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def conversation_row(session_id: str, role: str, content: str, model: Optional[str] = None) -> Dict[str, Any]:
+    """Build a ``conversations`` row with a client-side id, so replays are idempotent.
+
+    ``model`` records which model produced an assistant reply.
+    """
+    return {
+        "id": str(uuid.uuid4()),
+        "session_id": session_id,
+        "role": role,
+        "content": content,
+        "model": model,
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+class WriteBehindWriter:
+    """Persists chat turns in the background instead of on the request path.
+
+    ``enqueue`` appends the turn to a journal file and returns immediately; a
+    background task then writes everything queued since the last flush with
+    one bulk ``conversations`` insert and a single ``sessions.last_activity``
+    update for all touched sessions. Each worker process owns its own journal
+    in ``journal_dir``; on startup, journals left behind by dead workers are
+    replayed. Rows carry client-side ids and are upserted with
+    ``ignore_duplicates``, so replaying an already-written turn is harmless.
+
+    If a bulk write fails with anything but a connection error, each
+    session's turns are written on their own, so one bad turn (its session
+    deleted meanwhile, a column missing) cannot hold up the others. A turn
+    that fails ``max_attempts`` (``PERSIST_MAX_ATTEMPTS``) times is appended
+    to ``dead-letter.jsonl`` in ``journal_dir`` and dropped.
+    """
+
+    def __init__(
+        self,
+        storage: Any,
+        journal_dir: Optional[str] = None,
+        flush_interval: Optional[float] = None,
+        max_batch: Optional[int] = None,
+        fsync: Optional[bool] = None,
+        max_attempts: Optional[int] = None,
+    ):
+        self.storage = storage
+        self.journal_dir = journal_dir or os.getenv("PERSIST_JOURNAL_DIR", "journal")
+        self.flush_interval = flush_interval or env_float("PERSIST_FLUSH_INTERVAL", 0.5)
+        self.max_batch = max_batch or env_int("PERSIST_MAX_BATCH", 500)
+        self.fsync = env_bool("PERSIST_JOURNAL_FSYNC") if fsync is None else fsync
+        self.max_attempts = max_attempts or env_int("PERSIST_MAX_ATTEMPTS", 5)
+        self.dead_letter_path = os.path.join(self.journal_dir, "dead-letter.jsonl")
+        # Errors meaning the database could not be reached, as opposed to a rejected write
+        self.transient_errors = getattr(storage, "transient_errors", (OSError,))
+        self.write_failures = 0
+        self.dead_lettered = 0
+        self.journal_path: Optional[str] = None
+        self._journal: Any = None
+        self._pending: List[Dict[str, Any]] = []
+        self._in_flight: List[Dict[str, Any]] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        """Open this worker's journal, adopt orphaned journals and start flushing."""
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self.journal_path = os.path.join(self.journal_dir, f"chat-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+        self._open_journal()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._adopt_orphaned_journals()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Flush whatever is queued and close the journal."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Final flush failed; {len(self._pending)} turns remain in {self.journal_path}: {str(e)}")
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+            if not self._pending:
+                os.remove(self.journal_path)
+
+    def enqueue(self, session_id: str, rows: List[Dict[str, Any]]) -> None:
+        """Journal a turn's ``conversations`` rows and queue them for the next flush."""
+        entry = {"session_id": session_id, "rows": rows, "last_activity": datetime.utcnow().isoformat()}
+        if self._journal is None:
+            raise RuntimeError("WriteBehindWriter.start() has not been called")
+        self._write_journal([entry])
+        self._pending.append(entry)
+        if sum(len(e["rows"]) for e in self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    def merge_pending(self, session_id: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Append the session's not-yet-flushed rows to ``rows`` read from the database."""
+        seen = {row.get("id") for row in rows}
+        unflushed = [
+            row
+            for entry in self._in_flight + self._pending
+            if entry["session_id"] == session_id
+            for row in entry["rows"]
+            if row["id"] not in seen
+        ]
+        return rows + unflushed
+
+    async def flush(self) -> None:
+        """Write every queued turn to the database."""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, []
+            self._in_flight = batch
+            try:
+                try:
+                    await self._write_batch(batch)
+                    failed: List[Dict[str, Any]] = []
+                except self.transient_errors:
+                    raise
+                except Exception as e:
+                    self.write_failures += 1
+                    logger.warning(f"Bulk write of {len(batch)} chat turns failed, writing per session: {str(e)}")
+                    failed = await self._write_per_session(batch)
+            except BaseException:
+                self._pending = batch + self._pending
+                raise
+            finally:
+                self._in_flight = []
+            self._pending = failed + self._pending
+            self._compact_journal()
+
+    async def _write_per_session(self, batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Write each session's turns separately; returns the turns to retry."""
+        sessions: Dict[str, List[Dict[str, Any]]] = {}
+        for entry in batch:
+            sessions.setdefault(entry["session_id"], []).append(entry)
+        failed: List[Dict[str, Any]] = []
+        remaining = list(sessions.items())
+        for i, (session_id, entries) in enumerate(remaining):
+            try:
+                await self._write_batch(entries)
+            except self.transient_errors as e:
+                # The database went away; retry everything not written yet
+                logger.error(f"Lost the database while writing chat turns: {str(e)}")
+                failed.extend(entry for _, rest in remaining[i:] for entry in rest)
+                break
+            except Exception as e:
+                self.write_failures += 1
+                logger.error(f"Error writing chat turns of session {session_id}: {str(e)}")
+                for entry in entries:
+                    entry["attempts"] = entry.get("attempts", 0) + 1
+                    if entry["attempts"] >= self.max_attempts:
+                        self._dead_letter(entry, str(e))
+                    else:
+                        failed.append(entry)
+        return failed
+
+    def _dead_letter(self, entry: Dict[str, Any], error: str) -> None:
+        """Set aside a turn that keeps failing, so it no longer blocks the queue."""
+        logger.error(
+            f"Giving up on a chat turn of session {entry['session_id']} after {entry['attempts']} attempts; "
+            f"saved to {self.dead_letter_path}"
+        )
+        with open(self.dead_letter_path, "a", encoding="utf-8") as dead_letter:
+            dead_letter.write(json.dumps({**entry, "error": error, "failed_at": datetime.utcnow().isoformat()}) + "\n")
+            dead_letter.flush()
+            if self.fsync:
+                os.fsync(dead_letter.fileno())
+        self.dead_lettered += 1
+
+    async def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        rows = [row for entry in batch for row in entry["rows"]]
+        for i in range(0, len(rows), self.max_batch):
+            await self.storage.save_conversations(rows[i:i + self.max_batch])
+        # One update for every session touched since the last flush
+        session_ids = sorted({entry["session_id"] for entry in batch})
+        await self.storage.touch_sessions(session_ids, max(entry["last_activity"] for entry in batch))
+        logger.debug(f"Flushed {len(rows)} conversation rows for {len(session_ids)} sessions")
+
+    async def _run(self) -> None:
+        delay = self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            failures = self.write_failures
+            try:
+                await self.flush()
+                # Back off while turns keep failing, as for a failed flush
+                delay = self.flush_interval if self.write_failures == failures else min(delay * 2, 30.0)
+            except Exception as e:
+                delay = min(delay * 2, 30.0)
+                logger.error(f"Error flushing chat turns, retrying in {delay:.1f}s: {str(e)}")
+
+    def _open_journal(self) -> None:
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        _try_lock(self._journal)
+
+    def _write_journal(self, entries: List[Dict[str, Any]]) -> None:
+        for entry in entries:
+            self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def _compact_journal(self) -> None:
+        """Replace the journal with only the turns still waiting to be flushed."""
+        tmp_path = f"{self.journal_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as tmp:
+            for entry in self._pending:
+                tmp.write(json.dumps(entry) + "\n")
+            tmp.flush()
+            if self.fsync:
+                os.fsync(tmp.fileno())
+        self._journal.close()
+        os.replace(tmp_path, self.journal_path)
+        self._open_journal()
+
+    def _adopt_orphaned_journals(self) -> None:
+        """Queue the turns from journals whose worker is gone."""
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, "chat-*.jsonl"))):
+            if path == self.journal_path:
+                continue
+            with open(path, "r+", encoding="utf-8") as orphan:
+                if not _try_lock(orphan):
+                    continue  # Owned by a live worker
+                entries = []
+                for line in orphan:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        logger.warning(f"Skipping corrupt line in journal {path}")
+                if entries:
+                    logger.info(f"Replaying {len(entries)} journaled chat turns from {path}")
+                    self._write_journal(entries)
+                    self._pending.extend(entries)
+            os.remove(path)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending_turns": len(self._pending),
+            "in_flight_turns": len(self._in_flight),
+            "write_failures": self.write_failures,
+            "dead_lettered_turns": self.dead_lettered,
+            "journal": self.journal_path,
+        }
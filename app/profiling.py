@@ -0,0 +1,110 @@
+"""Opt-in profiling of individual chat requests, for chasing one tenant's slow replies in production."""
+import asyncio
+import functools
+import hmac
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from app.settings import env_float, env_int
+
+try:
+    from pyinstrument import Profiler
+except ImportError:  # pragma: no cover - optional dependency
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+
+class RequestProfiler:
+    """Profiles the requests that ask for it and saves one report per request.
+
+    A request is profiled when it sends ``X-Profile-Token`` matching
+    ``PROFILE_TOKEN``, or when its chatbot has ``profile_requests`` enabled.
+    ``pyinstrument``'s sampling profiler (every ``PROFILE_INTERVAL`` seconds)
+    follows the request's task across awaits, so other requests on the event
+    loop are neither slowed nor included, and an HTML call tree is written to
+    ``PROFILE_DIR``, keeping the newest ``PROFILE_KEEP``. Without
+    ``pyinstrument`` nothing is profiled: a deterministic tracer would slow
+    down every tenant's requests, not just the profiled one.
+
+    One request is profiled at a time; others that ask while it runs are
+    served unprofiled. Streamed reply bodies are sent after the handler
+    returns and are not included.
+    """
+
+    def __init__(self, directory: Optional[str] = None, interval: Optional[float] = None, keep: Optional[int] = None):
+        self.directory = directory or os.getenv("PROFILE_DIR", "profiles")
+        self.interval = interval or env_float("PROFILE_INTERVAL", 0.001)
+        self.keep = keep or env_int("PROFILE_KEEP", 100)
+        self.token = os.getenv("PROFILE_TOKEN")
+        self.profiled = 0
+        self.refused = 0
+        self._active = False
+
+    def wanted(self, token: Optional[str], chatbot: Any) -> bool:
+        """Whether a request with this header and (cached) chatbot config should be profiled."""
+        if isinstance(chatbot, dict) and chatbot.get("profile_requests"):
+            wanted = True
+        else:
+            wanted = bool(self.token and token and hmac.compare_digest(token.encode(), self.token.encode()))
+        if wanted and Profiler is None:
+            if not self.refused:
+                logger.warning("Profiling was requested but pyinstrument is not installed; requests are served unprofiled")
+            self.refused += 1
+            return False
+        return wanted
+
+    @asynccontextmanager
+    async def profile(self, name: str) -> AsyncIterator[None]:
+        """Profile the body of the ``async with`` block and save the report as ``<time>-<name>``."""
+        if self._active:
+            yield
+            return
+        self._active = True
+        started = time.time()
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            self._active = False
+            self.profiled += 1
+            stem = f"{time.strftime('%Y%m%d-%H%M%S', time.gmtime(started))}.{int(started * 1000) % 1000:03d}-{name}"
+            try:
+                path = await asyncio.to_thread(self._save, profiler, stem)
+                logger.info(f"Saved profile of {name} ({time.time() - started:.3f}s) to {path}")
+            except Exception as e:
+                logger.error(f"Error saving profile of {name}: {str(e)}")
+
+    def _save(self, profiler: Any, stem: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{stem}.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(profiler.output_html())
+        reports = sorted(
+            (entry for entry in os.scandir(self.directory) if entry.is_file()), key=lambda entry: entry.name
+        )
+        for entry in reports[:-self.keep]:
+            os.remove(entry.path)
+        return path
+
+    def wrap(self, chatbot_for: Callable[[Any], Any]) -> Callable[[Callable[..., Awaitable[Any]]], Callable[..., Awaitable[Any]]]:
+        """Decorate an endpoint taking ``request`` and ``x_profile_token`` so it can be profiled.
+
+        ``chatbot_for(request)`` returns the request's cached chatbot config
+        (or ``None``) for the ``profile_requests`` flag; it must not query the
+        database.
+        """
+        def decorate(endpoint: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+            @functools.wraps(endpoint)
+            async def profiled_endpoint(*args: Any, **kwargs: Any) -> Any:
+                if not self.wanted(kwargs.get("x_profile_token"), chatbot_for(kwargs["request"])):
+                    return await endpoint(*args, **kwargs)
+                async with self.profile(endpoint.__name__):
+                    return await endpoint(*args, **kwargs)
+            return profiled_endpoint
+        return decorate
@@ -0,0 +1,196 @@
+"""Token-bucket rate limiting of chat requests per API key, chatbot and session."""
+import hashlib
+import logging
+import math
+import os
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+
+from app.cache import MISSING, TTLCache
+from app.settings import env_int
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # pragma: no cover - optional dependency
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Scopes a request is limited in, most specific first
+SCOPES = ("session", "api_key", "chatbot")
+
+
+class MemoryBackend:
+    """Token buckets in process memory; limits apply per worker."""
+
+    def __init__(self, max_keys: Optional[int] = None):
+        # A bucket left alone for a minute is full again, so it can be dropped
+        self._buckets = TTLCache(max_keys or env_int("RATE_LIMIT_MAX_KEYS", 100000), 60.0)
+
+    async def take(self, buckets: Sequence[Tuple[str, int]], consume: bool = True) -> Tuple[Optional[int], float]:
+        """Take a token from every ``(key, per_minute)`` bucket, or from none if one is empty.
+
+        Returns ``(None, 0)``, or the index of the first empty bucket and the
+        seconds until it has a token. With ``consume=False`` the buckets are
+        only checked.
+        """
+        now = time.monotonic()
+        levels: List[float] = []
+        for index, (key, per_minute) in enumerate(buckets):
+            rate = per_minute / 60.0
+            bucket = self._buckets.get(key)
+            tokens = per_minute if bucket is MISSING else min(per_minute, bucket[0] + (now - bucket[1]) * rate)
+            if tokens < 1:
+                return index, (1 - tokens) / rate
+            levels.append(tokens)
+        if not consume:
+            return None, 0.0
+        for (key, _), tokens in zip(buckets, levels):
+            self._buckets.set(key, (tokens - 1, now))
+        return None, 0.0
+
+
+# Same bucket arithmetic as MemoryBackend.take, atomic on the Redis server
+_TAKE_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local per_minute = tonumber(ARGV[i])
+    local rate = per_minute / 60
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local tokens = per_minute
+    if bucket[1] then
+        tokens = math.min(per_minute, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+    end
+    if tokens < 1 then
+        return {i - 1, tostring((1 - tokens) / rate)}
+    end
+    levels[i] = tokens
+end
+if ARGV[#KEYS + 1] ~= '1' then
+    return {-1, '0'}
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', tostring(levels[i] - 1), 'updated', tostring(now))
+    redis.call('EXPIRE', key, 60)
+end
+return {-1, '0'}
+"""
+
+
+class RedisBackend:
+    """Token buckets in Redis, shared by every worker; requires the ``redis`` package.
+
+    If Redis cannot be reached, requests are let through rather than failed.
+    """
+
+    def __init__(self, url: str):
+        self._client = redis.from_url(url)
+        self._take = self._client.register_script(_TAKE_SCRIPT)
+
+    async def take(self, buckets: Sequence[Tuple[str, int]], consume: bool = True) -> Tuple[Optional[int], float]:
+        try:
+            index, wait = await self._take(
+                keys=[f"ratelimit:{key}" for key, _ in buckets],
+                args=[per_minute for _, per_minute in buckets] + [1 if consume else 0],
+            )
+        except Exception as e:
+            logger.warning(f"Rate limit check skipped, Redis unavailable: {str(e)}")
+            return None, 0.0
+        return (None if index < 0 else index), float(wait)
+
+
+def backend_from_env() -> Any:
+    """``RedisBackend`` when ``RATE_LIMIT_REDIS_URL`` is set and redis is installed, else ``MemoryBackend``."""
+    url = os.getenv("RATE_LIMIT_REDIS_URL")
+    if url and redis is None:
+        logger.warning("RATE_LIMIT_REDIS_URL is set but redis is not installed; rate limits are per worker")
+    elif url:
+        return RedisBackend(url)
+    return MemoryBackend()
+
+
+class RateLimiter:
+    """Rejects chat requests beyond per-minute limits with 429 and Retry-After.
+
+    Each session, API key and chatbot has a token bucket holding up to its
+    per-minute limit and refilled continuously at that rate. Defaults come
+    from ``RATE_LIMIT_SESSION_PER_MINUTE``, ``RATE_LIMIT_API_KEY_PER_MINUTE``
+    and ``RATE_LIMIT_CHATBOT_PER_MINUTE``; a chatbot overrides them with its
+    ``rate_limits`` column, e.g. ``{"session": 10, "chatbot": 300}``. A limit
+    of 0 disables that scope.
+
+    Only charge the API key and chatbot scopes once the request's key has
+    been verified; otherwise anyone who knows a chatbot id could drain its
+    limits with bad keys. Before that, ``peek_session`` turns away sessions
+    that are already over their limit without taking a token.
+    """
+
+    def __init__(self, backend: Any = None, defaults: Optional[Dict[str, int]] = None):
+        self.backend = backend or backend_from_env()
+        self.defaults = defaults or {
+            "session": env_int("RATE_LIMIT_SESSION_PER_MINUTE", 20),
+            "api_key": env_int("RATE_LIMIT_API_KEY_PER_MINUTE", 120),
+            "chatbot": env_int("RATE_LIMIT_CHATBOT_PER_MINUTE", 600),
+        }
+        self.rejected: Dict[str, int] = {scope: 0 for scope in SCOPES}
+
+    def limits_for(self, chatbot: Any) -> Dict[str, int]:
+        """Per-minute limits for a chatbot config (or ``None``/``MISSING`` for the defaults)."""
+        limits = dict(self.defaults)
+        overrides = chatbot.get("rate_limits") if isinstance(chatbot, dict) else None
+        for scope, limit in (overrides or {}).items():
+            if scope in limits and limit is not None:
+                limits[scope] = int(limit)
+        return limits
+
+    async def check(
+        self,
+        chatbot_id: Optional[str],
+        session_id: Optional[str] = None,
+        api_key: Optional[str] = None,
+        chatbot: Any = None,
+    ) -> None:
+        """Take a token in every scope of the request; raises ``HTTPException`` 429 when one is empty.
+
+        Tokens are only taken when every scope has one, so a rejected request
+        does not use up the limits of its other scopes. ``chatbot`` is the
+        chatbot's config, if known, for its limit overrides. Scopes whose key
+        is unknown (None) are skipped.
+        """
+        await self._admit(
+            (
+                ("session", session_id),
+                # Keep raw API keys out of the rate limit store
+                ("api_key", hashlib.sha256(api_key.encode()).hexdigest() if api_key else None),
+                ("chatbot", chatbot_id),
+            ),
+            chatbot,
+        )
+
+    async def peek_session(self, session_id: Optional[str], chatbot: Any = None) -> None:
+        """Raise ``HTTPException`` 429 if the session is over its limit, without taking a token."""
+        await self._admit((("session", session_id),), chatbot, consume=False)
+
+    async def _admit(self, keys: Sequence[Tuple[str, Optional[str]]], chatbot: Any, consume: bool = True) -> None:
+        limits = self.limits_for(chatbot)
+        scopes = [(scope, value) for scope, value in keys if value is not None and limits[scope] > 0]
+        if not scopes:
+            return
+        empty, wait = await self.backend.take(
+            [(f"{scope}:{value}", limits[scope]) for scope, value in scopes], consume=consume
+        )
+        if empty is not None:
+            scope = scopes[empty][0]
+            self.rejected[scope] += 1
+            raise HTTPException(
+                status_code=429,
+                detail=f"Rate limit exceeded for this {scope.replace('_', ' ')}",
+                headers={"Retry-After": str(math.ceil(wait))},
+            )
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": type(self.backend).__name__, "limits": self.defaults, "rejected": dict(self.rejected)}
@@ -0,0 +1,230 @@
+"""Per-chatbot model routing with failover and hedged requests."""
+import asyncio
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.limiter import UpstreamGuard, UpstreamUnavailable
+from app.llm_client import OpenRouterClient, UpstreamError
+from app.settings import env_float, env_int
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """Recent upstream latencies per model, for percentile estimates."""
+
+    def __init__(self, window: Optional[int] = None, min_samples: Optional[int] = None):
+        self.window = window or env_int("LATENCY_WINDOW", 200)
+        self.min_samples = min_samples or env_int("HEDGE_MIN_SAMPLES", 20)
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, model: str, seconds: float) -> None:
+        self._samples[model].append(seconds)
+
+    def percentile(self, model: str, percentile: float) -> Optional[float]:
+        """The ``percentile`` (0-100) latency of ``model``, or None without enough samples."""
+        samples = self._samples.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            model: {
+                "samples": len(samples),
+                "p50": self.percentile(model, 50),
+                "p95": self.percentile(model, 95),
+            }
+            for model, samples in self._samples.items()
+        }
+
+
+class ModelRouter:
+    """Sends a chat turn to the chatbot's model, falling back and hedging as configured.
+
+    A chatbot's models are its ``model_name`` followed by its
+    ``fallback_models``. When a model fails, the next one is tried. When the
+    chatbot sets ``hedge_percentile``, a backup request to the next model
+    (or the same model, without fallbacks) is also started once the primary
+    has been outstanding for that percentile of its recent latency; the
+    first reply wins and the other request is cancelled. Until enough
+    latencies are observed, ``HEDGE_DEFAULT_DELAY`` is used.
+
+    Streams race on time to first token and only fail over before the first
+    delta. Every reply reports the model that produced it.
+
+    Each upstream call holds a slot of ``guard``, which adapts per-model
+    concurrency and skips models whose circuit is open.
+    """
+
+    def __init__(
+        self,
+        llm_client: OpenRouterClient,
+        guard: Optional[UpstreamGuard] = None,
+        default_delay: Optional[float] = None,
+        min_delay: Optional[float] = None,
+    ):
+        self.llm_client = llm_client
+        self.guard = guard or UpstreamGuard()
+        self.default_delay = default_delay or env_float("HEDGE_DEFAULT_DELAY", 3.0)
+        self.min_delay = min_delay or env_float("HEDGE_MIN_DELAY", 0.25)
+        self.latency = LatencyTracker()
+        self.first_token = LatencyTracker()
+        self.answered: Dict[str, int] = defaultdict(int)
+        self.failures: Dict[str, int] = defaultdict(int)
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def attempts_for(self, chatbot: Dict[str, Any]) -> List[str]:
+        """Models to try for ``chatbot``, in order."""
+        models = [chatbot["model_name"]]
+        for model in chatbot.get("fallback_models") or []:
+            if model not in models:
+                models.append(model)
+        if chatbot.get("hedge_percentile") and len(models) == 1:
+            models.append(models[0])
+        return models
+
+    def check_available(self, chatbot: Dict[str, Any]) -> None:
+        """Raise ``UpstreamUnavailable`` if none of the chatbot's models can take a call now."""
+        delays = [self.guard.retry_after(model) for model in self.attempts_for(chatbot)]
+        if all(delay is not None for delay in delays):
+            raise UpstreamUnavailable("The AI service is temporarily unavailable", min(delays))
+
+    def hedge_delay(self, tracker: LatencyTracker, model: str, percentile: float) -> float:
+        delay = tracker.percentile(model, percentile)
+        return max(self.min_delay, self.default_delay if delay is None else delay)
+
+    async def _race(
+        self,
+        chatbot: Dict[str, Any],
+        tracker: LatencyTracker,
+        attempt: Callable[[str], Awaitable[Any]],
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Tuple[Any, str]:
+        """Run ``attempt(model)`` over the chatbot's models with failover and hedging.
+
+        Returns the first successful result and the model that produced it;
+        ``discard`` releases results of attempts that finished too late.
+        """
+        models = self.attempts_for(chatbot)
+        percentile = chatbot.get("hedge_percentile")
+        pending: Dict[asyncio.Task, Tuple[str, bool]] = {}
+        launched = 0
+
+        def launch(hedge: bool) -> None:
+            nonlocal launched
+            model = models[launched]
+            launched += 1
+            pending[asyncio.create_task(attempt(model))] = (model, hedge)
+
+        launch(hedge=False)
+        last_error: Optional[UpstreamError] = None
+        try:
+            while pending:
+                timeout = None
+                if percentile and launched < len(models) and len(pending) == 1:
+                    timeout = self.hedge_delay(tracker, models[launched - 1], percentile)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self.hedges += 1
+                    launch(hedge=True)
+                    continue
+                for task in done:
+                    model, hedge = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except UpstreamError as e:
+                        self.failures[model] += 1
+                        logger.warning(f"Model {model} failed: {e.detail}")
+                        # Report a real upstream error over our own fail-fast rejections
+                        if last_error is None or isinstance(last_error, UpstreamUnavailable):
+                            last_error = e
+                        continue
+                    self.answered[model] += 1
+                    if hedge:
+                        self.hedge_wins += 1
+                    return result, model
+                if not pending and launched < len(models):
+                    self.failovers += 1
+                    launch(hedge=False)
+        finally:
+            for task in pending:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None and discard is not None:
+                    await discard(task.result())
+        raise last_error
+
+    async def complete(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        **kwargs: Any,
+    ) -> Tuple[str, str]:
+        """Return ``(reply, model)``; raises the last ``UpstreamError`` if every model fails."""
+
+        async def attempt(model: str) -> str:
+            async with self.guard.slot(model):
+                started = time.monotonic()
+                reply = await self.llm_client.chat_completion(model, messages, **kwargs)
+                self.latency.record(model, time.monotonic() - started)
+                return reply
+
+        return await self._race(chatbot, self.latency, attempt)
+
+    async def stream(
+        self,
+        chatbot: Dict[str, Any],
+        messages: List[Dict[str, str]],
+        **kwargs: Any,
+    ) -> AsyncIterator[Tuple[str, str]]:
+        """Yield ``(model, delta)`` pairs from the first model to produce a token."""
+
+        async def attempt(model: str) -> Tuple[AsyncIterator[str], Optional[str]]:
+            started = time.monotonic()
+            deltas = self._guarded_stream(model, messages, **kwargs)
+            try:
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await deltas.aclose()
+                raise
+            self.first_token.record(model, time.monotonic() - started)
+            return deltas, first
+
+        async def discard(result: Tuple[AsyncIterator[str], Optional[str]]) -> None:
+            await result[0].aclose()
+
+        (deltas, first), model = await self._race(chatbot, self.first_token, attempt, discard)
+        try:
+            if first is None:
+                return
+            yield model, first
+            async for delta in deltas:
+                yield model, delta
+        finally:
+            await deltas.aclose()
+
+    async def _guarded_stream(self, model: str, messages: List[Dict[str, str]], **kwargs: Any) -> AsyncIterator[str]:
+        # Streams hold their slot until the last delta; their duration depends
+        # on the reply length, so it is not used as a latency signal
+        async with self.guard.slot(model, measure_latency=False):
+            async for delta in self.llm_client.stream_chat_completion(model, messages, **kwargs):
+                yield delta
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "answered": dict(self.answered),
+            "failures": dict(self.failures),
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "latency": self.latency.stats(),
+            "first_token": self.first_token.stats(),
+        }
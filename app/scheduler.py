@@ -0,0 +1,198 @@
+"""Weighted fair scheduling of upstream dispatches across chatbots and traffic classes."""
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from app.limiter import UpstreamUnavailable
+from app.settings import env_float, env_int
+
+# Traffic classes: API-key requests, anonymous widget requests and background work
+API = "api"
+WIDGET = "widget"
+BACKGROUND = "background"
+
+# Classes whose queued calls may be shed to make room for a call of each class, lowest first
+SHEDDABLE = {API: (BACKGROUND, WIDGET), WIDGET: (BACKGROUND,)}
+
+
+class _Waiter:
+    __slots__ = ("future", "start", "finish")
+
+    def __init__(self, future: "asyncio.Future[None]", start: float, finish: float):
+        self.future = future
+        self.start = start
+        self.finish = finish
+
+
+class _Flow:
+    """Queued requests of one chatbot in one traffic class."""
+
+    __slots__ = ("waiters", "last_finish")
+
+    def __init__(self):
+        self.waiters: Deque[_Waiter] = deque()
+        self.last_finish = 0.0
+
+
+class FairScheduler:
+    """Admits upstream calls with weighted fair queuing per chatbot.
+
+    At most ``concurrency`` (``SCHEDULER_CONCURRENCY``) calls are dispatched
+    at once. Beyond that, calls queue in a flow per chatbot and traffic
+    class, and free slots go to the flow with the smallest virtual finish
+    time (start-time fair queuing). A flow's share of the slots is
+    proportional to its class weight, so API-key traffic
+    (``SCHEDULER_API_WEIGHT``) is favoured over widget traffic
+    (``SCHEDULER_WIDGET_WEIGHT``), both are favoured over background work
+    such as conversation summaries (``SCHEDULER_BACKGROUND_WEIGHT``), and a
+    busy chatbot cannot starve the others.
+
+    Queues are bounded. A call is shed with ``UpstreamUnavailable`` when its
+    flow already holds ``SCHEDULER_MAX_QUEUE_PER_CHATBOT`` calls, when it has
+    waited ``SCHEDULER_QUEUE_TIMEOUT`` seconds, or when ``SCHEDULER_MAX_QUEUE``
+    calls are queued overall. In the last case a call instead pushes out the
+    newest call of the longest queue of a lower class, if there is one:
+    background calls first, then (for API calls) widget calls.
+    """
+
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        max_flow_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        weights: Optional[Dict[str, float]] = None,
+    ):
+        self.concurrency = concurrency or env_int("SCHEDULER_CONCURRENCY", 64)
+        self.max_queue = env_int("SCHEDULER_MAX_QUEUE", 500) if max_queue is None else max_queue
+        self.max_flow_queue = (
+            env_int("SCHEDULER_MAX_QUEUE_PER_CHATBOT", 20) if max_flow_queue is None else max_flow_queue
+        )
+        self.queue_timeout = queue_timeout or env_float("SCHEDULER_QUEUE_TIMEOUT", 10.0)
+        self.weights = weights or {
+            API: env_float("SCHEDULER_API_WEIGHT", 4.0),
+            WIDGET: env_float("SCHEDULER_WIDGET_WEIGHT", 1.0),
+            BACKGROUND: env_float("SCHEDULER_BACKGROUND_WEIGHT", 0.5),
+        }
+        self.running = 0
+        self.queued = 0
+        self.dispatched: Dict[str, int] = {priority: 0 for priority in self.weights}
+        self.shed: Dict[str, int] = {priority: 0 for priority in self.weights}
+        self._vtime = 0.0
+        self._flows: Dict[Tuple[str, str], _Flow] = {}
+
+    def _victim(self, priority: str) -> Optional[Tuple[str, str]]:
+        """The longest flow of the lowest class below ``priority``, whose newest call is shed to make room."""
+        for victim_class in SHEDDABLE.get(priority, ()):
+            flows = [key for key, flow in self._flows.items() if key[1] == victim_class and flow.waiters]
+            if flows:
+                return max(flows, key=lambda key: len(self._flows[key].waiters))
+        return None
+
+    def retry_after(self, chatbot_id: str, priority: str = API) -> Optional[float]:
+        """Seconds to wait before retrying if a call would be shed right now, else None."""
+        if self.running < self.concurrency and not self.queued:
+            return None
+        flow = self._flows.get((chatbot_id, priority))
+        if flow is not None and len(flow.waiters) >= self.max_flow_queue:
+            return self.queue_timeout
+        if self.queued >= self.max_queue and self._victim(priority) is None:
+            return self.queue_timeout
+        return None
+
+    def _reject(self, priority: str, detail: str) -> UpstreamUnavailable:
+        self.shed[priority] = self.shed.get(priority, 0) + 1
+        return UpstreamUnavailable(detail, self.queue_timeout)
+
+    async def acquire(self, chatbot_id: str, priority: str = API) -> None:
+        """Wait for a dispatch slot; raises ``UpstreamUnavailable`` when the call is shed."""
+        if self.running < self.concurrency and not self.queued:
+            self.running += 1
+            self.dispatched[priority] = self.dispatched.get(priority, 0) + 1
+            return
+        key = (chatbot_id, priority)
+        flow = self._flows.get(key)
+        if flow is not None and len(flow.waiters) >= self.max_flow_queue:
+            raise self._reject(priority, "Too many requests queued for this chatbot")
+        if self.queued >= self.max_queue:
+            victim = self._victim(priority)
+            if victim is None:
+                raise self._reject(priority, "Too many requests queued for the AI service")
+            shed = self._flows[victim].waiters.pop()
+            self._forget(victim)
+            shed.future.set_exception(self._reject(victim[1], "Request shed to make room for higher-priority traffic"))
+
+        flow = self._flows.get(key)
+        if flow is None:
+            flow = self._flows[key] = _Flow()
+        start = max(self._vtime, flow.last_finish)
+        flow.last_finish = start + 1.0 / self.weights.get(priority, 1.0)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), start, flow.last_finish)
+        flow.waiters.append(waiter)
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                waiter.future.result()  # Granted (or shed) just as the wait timed out
+                return
+            waiter.future.cancel()
+            self._discard(key, waiter)
+            raise self._reject(priority, "Timed out waiting for the AI service")
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self.release()  # Granted just as we were cancelled
+            elif not waiter.future.done():
+                waiter.future.cancel()
+                self._discard(key, waiter)
+            raise
+
+    def _discard(self, key: Tuple[str, str], waiter: _Waiter) -> None:
+        flow = self._flows.get(key)
+        if flow is not None and waiter in flow.waiters:
+            flow.waiters.remove(waiter)
+            self._forget(key)
+
+    def _forget(self, key: Tuple[str, str]) -> None:
+        self.queued -= 1
+        if not self._flows[key].waiters:
+            del self._flows[key]
+
+    def release(self) -> None:
+        """Return a dispatch slot and hand it to the next flow in fair order."""
+        self.running -= 1
+        while self.running < self.concurrency and self.queued:
+            key = min(
+                (key for key, flow in self._flows.items() if flow.waiters),
+                key=lambda key: self._flows[key].waiters[0].finish,
+            )
+            waiter = self._flows[key].waiters.popleft()
+            self._forget(key)
+            self._vtime = waiter.start
+            waiter.future.set_result(None)
+            self.running += 1
+            self.dispatched[key[1]] = self.dispatched.get(key[1], 0) + 1
+
+    @asynccontextmanager
+    async def slot(self, chatbot_id: str, priority: str = API) -> AsyncIterator[None]:
+        """Hold a dispatch slot for the duration of an upstream call."""
+        await self.acquire(chatbot_id, priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        busiest = sorted(self._flows.items(), key=lambda item: len(item[1].waiters), reverse=True)[:10]
+        return {
+            "concurrency": self.concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "dispatched": dict(self.dispatched),
+            "shed": dict(self.shed),
+            "busiest_queues": [
+                {"chatbot_id": chatbot_id, "priority": priority, "queued": len(flow.waiters)}
+                for (chatbot_id, priority), flow in busiest
+            ],
+        }
@@ -0,0 +1,174 @@
+"""Semantic cache of answers to opening questions, searched by cosine similarity."""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from app.settings import env_float, env_int
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - optional dependency
+    np = None
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def embed(text: str, dim: int) -> "np.ndarray":
+    """Embed ``text`` as an L2-normalized vector of signed, hashed n-gram counts.
+
+    Features are words, word bigrams and character trigrams, so the vector
+    is cheap to compute locally and tolerant of small wording and spelling
+    differences.
+    """
+    text = " ".join(text.casefold().split())
+    words = _WORD_RE.findall(text)
+    padded = f" {text} "
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    features += [padded[i:i + 3] for i in range(len(padded) - 2)]
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+        vector[h % dim] += 1.0 if h >> 63 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class _Index:
+    """Question vectors of one chatbot in a matrix that grows up to ``capacity`` rows."""
+
+    def __init__(self, dim: int, capacity: int):
+        self.capacity = capacity
+        self.vectors = np.zeros((min(64, capacity), dim), dtype=np.float32)
+        self.replies: List[str] = []
+        self.last_used = np.zeros(len(self.vectors), dtype=np.float64)
+
+    def search(self, vector: "np.ndarray") -> Tuple[int, float]:
+        if not self.replies:
+            return -1, 0.0
+        scores = self.vectors[:len(self.replies)] @ vector
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def add(self, vector: "np.ndarray", reply: str) -> None:
+        if len(self.replies) < self.capacity:
+            row = len(self.replies)
+            if row == len(self.vectors):
+                rows = min(len(self.vectors) * 2, self.capacity)
+                self.vectors = np.resize(self.vectors, (rows, self.vectors.shape[1]))
+                self.last_used = np.resize(self.last_used, rows)
+            self.replies.append(reply)
+        else:
+            # Full: replace the least recently used answer
+            row = int(np.argmin(self.last_used))
+            self.replies[row] = reply
+        self.vectors[row] = vector
+        self.last_used[row] = time.monotonic()
+
+
+class SemanticCache:
+    """Per-chatbot cache that answers paraphrased opening questions.
+
+    Each chatbot gets its own matrix of question embeddings, and a lookup is
+    one matrix-vector product. A stored answer is reused when the cosine
+    similarity reaches ``threshold`` (``SEMANTIC_CACHE_THRESHOLD``). Each
+    chatbot keeps at most ``capacity`` answers and the least recently used
+    answer is replaced first; at most ``max_chatbots`` indexes are kept.
+
+    ``seed_loader(chatbot_id, limit)`` returns ``(question, answer)`` pairs
+    from past sessions. A chatbot's index is seeded from it in the
+    background the first time the chatbot is looked up.
+
+    Requires NumPy; without it every lookup is a miss.
+    """
+
+    def __init__(
+        self,
+        seed_loader: Optional[Callable[[str, int], Awaitable[List[Tuple[str, str]]]]] = None,
+        threshold: Optional[float] = None,
+        capacity: Optional[int] = None,
+        dim: Optional[int] = None,
+        max_chatbots: Optional[int] = None,
+        seed_limit: Optional[int] = None,
+    ):
+        self.seed_loader = seed_loader
+        self.threshold = threshold or env_float("SEMANTIC_CACHE_THRESHOLD", 0.85)
+        self.capacity = capacity or env_int("SEMANTIC_CACHE_CAPACITY", 1000)
+        self.dim = dim or env_int("SEMANTIC_CACHE_DIM", 512)
+        self.max_chatbots = max_chatbots or env_int("SEMANTIC_CACHE_MAX_CHATBOTS", 100)
+        self.seed_limit = env_int("SEMANTIC_CACHE_SEED_LIMIT", 500) if seed_limit is None else seed_limit
+        self.hits = 0
+        self.misses = 0
+        self._indexes: "OrderedDict[str, _Index]" = OrderedDict()
+        self._tasks: Set[asyncio.Task] = set()
+        if np is None:
+            logger.warning("NumPy is not installed; the semantic response cache is disabled")
+
+    def _index(self, chatbot_id: str) -> _Index:
+        index = self._indexes.get(chatbot_id)
+        if index is None:
+            index = self._indexes[chatbot_id] = _Index(self.dim, self.capacity)
+            while len(self._indexes) > self.max_chatbots:
+                self._indexes.popitem(last=False)
+            if self.seed_loader is not None and self.seed_limit > 0:
+                task = asyncio.create_task(self._seed(chatbot_id, index))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        self._indexes.move_to_end(chatbot_id)
+        return index
+
+    def get(self, chatbot_id: str, question: str) -> Optional[str]:
+        """Return the stored answer to the most similar question above the threshold."""
+        if np is None:
+            return None
+        index = self._index(chatbot_id)
+        row, score = index.search(embed(question, self.dim))
+        if row < 0 or score < self.threshold:
+            self.misses += 1
+            return None
+        index.last_used[row] = time.monotonic()
+        self.hits += 1
+        return index.replies[row]
+
+    def add(self, chatbot_id: str, question: str, reply: str) -> None:
+        if np is None or not question.strip() or not reply:
+            return
+        index = self._index(chatbot_id)
+        vector = embed(question, self.dim)
+        row, score = index.search(vector)
+        if row >= 0 and score >= self.threshold:
+            return  # Already answered by a near-identical question
+        index.add(vector, reply)
+
+    async def _seed(self, chatbot_id: str, index: _Index) -> None:
+        try:
+            pairs = await self.seed_loader(chatbot_id, self.seed_limit)
+        except Exception as e:
+            logger.error(f"Error seeding semantic cache for chatbot {chatbot_id}: {str(e)}")
+            return
+        if self._indexes.get(chatbot_id) is not index:
+            return  # Invalidated or evicted while loading
+        for question, reply in pairs:
+            self.add(chatbot_id, question, reply)
+        logger.info(f"Seeded semantic cache for chatbot {chatbot_id} with {len(index.replies)} answers")
+
+    def invalidate(self, chatbot_id: Optional[str] = None) -> None:
+        """Forget one chatbot's answers (or all of them when ``chatbot_id`` is None)."""
+        if chatbot_id is None:
+            self._indexes.clear()
+        else:
+            self._indexes.pop(chatbot_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "chatbots": len(self._indexes),
+            "answers": sum(len(index.replies) for index in self._indexes.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "enabled": np is not None,
+        }
@@ -0,0 +1,33 @@
+"""Helpers for reading optional tuning knobs from the environment."""
+import os
+from typing import Dict, Optional
+
+
+def env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def env_bool(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def parse_mapping(value: Optional[str]) -> Dict[str, str]:
+    """Parse ``key=value,key=value`` into a dict."""
+    mapping: Dict[str, str] = {}
+    if not value:
+        return mapping
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        key, item_value = item.rsplit("=", 1)
+        mapping[key.strip()] = item_value.strip()
+    return mapping
@@ -0,0 +1,79 @@
+"""Readiness tracking and cache warm-up for new instances."""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Optional
+
+from app.cache import ChatbotConfigCache
+from app.settings import env_int
+
+logger = logging.getLogger(__name__)
+
+# Recent sessions scanned per chatbot to warm up
+SESSIONS_PER_CHATBOT = 20
+
+
+async def warm_chatbot_cache(storage: Any, chatbots: ChatbotConfigCache, count: Optional[int] = None) -> int:
+    """Load the configs of the ``count`` (``WARMUP_CHATBOTS``) chatbots with the most recently active sessions.
+
+    Returns the number of chatbots loaded.
+    """
+    count = env_int("WARMUP_CHATBOTS", 0) if count is None else count
+    if count <= 0:
+        return 0
+    chatbot_ids = (await storage.recent_chatbot_ids(count * SESSIONS_PER_CHATBOT))[:count]
+    if not chatbot_ids:
+        return 0
+    rows = await storage.get_chatbots(chatbot_ids)
+    for row in rows:
+        chatbots.put(row["id"], row)
+    return len(rows)
+
+
+class Readiness:
+    """Whether this instance should take traffic, for the ``/ready`` probe.
+
+    ``start`` runs the startup checks in the background so the server begins
+    listening (and answering ``/health``) at once: ``check`` is retried with
+    backoff until it succeeds, then ``warm_up`` runs once (its failure is
+    logged, not fatal) and the instance reports ready. ``stop`` reports not
+    ready again so load balancers drain the instance during shutdown.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.detail = "Starting"
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self, check: Callable[[], Awaitable[None]], warm_up: Optional[Callable[[], Awaitable[int]]] = None) -> None:
+        self._task = asyncio.create_task(self._run(check, warm_up))
+
+    async def _run(self, check: Callable[[], Awaitable[None]], warm_up: Optional[Callable[[], Awaitable[int]]]) -> None:
+        delay = 0.5
+        while True:
+            try:
+                await check()
+                break
+            except Exception as e:
+                self.detail = "Waiting for the database"
+                logger.warning(f"Readiness check failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30.0)
+        if warm_up is not None:
+            self.detail = "Warming caches"
+            try:
+                warmed = await warm_up()
+                if warmed:
+                    logger.info(f"Warmed up {warmed} chatbot configs")
+            except Exception as e:
+                logger.error(f"Cache warm-up failed: {str(e)}")
+        self.ready = True
+        self.detail = "Ready"
+        logger.info("Ready to take traffic")
+
+    async def stop(self) -> None:
+        self.ready = False
+        self.detail = "Shutting down"
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
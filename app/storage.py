@@ -0,0 +1,478 @@
+"""Storage backends for chatbots, sessions, conversations, summaries and chat jobs.
+
+Both backends have the same async methods and return plain dicts shaped like
+PostgREST rows (ids and timestamps as strings), so callers never see which
+one is in use:
+
+- ``SupabaseStorage`` queries PostgREST over HTTP with supabase-py, on the
+  ``AsyncDB`` thread pool.
+- ``PostgresStorage`` talks to Postgres directly through an ``asyncpg``
+  connection pool, using the schema and functions in ``init_db.sql``.
+
+``storage_from_env`` picks one with ``STORAGE_BACKEND``.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from supabase import create_client
+
+from app.db import AsyncDB
+from app.settings import env_float, env_int
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover - optional dependency
+    asyncpg = None
+
+logger = logging.getLogger(__name__)
+
+# Session ids per ``in`` filter, keeping PostgREST request URLs short
+LOOKUP_CHUNK = 100
+# Rows per page; PostgREST caps a single response (1000 rows on Supabase by default)
+PAGE_SIZE = 1000
+
+
+class SupabaseStorage:
+    """Storage over PostgREST, through the synchronous supabase-py client."""
+
+    # Raised when PostgREST cannot be reached; its answers raise APIError
+    transient_errors: Tuple[type, ...] = (httpx.TransportError, OSError)
+
+    def __init__(self, db: AsyncDB):
+        self.db = db
+
+    async def connect(self) -> None:
+        await self.db.connect()
+
+    async def close(self) -> None:
+        self.db.shutdown()
+
+    async def ping(self) -> None:
+        await self.db.ping()
+
+    def _table(self, name: str) -> Any:
+        return self.db.client.table(name)
+
+    async def _select_in(self, table: str, columns: Tuple[str, ...], session_ids: List[str]) -> List[Dict[str, Any]]:
+        """All rows of ``table`` for ``session_ids``, ordered by session and time, across pages."""
+        rows: List[Dict[str, Any]] = []
+        for i in range(0, len(session_ids), LOOKUP_CHUNK):
+            chunk = session_ids[i:i + LOOKUP_CHUNK]
+            offset = 0
+            while True:
+                query = self._table(table).select(*columns).in_("session_id", chunk)
+                if table == "conversations":
+                    query = query.order("session_id").order("timestamp")
+                page = (await self.db.execute(query.range(offset, offset + PAGE_SIZE - 1))).data
+                rows.extend(page)
+                offset += len(page)
+                if len(page) < PAGE_SIZE:
+                    break
+        return rows
+
+    # Chatbots
+
+    async def get_chatbot(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
+        response = await self.db.execute(self._table("chatbots").select("*").eq("id", chatbot_id))
+        return response.data[0] if response.data else None
+
+    async def get_chatbots(self, chatbot_ids: List[str]) -> List[Dict[str, Any]]:
+        response = await self.db.execute(self._table("chatbots").select("*").in_("id", chatbot_ids))
+        return response.data
+
+    # Sessions
+
+    async def get_session_owner(self, session_id: str) -> Optional[str]:
+        response = await self.db.execute(
+            self._table("sessions").select("chatbot_id").eq("session_id", session_id)
+        )
+        return response.data[0]["chatbot_id"] if response.data else None
+
+    async def get_session_owners(self, session_ids: List[str]) -> Dict[str, str]:
+        rows = await self._select_in("sessions", ("session_id", "chatbot_id"), session_ids)
+        return {row["session_id"]: row["chatbot_id"] for row in rows}
+
+    async def create_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """Insert ``sessions`` rows with one request; returns how many were created."""
+        response = await self.db.execute(self._table("sessions").insert(sessions))
+        return len(response.data)
+
+    async def touch_sessions(self, session_ids: List[str], last_activity: str) -> None:
+        await self.db.execute(
+            self._table("sessions").update({"last_activity": last_activity}).in_("session_id", session_ids)
+        )
+
+    async def recent_chatbot_ids(self, sessions: int) -> List[str]:
+        """Distinct chatbots of the ``sessions`` most recently active sessions, most recent first."""
+        response = await self.db.execute(
+            self._table("sessions").select("chatbot_id").order("last_activity", desc=True).limit(sessions)
+        )
+        return list(dict.fromkeys(row["chatbot_id"] for row in response.data))
+
+    # Conversations
+
+    async def get_history(self, session_id: str) -> List[Dict[str, Any]]:
+        """A session's ``id``, ``role`` and ``content`` rows, oldest first."""
+        response = await self.db.execute(
+            self._table("conversations").select("id", "role", "content").eq("session_id", session_id).order("timestamp")
+        )
+        return response.data
+
+    async def get_histories(self, session_ids: List[str]) -> List[Dict[str, Any]]:
+        """History rows (with ``session_id``) of many sessions, ordered by session and time."""
+        return await self._select_in("conversations", ("id", "session_id", "role", "content"), session_ids)
+
+    async def save_conversations(self, rows: List[Dict[str, Any]]) -> None:
+        """Insert ``conversations`` rows, skipping ids that already exist."""
+        await self.db.execute(self._table("conversations").upsert(rows, ignore_duplicates=True))
+
+    async def opening_turns(self, chatbot_id: str, limit: int) -> List[Tuple[str, str]]:
+        response = await self.db.execute(
+            self.db.client.rpc("opening_turns", {"p_chatbot_id": chatbot_id, "p_limit": limit})
+        )
+        return [(row["question"], row["answer"]) for row in response.data]
+
+    async def prepare_chat_turn(
+        self, api_key: str, assistant_id: str, session_id: str, include_history: bool
+    ) -> Dict[str, Any]:
+        response = await self.db.execute(self.db.client.rpc("prepare_chat_turn", {
+            "p_api_key": api_key,
+            "p_assistant_id": assistant_id,
+            "p_session_id": session_id,
+            "p_include_history": include_history,
+        }))
+        return response.data
+
+    # Summaries
+
+    async def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        response = await self.db.execute(
+            self._table("conversation_summaries").select("summary", "summarized_messages").eq("session_id", session_id)
+        )
+        return response.data[0] if response.data else None
+
+    async def save_summary(self, row: Dict[str, Any]) -> None:
+        await self.db.execute(self._table("conversation_summaries").upsert(row))
+
+    # Chat jobs
+
+    async def create_job(self, job: Dict[str, Any]) -> None:
+        await self.db.execute(self._table("chat_jobs").insert(job))
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        response = await self.db.execute(self._table("chat_jobs").select("*").eq("id", job_id))
+        return response.data[0] if response.data else None
+
+    async def claim_job(self, job_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply ``fields`` if the job is still queued; returns the job, or ``None`` if it was not."""
+        response = await self.db.execute(
+            self._table("chat_jobs").update(fields).eq("id", job_id).eq("status", "queued")
+        )
+        return response.data[0] if response.data else None
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        await self.db.execute(self._table("chat_jobs").update(fields).eq("id", job_id))
+
+    async def requeue_stale_jobs(self, before: str, fields: Dict[str, Any]) -> int:
+        """Apply ``fields`` to jobs ``running`` since before ``before``; returns how many there were."""
+        response = await self.db.execute(
+            self._table("chat_jobs").update(fields).eq("status", "running").lt("updated_at", before)
+        )
+        return len(response.data)
+
+    async def queued_job_ids(self, limit: int) -> List[str]:
+        response = await self.db.execute(
+            self._table("chat_jobs").select("id").eq("status", "queued").order("created_at").limit(limit)
+        )
+        return [row["id"] for row in response.data]
+
+
+def _columns(row: Dict[str, Any]) -> str:
+    # Column names come from our own row dicts, never from requests
+    return ", ".join(f'"{name}"' for name in row)
+
+
+def _excluded(row: Dict[str, Any]) -> str:
+    return ", ".join(f'EXCLUDED."{name}"' for name in row)
+
+
+async def _init_connection(connection: Any) -> None:
+    # JSON in and out as Python objects; rows are read as jsonb so ids and
+    # timestamps come back as strings, as they do from PostgREST
+    for name in ("json", "jsonb"):
+        await connection.set_type_codec(name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+class PostgresStorage:
+    """Storage over a direct ``asyncpg`` connection pool, skipping PostgREST and its HTTP hop.
+
+    ``POSTGRES_POOL_MIN`` / ``POSTGRES_POOL_MAX`` size the pool and
+    ``POSTGRES_COMMAND_TIMEOUT`` bounds each statement. Behind a
+    transaction-mode pooler (PgBouncer, Supabase's port 6543) set
+    ``POSTGRES_STATEMENT_CACHE_SIZE=0``, as prepared statements cannot be
+    reused there. Rows are written from dicts with
+    ``jsonb_populate_recordset``, so many rows take one statement.
+    """
+
+    # Raised when the database cannot be reached, as opposed to a rejected statement
+    transient_errors: Tuple[type, ...] = (OSError, asyncio.TimeoutError) + (
+        (
+            asyncpg.InterfaceError,
+            asyncpg.PostgresConnectionError,
+            asyncpg.CannotConnectNowError,
+            asyncpg.TooManyConnectionsError,
+        )
+        if asyncpg is not None
+        else ()
+    )
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        command_timeout: Optional[float] = None,
+        statement_cache_size: Optional[int] = None,
+    ):
+        if asyncpg is None:
+            raise RuntimeError("STORAGE_BACKEND=postgres requires the asyncpg package")
+        self.dsn = dsn
+        self.min_size = min_size or env_int("POSTGRES_POOL_MIN", 2)
+        self.max_size = max_size or env_int("POSTGRES_POOL_MAX", 20)
+        self.command_timeout = command_timeout or env_float("POSTGRES_COMMAND_TIMEOUT", 30.0)
+        self.statement_cache_size = (
+            env_int("POSTGRES_STATEMENT_CACHE_SIZE", 100) if statement_cache_size is None else statement_cache_size
+        )
+        self._pool: Any = None
+        self._opening: Optional[asyncio.Lock] = None
+
+    async def connect(self) -> None:
+        """Open the pool. If the database is down it is opened on first use instead
+        (``ping``, which the readiness check retries), so startup does not fail."""
+        try:
+            await self._pool_ready()
+        except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+            logger.warning(f"Could not connect to Postgres yet: {str(e)}")
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def ping(self) -> None:
+        await self._fetchval("SELECT 1")
+
+    async def _pool_ready(self) -> Any:
+        if self._pool is None:
+            if self._opening is None:
+                self._opening = asyncio.Lock()
+            async with self._opening:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        command_timeout=self.command_timeout,
+                        statement_cache_size=self.statement_cache_size,
+                        init=_init_connection,
+                    )
+        return self._pool
+
+    async def _fetchval(self, query: str, *args: Any) -> Any:
+        return await (await self._pool_ready()).fetchval(query, *args)
+
+    async def _fetch(self, query: str, *args: Any) -> List[Any]:
+        return await (await self._pool_ready()).fetch(query, *args)
+
+    async def _execute(self, query: str, *args: Any) -> str:
+        return await (await self._pool_ready()).execute(query, *args)
+
+    # Chatbots
+
+    async def get_chatbot(self, chatbot_id: str) -> Optional[Dict[str, Any]]:
+        return await self._fetchval("SELECT to_jsonb(c) FROM public.chatbots c WHERE id = $1::uuid", chatbot_id)
+
+    async def get_chatbots(self, chatbot_ids: List[str]) -> List[Dict[str, Any]]:
+        records = await self._fetch(
+            "SELECT to_jsonb(c) FROM public.chatbots c WHERE id = ANY($1::uuid[])", chatbot_ids
+        )
+        return [record[0] for record in records]
+
+    # Sessions
+
+    async def get_session_owner(self, session_id: str) -> Optional[str]:
+        return await self._fetchval(
+            "SELECT chatbot_id::text FROM public.sessions WHERE session_id = $1::uuid", session_id
+        )
+
+    async def get_session_owners(self, session_ids: List[str]) -> Dict[str, str]:
+        records = await self._fetch(
+            "SELECT session_id::text, chatbot_id::text FROM public.sessions WHERE session_id = ANY($1::uuid[])",
+            session_ids,
+        )
+        return {record[0]: record[1] for record in records}
+
+    async def create_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """Insert ``sessions`` rows with one statement; returns how many were created."""
+        columns = _columns(sessions[0])
+        status = await self._execute(
+            f"INSERT INTO public.sessions ({columns}) "
+            f"SELECT {columns} FROM jsonb_populate_recordset(NULL::public.sessions, $1::jsonb)",
+            sessions,
+        )
+        return int(status.rsplit(" ", 1)[-1])
+
+    async def touch_sessions(self, session_ids: List[str], last_activity: str) -> None:
+        await self._execute(
+            "UPDATE public.sessions SET last_activity = $2::text::timestamptz WHERE session_id = ANY($1::uuid[])",
+            session_ids,
+            last_activity,
+        )
+
+    async def recent_chatbot_ids(self, sessions: int) -> List[str]:
+        """Distinct chatbots of the ``sessions`` most recently active sessions, most recent first."""
+        records = await self._fetch(
+            "SELECT chatbot_id::text FROM ("
+            "  SELECT chatbot_id, max(last_activity) AS last_activity FROM ("
+            "    SELECT chatbot_id, last_activity FROM public.sessions"
+            "    ORDER BY last_activity DESC NULLS LAST LIMIT $1"
+            "  ) recent GROUP BY chatbot_id"
+            ") chatbots ORDER BY last_activity DESC NULLS LAST",
+            sessions,
+        )
+        return [record[0] for record in records]
+
+    # Conversations
+
+    async def get_history(self, session_id: str) -> List[Dict[str, Any]]:
+        """A session's ``id``, ``role`` and ``content`` rows, oldest first."""
+        records = await self._fetch(
+            "SELECT id::text, role, content FROM public.conversations WHERE session_id = $1::uuid ORDER BY timestamp",
+            session_id,
+        )
+        return [dict(record) for record in records]
+
+    async def get_histories(self, session_ids: List[str]) -> List[Dict[str, Any]]:
+        """History rows (with ``session_id``) of many sessions, ordered by session and time."""
+        records = await self._fetch(
+            "SELECT id::text, session_id::text, role, content FROM public.conversations "
+            "WHERE session_id = ANY($1::uuid[]) ORDER BY session_id, timestamp",
+            session_ids,
+        )
+        return [dict(record) for record in records]
+
+    async def save_conversations(self, rows: List[Dict[str, Any]]) -> None:
+        """Insert ``conversations`` rows, skipping ids that already exist."""
+        columns = _columns(rows[0])
+        await self._execute(
+            f"INSERT INTO public.conversations ({columns}) "
+            f"SELECT {columns} FROM jsonb_populate_recordset(NULL::public.conversations, $1::jsonb) "
+            "ON CONFLICT (id) DO NOTHING",
+            rows,
+        )
+
+    async def opening_turns(self, chatbot_id: str, limit: int) -> List[Tuple[str, str]]:
+        records = await self._fetch("SELECT question, answer FROM public.opening_turns($1::uuid, $2)", chatbot_id, limit)
+        return [(record[0], record[1]) for record in records]
+
+    async def prepare_chat_turn(
+        self, api_key: str, assistant_id: str, session_id: str, include_history: bool
+    ) -> Dict[str, Any]:
+        return await self._fetchval(
+            "SELECT public.prepare_chat_turn($1, $2::uuid, $3::uuid, $4)",
+            api_key,
+            assistant_id,
+            session_id,
+            include_history,
+        )
+
+    # Summaries
+
+    async def get_summary(self, session_id: str) -> Optional[Dict[str, Any]]:
+        record = await (await self._pool_ready()).fetchrow(
+            "SELECT summary, summarized_messages FROM public.conversation_summaries WHERE session_id = $1::uuid",
+            session_id,
+        )
+        return dict(record) if record is not None else None
+
+    async def save_summary(self, row: Dict[str, Any]) -> None:
+        columns = _columns(row)
+        await self._execute(
+            f"INSERT INTO public.conversation_summaries ({columns}) "
+            f"SELECT {columns} FROM jsonb_populate_record(NULL::public.conversation_summaries, $1::jsonb) "
+            f"ON CONFLICT (session_id) DO UPDATE SET ({columns}) = ROW({_excluded(row)})",
+            row,
+        )
+
+    # Chat jobs
+
+    async def create_job(self, job: Dict[str, Any]) -> None:
+        columns = _columns(job)
+        await self._execute(
+            f"INSERT INTO public.chat_jobs ({columns}) "
+            f"SELECT {columns} FROM jsonb_populate_record(NULL::public.chat_jobs, $1::jsonb)",
+            job,
+        )
+
+    async def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self._fetchval("SELECT to_jsonb(j) FROM public.chat_jobs j WHERE id = $1::uuid", job_id)
+
+    async def _update_job(self, job_id: str, fields: Dict[str, Any], condition: str = "") -> Optional[Dict[str, Any]]:
+        columns = _columns(fields)
+        return await self._fetchval(
+            f"UPDATE public.chat_jobs j SET ({columns}) = "
+            f"(SELECT {columns} FROM jsonb_populate_record(NULL::public.chat_jobs, $2::jsonb)) "
+            f"WHERE id = $1::uuid {condition} RETURNING to_jsonb(j)",
+            job_id,
+            fields,
+        )
+
+    async def claim_job(self, job_id: str, fields: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Apply ``fields`` if the job is still queued; returns the job, or ``None`` if it was not."""
+        return await self._update_job(job_id, fields, "AND status = 'queued'")
+
+    async def update_job(self, job_id: str, fields: Dict[str, Any]) -> None:
+        await self._update_job(job_id, fields)
+
+    async def requeue_stale_jobs(self, before: str, fields: Dict[str, Any]) -> int:
+        """Apply ``fields`` to jobs ``running`` since before ``before``; returns how many there were."""
+        columns = _columns(fields)
+        records = await self._fetch(
+            f"UPDATE public.chat_jobs SET ({columns}) = "
+            f"(SELECT {columns} FROM jsonb_populate_record(NULL::public.chat_jobs, $2::jsonb)) "
+            "WHERE status = 'running' AND updated_at < $1::text::timestamptz RETURNING id",
+            before,
+            fields,
+        )
+        return len(records)
+
+    async def queued_job_ids(self, limit: int) -> List[str]:
+        records = await self._fetch(
+            "SELECT id::text FROM public.chat_jobs WHERE status = 'queued' ORDER BY created_at LIMIT $1", limit
+        )
+        return [record[0] for record in records]
+
+
+def storage_from_env(supabase_url: Optional[str], supabase_key: Optional[str]) -> Any:
+    """The storage backend chosen by ``STORAGE_BACKEND``.
+
+    ``supabase`` (the default) needs ``SUPABASE_URL`` and ``SUPABASE_KEY``;
+    ``postgres`` needs ``DATABASE_URL`` and the ``asyncpg`` package. Nothing
+    connects until ``connect`` is awaited.
+    """
+    backend = os.getenv("STORAGE_BACKEND", "supabase").strip().lower()
+    if backend == "postgres":
+        dsn = os.getenv("DATABASE_URL")
+        if not dsn:
+            raise ValueError("Missing DATABASE_URL in environment variables")
+        logger.info("Using direct Postgres storage")
+        return PostgresStorage(dsn)
+    if backend != "supabase":
+        raise ValueError(f"Unknown STORAGE_BACKEND: {backend}")
+    if not supabase_url or not supabase_key:
+        raise ValueError("Missing Supabase URL or key in environment variables")
+    return SupabaseStorage(AsyncDB(lambda: create_client(supabase_url, supabase_key)))
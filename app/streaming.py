@@ -0,0 +1,126 @@
+"""Server-Sent Events and WebSocket helpers for streaming chat replies."""
+import json
+import math
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from app.llm_client import UpstreamError
+
+logger = logging.getLogger(__name__)
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    # Stop nginx-style proxies (e.g. Render's) from buffering the stream
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format ``data`` as a single SSE event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def upstream_error_event(e: UpstreamError) -> Dict[str, Any]:
+    """The error payload sent to clients when the upstream fails mid-reply."""
+    error: Dict[str, Any] = {"detail": f"Error communicating with AI service: {e.detail}"}
+    if e.retry_after is not None:
+        error["retry_after"] = math.ceil(e.retry_after)
+    return error
+
+
+async def relay_chat_stream(
+    deltas: AsyncIterator[str],
+    on_complete: Callable[[str], Awaitable[None]],
+) -> AsyncIterator[str]:
+    """Relay upstream deltas as SSE, then hand the full reply to ``on_complete``.
+
+    Emits one ``{"delta": ...}`` event per upstream chunk, an ``error`` event
+    if the upstream fails, and ``data: [DONE]`` once the reply is persisted.
+    """
+    parts = []
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            yield sse_event({"delta": delta})
+    except UpstreamError as e:
+        logger.error(f"OpenRouter stream error: {e.detail}")
+        yield sse_event(upstream_error_event(e), event="error")
+        return
+
+    try:
+        await on_complete("".join(parts))
+    except Exception as e:
+        logger.error(f"Error saving streamed reply: {str(e)}", exc_info=True)
+        yield sse_event({"detail": "Error saving conversation"}, event="error")
+        return
+    yield "data: [DONE]\n\n"
+
+
+def sse_response(
+    deltas: AsyncIterator[str],
+    on_complete: Callable[[str], Awaitable[None]],
+) -> StreamingResponse:
+    """Wrap an upstream delta stream in a ``text/event-stream`` response."""
+    return StreamingResponse(
+        relay_chat_stream(deltas, on_complete),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS,
+    )
+
+
+async def receive_chat_messages(websocket: WebSocket) -> AsyncIterator[str]:
+    """Yield the user messages sent over a chat WebSocket until the client disconnects.
+
+    Each frame is a JSON object with a non-empty ``message`` string; other
+    frames are answered with an ``error`` frame and skipped.
+    """
+    while True:
+        try:
+            frame = await websocket.receive_text()
+        except WebSocketDisconnect:
+            return
+        try:
+            message = json.loads(frame).get("message")
+        except (ValueError, AttributeError):
+            message = None
+        if not isinstance(message, str) or not message.strip():
+            await websocket.send_json({"type": "error", "detail": 'Expected a JSON object with a "message" string'})
+            continue
+        yield message
+
+
+async def relay_chat_socket(
+    websocket: WebSocket,
+    deltas: AsyncIterator[str],
+    on_complete: Callable[[str], Awaitable[None]],
+) -> Optional[str]:
+    """Relay upstream deltas as WebSocket frames, then hand the full reply to ``on_complete``.
+
+    Sends one ``{"type": "delta", ...}`` frame per upstream chunk and a
+    ``{"type": "done"}`` frame once the reply is persisted, or an ``error``
+    frame instead. Returns the reply, or None if it failed.
+    """
+    parts = []
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            await websocket.send_json({"type": "delta", "delta": delta})
+    except UpstreamError as e:
+        logger.error(f"OpenRouter stream error: {e.detail}")
+        await websocket.send_json({"type": "error", **upstream_error_event(e)})
+        return None
+
+    reply = "".join(parts)
+    try:
+        await on_complete(reply)
+    except Exception as e:
+        logger.error(f"Error saving streamed reply: {str(e)}", exc_info=True)
+        await websocket.send_json({"type": "error", "detail": "Error saving conversation"})
+        return None
+    await websocket.send_json({"type": "done"})
+    return reply
@@ -0,0 +1,91 @@
+"""Validation and loading of everything a chat turn needs before the LLM call."""
+import uuid
+from typing import Any, Callable, Dict, List, Tuple
+
+from fastapi import HTTPException
+
+from app.cache import MISSING, ChatbotConfigCache, SessionCache
+from app.history import HistoryCache
+
+
+class ChatTurnPreparer:
+    """Checks the API key and session ownership and returns the chatbot and history.
+
+    When the chatbot, the session's owner and the history are all cached, no
+    query is made. Otherwise a single ``prepare_chat_turn`` RPC (see
+    ``init_db.sql``) validates the key, confirms the session belongs to the
+    assistant and returns the chatbot row and the ordered history, and the
+    caches are filled from its result. History is only requested when it is
+    not cached already.
+
+    ``merge_pending`` adds turns that are queued for writing but not yet in
+    the database to the loaded history. Ids that are not UUIDs are rejected
+    up front (403 for the assistant, 404 for the session), since the
+    database would fail on them.
+    """
+
+    def __init__(
+        self,
+        storage: Any,
+        chatbots: ChatbotConfigCache,
+        sessions: SessionCache,
+        history: HistoryCache,
+        merge_pending: Callable[[str, List[Dict[str, Any]]], List[Dict[str, Any]]],
+    ):
+        self.storage = storage
+        self.chatbots = chatbots
+        self.sessions = sessions
+        self.history = history
+        self.merge_pending = merge_pending
+
+    async def prepare(
+        self, api_key: str, assistant_id: str, session_id: str
+    ) -> Tuple[Dict[str, Any], List[Dict[str, str]]]:
+        """Return ``(chatbot, history)`` or raise 403/404 ``HTTPException``."""
+        if not _is_uuid(assistant_id) or self.chatbots.is_rejected(assistant_id, api_key):
+            raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+        if not _is_uuid(session_id):
+            if not await self.chatbots.verify_api_key(assistant_id, api_key):
+                raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+            raise HTTPException(status_code=404, detail="Session not found or does not belong to the assistant")
+
+        config = self.chatbots.peek(assistant_id)
+        owner = self.sessions.get(session_id)
+        history = self.history.get(session_id)
+        if config is not MISSING and owner is not None and history is not None:
+            if not await self.chatbots.verify_api_key(assistant_id, api_key):
+                raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+            if owner != assistant_id:
+                raise HTTPException(status_code=404, detail="Session not found or does not belong to the assistant")
+            return config, history
+
+        turn: Dict[str, Any] = {}
+
+        async def load(session_id: str) -> List[Dict[str, Any]]:
+            turn.update(await self._call(api_key, assistant_id, session_id, include_history=history is None))
+            return self.merge_pending(session_id, turn["history"])
+
+        if history is None:
+            history = await self.history.load(session_id, load)
+        else:
+            await load(session_id)
+        return turn["chatbot"], history
+
+    async def _call(self, api_key: str, assistant_id: str, session_id: str, include_history: bool) -> Dict[str, Any]:
+        turn = await self.storage.prepare_chat_turn(api_key, assistant_id, session_id, include_history)
+        if turn["status"] == "invalid_key":
+            self.chatbots.reject(assistant_id, api_key)
+            raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+        if turn["status"] == "session_not_found":
+            raise HTTPException(status_code=404, detail="Session not found or does not belong to the assistant")
+        self.chatbots.put(assistant_id, turn["chatbot"])
+        self.sessions.put(session_id, assistant_id)
+        return turn
+
+
+def _is_uuid(value: str) -> bool:
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
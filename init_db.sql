@@ -5,10 +5,24 @@ CREATE TABLE IF NOT EXISTS public.chatbots (
     description TEXT,
     model_name TEXT NOT NULL,
     api_key TEXT NOT NULL,
+    cache_responses BOOLEAN NOT NULL DEFAULT FALSE,
+    semantic_cache BOOLEAN NOT NULL DEFAULT FALSE,
+    fallback_models TEXT[] NOT NULL DEFAULT '{}',
+    hedge_percentile REAL,
+    rate_limits JSONB,
+    profile_requests BOOLEAN NOT NULL DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
+-- Columns added after the initial release
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS cache_responses BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS semantic_cache BOOLEAN NOT NULL DEFAULT FALSE;
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS fallback_models TEXT[] NOT NULL DEFAULT '{}';
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS hedge_percentile REAL;
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS rate_limits JSONB;
+ALTER TABLE public.chatbots ADD COLUMN IF NOT EXISTS profile_requests BOOLEAN NOT NULL DEFAULT FALSE;
+
 -- Create the sessions table
 CREATE TABLE IF NOT EXISTS public.sessions (
     session_id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -24,34 +38,171 @@ CREATE TABLE IF NOT EXISTS public.conversations (
     session_id UUID NOT NULL REFERENCES public.sessions(session_id) ON DELETE CASCADE,
     role TEXT NOT NULL,
     content TEXT NOT NULL,
+    model TEXT,
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
 -- Create an index on session_id for faster lookups
 CREATE INDEX IF NOT EXISTS idx_conversations_session_id ON public.conversations(session_id);
+ALTER TABLE public.conversations ADD COLUMN IF NOT EXISTS model TEXT;
+
+-- Create the conversation summaries table (rolling summary of turns outside the context window)
+CREATE TABLE IF NOT EXISTS public.conversation_summaries (
+    session_id UUID PRIMARY KEY REFERENCES public.sessions(session_id) ON DELETE CASCADE,
+    summary TEXT NOT NULL,
+    summarized_messages INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Create the chat jobs table (asynchronous chat turns submitted to /api/chat/jobs)
+CREATE TABLE IF NOT EXISTS public.chat_jobs (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    session_id UUID NOT NULL REFERENCES public.sessions(session_id) ON DELETE CASCADE,
+    chatbot_id UUID NOT NULL REFERENCES public.chatbots(id) ON DELETE CASCADE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    user_messages JSONB NOT NULL,
+    webhook_url TEXT,
+    reply TEXT,
+    model TEXT,
+    error TEXT,
+    status_code INTEGER,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    completed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Queued jobs are picked up again after a restart
+CREATE INDEX IF NOT EXISTS idx_chat_jobs_status ON public.chat_jobs(status, created_at);
 
 -- Enable Row Level Security
 ALTER TABLE public.chatbots ENABLE ROW LEVEL SECURITY;
 ALTER TABLE public.sessions ENABLE ROW LEVEL SECURITY;
 ALTER TABLE public.conversations ENABLE ROW LEVEL SECURITY;
+ALTER TABLE public.conversation_summaries ENABLE ROW LEVEL SECURITY;
+-- Chat jobs hold replies; only the backend (service key) may access them
+ALTER TABLE public.chat_jobs ENABLE ROW LEVEL SECURITY;
 
--- Create policies for chatbots table
+-- Create policies for chatbots table (dropped first so the script can be re-run)
+DROP POLICY IF EXISTS "Enable read access for all users" ON public.chatbots;
 CREATE POLICY "Enable read access for all users" ON public.chatbots
     FOR SELECT USING (true);
 
+DROP POLICY IF EXISTS "Enable insert for authenticated users only" ON public.chatbots;
 CREATE POLICY "Enable insert for authenticated users only" ON public.chatbots
     FOR INSERT WITH CHECK (auth.role() = 'authenticated');
 
 -- Create policies for sessions table
+DROP POLICY IF EXISTS "Enable read access for all users" ON public.sessions;
 CREATE POLICY "Enable read access for all users" ON public.sessions
     FOR SELECT USING (true);
 
+DROP POLICY IF EXISTS "Enable insert for authenticated users only" ON public.sessions;
 CREATE POLICY "Enable insert for authenticated users only" ON public.sessions
     FOR INSERT WITH CHECK (auth.role() = 'authenticated');
 
 -- Create policies for conversations table
+DROP POLICY IF EXISTS "Enable read access for all users" ON public.conversations;
 CREATE POLICY "Enable read access for all users" ON public.conversations
     FOR SELECT USING (true);
 
+DROP POLICY IF EXISTS "Enable insert for authenticated users only" ON public.conversations;
 CREATE POLICY "Enable insert for authenticated users only" ON public.conversations
     FOR INSERT WITH CHECK (auth.role() = 'authenticated');
+
+-- Create policies for conversation summaries table
+DROP POLICY IF EXISTS "Enable read access for all users" ON public.conversation_summaries;
+CREATE POLICY "Enable read access for all users" ON public.conversation_summaries
+    FOR SELECT USING (true);
+
+DROP POLICY IF EXISTS "Enable insert for authenticated users only" ON public.conversation_summaries;
+CREATE POLICY "Enable insert for authenticated users only" ON public.conversation_summaries
+    FOR INSERT WITH CHECK (auth.role() = 'authenticated');
+
+DROP POLICY IF EXISTS "Enable update for authenticated users only" ON public.conversation_summaries;
+CREATE POLICY "Enable update for authenticated users only" ON public.conversation_summaries
+    FOR UPDATE USING (auth.role() = 'authenticated');
+
+
+-- Validate a chat request and load what the LLM call needs in one round trip.
+-- Returns {"status": "ok", "chatbot": {...}, "model_name": ..., "history": [...]},
+-- or {"status": "invalid_key"} / {"status": "session_not_found"}.
+CREATE OR REPLACE FUNCTION public.prepare_chat_turn(
+    p_api_key TEXT,
+    p_assistant_id UUID,
+    p_session_id UUID,
+    p_include_history BOOLEAN DEFAULT TRUE
+) RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    v_chatbot public.chatbots;
+    v_history JSONB := '[]'::JSONB;
+BEGIN
+    SELECT * INTO v_chatbot
+    FROM public.chatbots
+    WHERE id = p_assistant_id AND api_key = p_api_key;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'invalid_key');
+    END IF;
+
+    PERFORM 1
+    FROM public.sessions
+    WHERE session_id = p_session_id AND chatbot_id = p_assistant_id;
+    IF NOT FOUND THEN
+        RETURN jsonb_build_object('status', 'session_not_found');
+    END IF;
+
+    IF p_include_history THEN
+        SELECT COALESCE(
+            jsonb_agg(
+                jsonb_build_object('id', id, 'role', role, 'content', content)
+                ORDER BY timestamp
+            ),
+            '[]'::JSONB
+        )
+        INTO v_history
+        FROM public.conversations
+        WHERE session_id = p_session_id;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'status', 'ok',
+        'chatbot', to_jsonb(v_chatbot),
+        'model_name', v_chatbot.model_name,
+        'history', v_history
+    );
+END;
+$$;
+
+
+-- First question and answer of a chatbot's most recent sessions, used to seed the semantic cache
+CREATE OR REPLACE FUNCTION public.opening_turns(
+    p_chatbot_id UUID,
+    p_limit INTEGER DEFAULT 500
+) RETURNS TABLE (question TEXT, answer TEXT)
+LANGUAGE sql
+STABLE
+AS $$
+    SELECT t.contents[1], t.contents[2]
+    FROM (
+        SELECT session_id
+        FROM public.sessions
+        WHERE chatbot_id = p_chatbot_id
+        ORDER BY created_at DESC
+        LIMIT p_limit
+    ) s
+    CROSS JOIN LATERAL (
+        SELECT
+            array_agg(first_two.role ORDER BY first_two.timestamp) AS roles,
+            array_agg(first_two.content ORDER BY first_two.timestamp) AS contents
+        FROM (
+            SELECT role, content, timestamp
+            FROM public.conversations c
+            WHERE c.session_id = s.session_id
+            ORDER BY timestamp
+            LIMIT 2
+        ) first_two
+    ) t
+    WHERE t.roles = ARRAY['user', 'assistant'];
+$$;
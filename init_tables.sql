@@ -1,4 +1,6 @@
 -- Drop tables if they exist
+DROP TABLE IF EXISTS public.chat_jobs;
+DROP TABLE IF EXISTS public.conversation_summaries;
 DROP TABLE IF EXISTS public.conversations;
 DROP TABLE IF EXISTS public.sessions;
 DROP TABLE IF EXISTS public.chatbots;
@@ -10,6 +12,12 @@ CREATE TABLE public.chatbots (
     description TEXT,
     model_name TEXT NOT NULL,
     api_key TEXT NOT NULL,
+    cache_responses BOOLEAN NOT NULL DEFAULT FALSE,
+    semantic_cache BOOLEAN NOT NULL DEFAULT FALSE,
+    fallback_models TEXT[] NOT NULL DEFAULT '{}',
+    hedge_percentile REAL,
+    rate_limits JSONB,
+    profile_requests BOOLEAN NOT NULL DEFAULT FALSE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
@@ -29,12 +37,41 @@ CREATE TABLE public.conversations (
     session_id UUID NOT NULL REFERENCES public.sessions(session_id) ON DELETE CASCADE,
     role TEXT NOT NULL,
     content TEXT NOT NULL,
+    model TEXT,
     timestamp TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
 -- Create an index on session_id for faster lookups
 CREATE INDEX idx_conversations_session_id ON public.conversations(session_id);
 
+-- Create the conversation summaries table (rolling summary of turns outside the context window)
+CREATE TABLE public.conversation_summaries (
+    session_id UUID PRIMARY KEY REFERENCES public.sessions(session_id) ON DELETE CASCADE,
+    summary TEXT NOT NULL,
+    summarized_messages INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Create the chat jobs table (asynchronous chat turns submitted to /api/chat/jobs)
+CREATE TABLE public.chat_jobs (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    session_id UUID NOT NULL REFERENCES public.sessions(session_id) ON DELETE CASCADE,
+    chatbot_id UUID NOT NULL REFERENCES public.chatbots(id) ON DELETE CASCADE,
+    status TEXT NOT NULL DEFAULT 'queued',
+    user_messages JSONB NOT NULL,
+    webhook_url TEXT,
+    reply TEXT,
+    model TEXT,
+    error TEXT,
+    status_code INTEGER,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    completed_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Queued jobs are picked up again after a restart
+CREATE INDEX idx_chat_jobs_status ON public.chat_jobs(status, created_at);
+
 -- Insert a test chatbot
 INSERT INTO public.chatbots (id, name, description, model_name, api_key)
 VALUES (
@@ -5,110 +5,151 @@ from dotenv import load_dotenv
 env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
 load_dotenv(env_path)
 
-from fastapi import FastAPI, HTTPException, Depends, Request, Header
+from fastapi import FastAPI, HTTPException, Depends, Request, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List
-import requests
-from supabase import create_client, Client
+from pydantic import BaseModel, Field
+from typing import List, Optional, Tuple
+from contextlib import asynccontextmanager
+import asyncio
+import math
+import time
 import uuid
 from datetime import datetime
 import logging
 
-# Configure logging
-logging.basicConfig(
-    level=logging.DEBUG,  # Set to DEBUG to see all logs
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
-logger = logging.getLogger(__name__)
-
-# Enable debug logging for httpx
-logging.getLogger('httpx').setLevel(logging.DEBUG)
-logging.getLogger('httpcore').setLevel(logging.DEBUG)
+from app import admin
+from app.batch import BatchChat, BatchItem
+from app.cache import ChatbotConfigCache, SessionCache
+from app.completions import ChatCompletions, Completion, ResponseCache
+from app.context import ContextBuilder, SummaryStore
+from app.history import HistoryCache
+from app.jobs import ChatJobQueue, WebhookRejected, job_store_from_env, public_job
+from app.llm_client import OpenRouterClient, UpstreamError
+from app.logs import configure_logging
+from app.metrics import Metrics, MetricsMiddleware, router as metrics_router
+from app.persistence import WriteBehindWriter, conversation_row
+from app.profiling import RequestProfiler
+from app.ratelimit import RateLimiter
+from app.routing import ModelRouter
+from app.scheduler import WIDGET
+from app.semantic_cache import SemanticCache
+from app.startup import Readiness, warm_chatbot_cache
+from app.storage import storage_from_env
+from app.streaming import receive_chat_messages, relay_chat_socket, sse_response, upstream_error_event
+from app.turns import ChatTurnPreparer
 
-# Initialize Supabase client
-supabase_url = os.getenv("SUPABASE_URL")
-supabase_key = os.getenv("SUPABASE_KEY")
-
-print(f"Loading Supabase client with URL: {supabase_url}")
-print(f"Supabase key: {supabase_key[:10]}...")
+# Configure logging: JSON records written off the request path, sampled and redacted
+# (see app/logs.py for LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_* and LOG_MAX_LENGTH)
+configure_logging()
+logger = logging.getLogger(__name__)
 
-if not supabase_url or not supabase_key:
-    raise ValueError("Missing Supabase URL or key in environment variables")
+async def fetch_chatbot(chatbot_id: str) -> Optional[dict]:
+    """Load a chatbot's configuration row from the database."""
+    return await storage.get_chatbot(chatbot_id)
 
-try:
-    supabase: Client = create_client(supabase_url, supabase_key)
-    # Test the connection
-    test = supabase.table('chatbots').select('*').limit(1).execute()
-    print("Successfully connected to Supabase")
-except Exception as e:
-    print(f"Error initializing Supabase client: {str(e)}")
-    raise
+# Chatbot configuration (API key, model name) cached by chatbot id
+chatbot_cache = ChatbotConfigCache(fetch_chatbot)
 
-async def verify_api_key(api_key: str, assistant_id: str) -> bool:
-    """Verify if the provided API key is valid for the given assistant."""
-    try:
-        response = supabase.table("chatbots") \
-            .select("id") \
-            .eq("id", assistant_id) \
-            .eq("api_key", api_key) \
-            .execute()
-        
-        if not response.data:
-            logger.warning(f"Invalid API key or assistant ID. Assistant ID: {assistant_id}")
-            return False
-        
-        return True
-    except Exception as e:
-        logger.error(f"Error verifying API key: {str(e)}")
-        return False
+# Session -> chatbot ID mapping, filled at session creation and on first lookup
+session_cache = SessionCache()
 
 async def get_chatbot_id_from_session(session_id: str) -> str:
     """Get the chatbot ID associated with a session."""
     try:
-        response = supabase.table("sessions") \
-            .select("chatbot_id") \
-            .eq("session_id", session_id) \
-            .execute()
+        chatbot_id = session_cache.get(session_id)
+        if chatbot_id:
+            return chatbot_id
         
-        if not response.data:
+        chatbot_id = await storage.get_session_owner(session_id)
+        
+        if not chatbot_id:
             logger.warning(f"No session found with ID: {session_id}")
             raise HTTPException(status_code=404, detail="Session not found")
         
-        return response.data[0]["chatbot_id"]
+        session_cache.put(session_id, chatbot_id)
+        return chatbot_id
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error getting chatbot ID from session: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving session information")
 
-async def get_chatbot_model(chatbot_id: str) -> str:
-    """Get the model name for a chatbot."""
+async def get_chatbot_config(chatbot_id: str) -> dict:
+    """Get a chatbot's configuration (model name, response caching, ...)."""
     try:
-        response = supabase.table("chatbots") \
-            .select("model_name") \
-            .eq("id", chatbot_id) \
-            .execute()
+        config = await chatbot_cache.get(chatbot_id)
         
-        if not response.data:
+        if not config:
             logger.warning(f"No chatbot found with ID: {chatbot_id}")
             raise HTTPException(status_code=404, detail="Chatbot not found")
         
-        return response.data[0]["model_name"]
+        return config
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error getting chatbot model: {str(e)}")
+        logger.error(f"Error getting chatbot config: {str(e)}")
         raise HTTPException(status_code=500, detail="Error retrieving chatbot information")
 
+# Per-session conversation history, read from the database only on a cache miss
+history_cache = HistoryCache()
+
+async def fetch_conversation_history(session_id: str) -> List[dict]:
+    """Load a session's conversation history from the database, oldest first."""
+    rows = await storage.get_history(session_id)
+    # Include turns that are journaled but not flushed to the database yet
+    return persistence.merge_pending(session_id, rows)
+
+async def fetch_conversation_summary(session_id: str) -> Optional[dict]:
+    """Load a session's rolling summary of older turns."""
+    return await storage.get_summary(session_id)
+
+async def save_conversation_summary(session_id: str, summary: str, summarized_messages: int) -> None:
+    """Store a session's rolling summary of older turns."""
+    await storage.save_summary({
+        "session_id": session_id,
+        "summary": summary,
+        "summarized_messages": summarized_messages,
+        "updated_at": datetime.utcnow().isoformat()
+    })
+
+async def save_chat_turn(
+    session_id: str,
+    user_messages: List[str],
+    ai_response: str,
+    model: Optional[str] = None
+) -> None:
+    """Queue the user messages and assistant reply for saving and bump the session's last activity."""
+    rows = [conversation_row(session_id, "user", content) for content in user_messages]
+    rows.append(conversation_row(session_id, "assistant", ai_response, model))
+    
+    # Journaled locally and written to the database in the background
+    persistence.enqueue(session_id, rows)
+    history_cache.append(session_id, rows)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the clients and background workers, and stop them in reverse order on shutdown."""
+    # Create the Supabase client (or the Postgres pool) off the event loop; the
+    # database is checked in the background so the server starts listening right away
+    await storage.connect()
+    await persistence.start()
+    await chat_jobs.start()
+    readiness.start(storage.ping, lambda: warm_chatbot_cache(storage, chatbot_cache))
+    try:
+        yield
+    finally:
+        await readiness.stop()
+        await chat_jobs.stop()
+        await persistence.stop()
+        await storage.close()
+        await llm_client.aclose()
+
 app = FastAPI(
     title="SaaS AI Chatbot API",
     description="API for managing AI chatbot sessions and conversations",
     version="1.0.0",
-    openapi_url="/openapi.json"
+    openapi_url="/openapi.json",
+    lifespan=lifespan
 )
 
 # Enable CORS for widget access
@@ -120,25 +161,133 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Supabase setup
+# Per-stage latency histograms and status counters, scraped at /metrics
+metrics = Metrics()
+app.state.metrics = metrics
+app.add_middleware(MetricsMiddleware, metrics=metrics)
+app.include_router(metrics_router)
+
+# Opt-in profiling of single chat requests (X-Profile-Token header or chatbots.profile_requests)
+profiler = RequestProfiler()
+
+# Admin endpoints for cache inspection and invalidation
+app.state.caches = {"chatbots": chatbot_cache, "sessions": session_cache, "history": history_cache}
+app.include_router(admin.router)
+
+# Storage setup: Supabase (PostgREST over HTTP) by default, or a direct
+# Postgres pool with STORAGE_BACKEND=postgres. Either way the client is
+# created by the lifespan handler, not at import time
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+
+storage = storage_from_env(SUPABASE_URL, SUPABASE_KEY)
+
+# Reported by /ready once the database answers and the caches are warm
+readiness = Readiness()
+
+# Write-behind persistence of chat turns (journaled locally, flushed in bulk)
+persistence = WriteBehindWriter(storage)
+app.state.persistence = persistence
+
+# Key check, session ownership, model and history for /api/chat in at most one round trip
+chat_turns = ChatTurnPreparer(storage, chatbot_cache, session_cache, history_cache, persistence.merge_pending)
+
+# Token-bucket limits per session, API key and chatbot, checked before any database work
+rate_limiter = RateLimiter()
+
+# Sessions one /api/chat/session/bulk request may create
+SESSION_BULK_MAX = int(os.getenv("SESSION_BULK_MAX", "1000"))
 
 # OpenRouter API key
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-print(f"OpenRouter API key: {OPENROUTER_API_KEY[:10]}..." if OPENROUTER_API_KEY else "OpenRouter API key not set")
+if not OPENROUTER_API_KEY:
+    logger.warning("OPENROUTER_API_KEY is not set")
+
+# Shared, pooled OpenRouter client used by every chat endpoint
+llm_client = OpenRouterClient(OPENROUTER_API_KEY)
+
+async def fetch_opening_turns(chatbot_id: str, limit: int) -> List[Tuple[str, str]]:
+    """Load the first question and answer of a chatbot's most recent sessions."""
+    return await storage.opening_turns(chatbot_id, limit)
+
+# Upstream completions, answered from the response caches for opted-in chatbots
+completions = ChatCompletions(ModelRouter(llm_client), ResponseCache(), SemanticCache(fetch_opening_turns))
+app.state.caches["responses"] = completions.responses
+app.state.caches["semantic"] = completions.semantic
+app.state.upstream = {
+    "routing": completions.router,
+    "limits": completions.router.guard,
+    "coalescing": completions.inflight,
+    "scheduling": completions.scheduler
+}
+
+# Fits history into each model's token budget, summarizing older turns at background priority
+context_builder = ContextBuilder(
+    completions,
+    SummaryStore(fetch_conversation_summary, save_conversation_summary),
+    history_loader=fetch_conversation_history
+)
+app.state.caches["summaries"] = context_builder
+
+# Many /api/chat turns in one request, sharing key checks, lookups and one bulk insert
+batch_chat = BatchChat(
+    storage,
+    chatbot_cache,
+    session_cache,
+    history_cache,
+    persistence.merge_pending,
+    context_builder,
+    completions,
+    save_chat_turn,
+    persistence.flush
+)
+
+async def run_chat_job(job: dict) -> Completion:
+    """Answer a turn submitted to /api/chat/jobs, as /api/chat would."""
+    chatbot = await get_chatbot_config(job["chatbot_id"])
+    prev_messages = await history_cache.get_or_load(job["session_id"], fetch_conversation_history)
+    messages = await context_builder.build(
+        job["session_id"],
+        chatbot,
+        prev_messages,
+        [{"role": "user", "content": content} for content in job["user_messages"]]
+    )
+    completion = await completions.complete(chatbot, messages, title="AI Chatbot SaaS")
+    await save_chat_turn(job["session_id"], job["user_messages"], completion.reply, completion.model)
+    return completion
 
-# Debug logging for environment variables
-logger.info(f"Supabase URL: {os.getenv('SUPABASE_URL')}")
-logger.info(f"Supabase key: {os.getenv('SUPABASE_KEY')}")
-logger.info(f"OpenRouter key: {'*' * (len(OPENROUTER_API_KEY) - 4) + OPENROUTER_API_KEY[-4:] if OPENROUTER_API_KEY else 'Not set'}")
+# Asynchronous chat turns: submitted to /api/chat/jobs, answered by a bounded worker pool
+chat_jobs = ChatJobQueue(job_store_from_env(storage), run_chat_job)
+app.state.upstream["jobs"] = chat_jobs
+
+def upstream_http_error(e: UpstreamError) -> HTTPException:
+    """Map an upstream failure to an HTTP error.
+
+    Overload and open circuits become 503 with a Retry-After header so
+    clients back off; everything else is a 500.
+    """
+    detail = f"Error communicating with AI service: {e.detail}"
+    if e.retry_after is not None:
+        return HTTPException(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(math.ceil(e.retry_after))}
+        )
+    return HTTPException(status_code=500, detail=detail)
 
 # Schemas
 class CreateSessionRequest(BaseModel):
     api_key: str
     assistant_id: str
 
+class BulkCreateSessionRequest(BaseModel):
+    api_key: str
+    assistant_id: str
+    count: int = Field(..., ge=1, le=SESSION_BULK_MAX)
+
+class BulkCreateSessionResponse(BaseModel):
+    session_ids: List[str]
+
 class Message(BaseModel):
     role: str
     content: str
@@ -149,6 +298,7 @@ class ChatRequest(BaseModel):
     type: str
     assistant_id: str
     messages: List[Message]
+    stream: bool = False
 
 class CreateWidgetSessionRequest(BaseModel):
     chatbot_id: str
@@ -156,6 +306,7 @@ class CreateWidgetSessionRequest(BaseModel):
 class WidgetChatRequest(BaseModel):
     session_id: str
     message: str
+    stream: bool = False
 
 class ErrorResponse(BaseModel):
     detail: str
@@ -171,37 +322,54 @@ class HTTPValidationError(BaseModel):
 class ChatResponse(BaseModel):
     response: str
 
+class BatchChatRequest(BaseModel):
+    items: List[ChatRequest]
+
+class BatchChatResult(BaseModel):
+    session_id: str
+    status_code: int
+    reply: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchChatResponse(BaseModel):
+    results: List[BatchChatResult]
+
+class ChatJobRequest(ChatRequest):
+    webhook_url: Optional[str] = None
+
+class ChatJobResponse(BaseModel):
+    job_id: str
+    session_id: str
+    status: str
+    reply: Optional[str] = None
+    model: Optional[str] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: Optional[str] = None
+    completed_at: Optional[str] = None
+
 # Health check
 @app.get("/health", response_model=str)
 async def health_check():
+    """Liveness: the process is up and serving requests."""
     return "OK"
 
+@app.get("/ready", response_model=str, responses={
+    503: {"model": ErrorResponse, "description": "Still starting up or shutting down"}
+})
+async def readiness_check():
+    """Readiness: the database has answered and the caches are warm, so this instance can take traffic."""
+    if not readiness.ready:
+        raise HTTPException(status_code=503, detail=readiness.detail)
+    return "READY"
+
 # Create a chat session (API)
 @app.post("/api/chat/session", response_model=str, status_code=201)
 async def create_session(request: CreateSessionRequest):
     """Create a new chat session"""
     try:
-        print(f"Attempting to create session for assistant_id: {request.assistant_id}")
-        print(f"Supabase URL: {os.getenv('SUPABASE_URL')}")
-        
-        # Test Supabase connection
-        try:
-            test_response = supabase.table('chatbots').select('*').limit(1).execute()
-            print(f"Supabase connection test: {test_response}")
-        except Exception as e:
-            print(f"Supabase connection error: {str(e)}")
-            raise
-            
-        # Check if chatbot exists with the given API key
-        response = supabase.table("chatbots") \
-            .select("id") \
-            .eq("id", request.assistant_id) \
-            .eq("api_key", request.api_key) \
-            .execute()
-            
-        print(f"Chatbot query response: {response}")
-        
-        if not response.data:
+        # Check if chatbot exists with the given API key (cached)
+        if not await chatbot_cache.verify_api_key(request.assistant_id, request.api_key):
             raise HTTPException(
                 status_code=403, 
                 detail=f"Invalid API key or assistant ID. No matching chatbot found with id: {request.assistant_id}"
@@ -215,31 +383,80 @@ async def create_session(request: CreateSessionRequest):
             "last_activity": datetime.utcnow().isoformat()
         }
         
-        print(f"Creating session with data: {session_data}")
-        session_response = supabase.table("sessions").insert(session_data).execute()
-        print(f"Session creation response: {session_response}")
+        created = await storage.create_sessions([session_data])
         
-        if not session_response.data:
+        if not created:
             raise HTTPException(status_code=500, detail="Failed to create session")
-            
+        
+        session_cache.put(session_data["session_id"], request.assistant_id)
+        logger.debug("Created session %s for assistant_id: %s", session_data["session_id"], request.assistant_id)
         return session_data["session_id"]
         
-    except HTTPException as he:
-        print(f"HTTPException in create_session: {he.detail}")
+    except HTTPException:
         raise
     except Exception as e:
         error_msg = f"Error creating session: {str(e)}"
-        print(error_msg)
+        logger.error(error_msg)
         raise HTTPException(status_code=500, detail=error_msg)
 
+@app.post("/api/chat/session/bulk", response_model=BulkCreateSessionResponse, status_code=201)
+async def create_sessions_bulk(request: BulkCreateSessionRequest):
+    """
+    Create many chat sessions at once, e.g. to pre-warm sessions for a campaign.
+    
+    - **api_key**: API key for authentication
+    - **assistant_id**: ID of the assistant
+    - **count**: Number of sessions to create (at most `SESSION_BULK_MAX`)
+    
+    The chatbot is validated once and all sessions are inserted with a single multi-row insert.
+    """
+    try:
+        if not await chatbot_cache.verify_api_key(request.assistant_id, request.api_key):
+            raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
+            
+        # Only requests with a valid key count against the key's and chatbot's limits
+        await rate_limiter.check(
+            request.assistant_id,
+            api_key=request.api_key,
+            chatbot=chatbot_cache.peek(request.assistant_id)
+        )
+            
+        now = datetime.utcnow().isoformat()
+        sessions = [
+            {
+                "session_id": str(uuid.uuid4()),
+                "chatbot_id": request.assistant_id,
+                "created_at": now,
+                "last_activity": now
+            }
+            for _ in range(request.count)
+        ]
+        created = await storage.create_sessions(sessions)
+        if created != len(sessions):
+            raise HTTPException(status_code=500, detail="Failed to create sessions")
+            
+        for session in sessions:
+            session_cache.put(session["session_id"], request.assistant_id)
+        logger.info(f"Created {len(sessions)} sessions for assistant_id: {request.assistant_id}")
+        return {"session_ids": [session["session_id"] for session in sessions]}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating sessions in bulk: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error creating sessions")
+
 @app.post("/api/chat", response_model=str, responses={
     200: {"description": "Successful Response"},
     400: {"model": ErrorResponse, "description": "Bad Request"},
     401: {"model": ErrorResponse, "description": "Unauthorized"},
     403: {"model": ErrorResponse, "description": "Forbidden"},
-    500: {"model": ErrorResponse, "description": "Internal Server Error"}
+    429: {"model": ErrorResponse, "description": "Rate limit exceeded; retry after the Retry-After header"},
+    500: {"model": ErrorResponse, "description": "Internal Server Error"},
+    503: {"model": ErrorResponse, "description": "AI service overloaded or unavailable; retry after the Retry-After header"}
 })
-async def chat(request: ChatRequest):
+@profiler.wrap(lambda request: chatbot_cache.peek(request.assistant_id))
+async def chat(request: ChatRequest, x_profile_token: Optional[str] = Header(None, include_in_schema=False)):
     """
     Process a chat message and return the assistant's response.
     
@@ -248,115 +465,213 @@ async def chat(request: ChatRequest):
     - **type**: Type of chat request
     - **assistant_id**: ID of the assistant
     - **messages**: List of messages in the conversation
+    - **stream**: Stream the reply as Server-Sent Events instead of returning it at once
     """
     try:
-        # Validate api_key and assistant_id
-        is_valid = await verify_api_key(request.api_key, request.assistant_id)
-        if not is_valid:
-            raise HTTPException(status_code=403, detail="Invalid API key or assistant ID")
-            
-        # Validate session
-        chatbot_id = await get_chatbot_id_from_session(request.session_id)
-        if not chatbot_id or chatbot_id != request.assistant_id:
-            raise HTTPException(status_code=404, detail="Session not found or does not belong to the assistant")
+        # Turn away a session that is over its limit before touching the database
+        await rate_limiter.peek_session(request.session_id, chatbot=chatbot_cache.peek(request.assistant_id))
+        
+        # Validate the API key and session and load the model and history
+        # (from the caches, or with a single prepare_chat_turn RPC)
+        with metrics.stage("chat", "prepare"):
+            chatbot, prev_messages = await chat_turns.prepare(
+                request.api_key,
+                request.assistant_id,
+                request.session_id
+            )
             
-        # Get the chatbot model
-        model_name = await get_chatbot_model(request.assistant_id)
+        # Charge the session, key and chatbot limits only now that the key is verified,
+        # so requests with bad keys cannot use up a chatbot's limit
+        with metrics.stage("chat", "rate_limit"):
+            await rate_limiter.check(
+                request.assistant_id,
+                session_id=request.session_id,
+                api_key=request.api_key,
+                chatbot=chatbot
+            )
+        model_name = chatbot.get("model_name")
         if not model_name:
             raise HTTPException(status_code=500, detail="Chatbot configuration error")
             
-        # Get conversation history
-        prev_messages = supabase.table("conversations")\
-            .select("role", "content")\
-            .eq("session_id", request.session_id)\
-            .order("timestamp")\
-            .execute().data
-            
-        # Prepare messages for the LLM
-        messages = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in prev_messages
-        ]
+        # Prepare messages for the LLM, keeping recent turns within the token budget
+        user_messages = [msg.content for msg in request.messages if msg.role == "user"]
+        with metrics.stage("chat", "context"):
+            messages = await context_builder.build(
+                request.session_id,
+                chatbot,
+                prev_messages,
+                [{"role": "user", "content": content} for content in user_messages]
+            )
         
-        # Add new user messages
-        for msg in request.messages:
-            if msg.role == "user":
-                messages.append({"role": msg.role, "content": msg.content})
+        # Stream the reply as Server-Sent Events; the turn is saved once the stream ends
+        if request.stream:
+            logger.debug("Streaming request to OpenRouter with model: %s", model_name)
+            try:
+                completions.check_available(chatbot)
+            except UpstreamError as e:
+                logger.warning(f"Rejecting stream, AI service unavailable: {e.detail}")
+                raise upstream_http_error(e)
+            stream = completions.stream(chatbot, messages, title="AI Chatbot SaaS")
+            started = time.perf_counter()
+            
+            async def finish_stream(reply: str):
+                metrics.observe("chat", "upstream", time.perf_counter() - started, stream.model or "cache")
+                with metrics.stage("chat", "persistence"):
+                    await save_chat_turn(request.session_id, user_messages, reply, stream.model)
+                    
+            return sse_response(stream, finish_stream)
                 
         # Call OpenRouter API
         try:
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": "https://pros.tools",
-                "X-Title": "AI Chatbot SaaS"
-            }
+            logger.debug("Sending request to OpenRouter with model: %s", model_name)
             
-            payload = {
-                "model": model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
+            with metrics.stage("chat", "upstream", model_name) as stage:
+                completion = await completions.complete(
+                    chatbot,
+                    messages,
+                    title="AI Chatbot SaaS"
+                )
+                # Label by the model that answered (after fallbacks), or "cache"
+                stage.model = completion.model or "cache"
+            ai_response = completion.reply
             
-            logger.info(f"Sending request to OpenRouter with model: {model_name}")
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Request payload: {payload}")
+        except UpstreamError as e:
+            logger.error(f"OpenRouter API error: {e.detail}")
+            raise upstream_http_error(e)
             
-            openrouter_response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            logger.debug(f"OpenRouter response status: {openrouter_response.status_code}")
-            logger.debug(f"OpenRouter response headers: {dict(openrouter_response.headers)}")
-            logger.debug(f"OpenRouter response body: {openrouter_response.text}")
-            
-            openrouter_response.raise_for_status()
-            ai_response = openrouter_response.json()["choices"][0]["message"]["content"]
-            
-        except requests.exceptions.RequestException as e:
-            error_detail = str(e)
-            if hasattr(e, 'response') and e.response is not None:
-                error_detail += f"\nResponse status: {e.response.status_code}"
-                error_detail += f"\nResponse body: {e.response.text}"
-            logger.error(f"OpenRouter API error: {error_detail}")
-            raise HTTPException(status_code=500, detail=f"Error communicating with AI service: {error_detail}")
-            
-        # Save user messages to database
-        for msg in request.messages:
-            if msg.role == "user":
-                supabase.table("conversations").insert({
-                    "session_id": request.session_id,
-                    "role": "user",
-                    "content": msg.content,
-                    "timestamp": datetime.utcnow().isoformat()
-                }).execute()
-                
-        # Save AI response to database
-        supabase.table("conversations").insert({
-            "session_id": request.session_id,
-            "role": "assistant",
-            "content": ai_response,
-            "timestamp": datetime.utcnow().isoformat()
-        }).execute()
-        
-        # Update session last activity
-        supabase.table("sessions")\
-            .update({"last_activity": datetime.utcnow().isoformat()})\
-            .eq("session_id", request.session_id)\
-            .execute()
+        # Save the turn to the database
+        with metrics.stage("chat", "persistence"):
+            await save_chat_turn(request.session_id, user_messages, ai_response, completion.model)
         
         return ai_response
         
     except HTTPException as he:
-        logger.error(f"HTTP error in chat endpoint: {str(he.detail)}")
+        # Expected client errors (403, 404, 429, ...); sampled with the other INFO records
+        logger.info("HTTP %s in chat endpoint: %s", he.status_code, he.detail)
         raise
     except Exception as e:
         logger.error(f"Unexpected error in chat endpoint: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail="An unexpected error occurred")
 
+@app.post("/api/chat/batch", response_model=BatchChatResponse, responses={
+    200: {"description": "Per-item results; check each item's status_code"},
+    400: {"model": ErrorResponse, "description": "Too many items"},
+    429: {"model": ErrorResponse, "description": "Rate limit exceeded; retry after the Retry-After header"},
+    500: {"model": ErrorResponse, "description": "Internal Server Error"}
+})
+async def chat_batch(request: BatchChatRequest):
+    """
+    Process many chat messages, possibly for different sessions and assistants, in one request.
+    
+    - **items**: `/api/chat` requests (`stream` is ignored)
+    
+    Each item gets its own result with a `status_code` and either a `reply` or an `error`;
+    a failing item does not fail the others. Items for the same session are answered in order.
+    """
+    if len(request.items) > batch_chat.max_items:
+        raise HTTPException(status_code=400, detail=f"A batch may contain at most {batch_chat.max_items} items")
+        
+    try:
+        # A batch counts as one request against each valid API key's and chatbot's rate limit;
+        # items with a bad key get their 403 from batch_chat.run without charging anything
+        for assistant_id, api_key in sorted({(item.assistant_id, item.api_key) for item in request.items}):
+            if await chatbot_cache.verify_api_key(assistant_id, api_key):
+                await rate_limiter.check(assistant_id, api_key=api_key, chatbot=chatbot_cache.peek(assistant_id))
+            
+        results = await batch_chat.run([
+            BatchItem(
+                item.api_key,
+                item.assistant_id,
+                item.session_id,
+                [msg.content for msg in item.messages if msg.role == "user"]
+            )
+            for item in request.items
+        ])
+        
+        failed = sum(1 for result in results if result["status_code"] != 200)
+        logger.info(f"Processed chat batch of {len(results)} items ({failed} failed)")
+        return {"results": results}
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Unexpected error in chat batch endpoint: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An unexpected error occurred")
+
+@app.post("/api/chat/jobs", response_model=ChatJobResponse, status_code=202, responses={
+    202: {"description": "Job queued; poll GET /api/chat/jobs/{job_id} or wait for the webhook"},
+    400: {"model": ErrorResponse, "description": "Bad Request"},
+    403: {"model": ErrorResponse, "description": "Forbidden"},
+    404: {"model": ErrorResponse, "description": "Session not found"},
+    429: {"model": ErrorResponse, "description": "Rate limit exceeded; retry after the Retry-After header"},
+    503: {"model": ErrorResponse, "description": "Job queue full; retry after the Retry-After header"}
+})
+async def submit_chat_job(request: ChatJobRequest):
+    """
+    Submit a chat message and return a job id at once instead of waiting for the reply.
+    
+    Takes the same fields as `/api/chat` (`stream` is ignored) plus:
+    
+    - **webhook_url**: Optional URL that receives the finished job as a JSON POST
+    
+    The key and session are validated before the job is queued.
+    """
+    try:
+        if request.webhook_url:
+            try:
+                chat_jobs.check_webhook_url(request.webhook_url)
+            except WebhookRejected as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            
+        await rate_limiter.peek_session(request.session_id, chatbot=chatbot_cache.peek(request.assistant_id))
+        
+        # Validate the API key and session now so the client gets 403/404 right away
+        chatbot, _ = await chat_turns.prepare(request.api_key, request.assistant_id, request.session_id)
+        
+        # Limits are charged only once the key is verified
+        await rate_limiter.check(
+            request.assistant_id,
+            session_id=request.session_id,
+            api_key=request.api_key,
+            chatbot=chatbot
+        )
+        
+        job = await chat_jobs.submit(
+            request.session_id,
+            request.assistant_id,
+            [msg.content for msg in request.messages if msg.role == "user"],
+            request.webhook_url
+        )
+        logger.info(f"Queued chat job {job['id']} for session: {request.session_id}")
+        return public_job(job)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error submitting chat job: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail="An unexpected error occurred")
+
+@app.get("/api/chat/jobs/{job_id}", response_model=ChatJobResponse)
+async def get_chat_job(job_id: str):
+    """
+    Poll a chat job. `status` is `queued`, `running`, `succeeded` (with `reply`) or `failed`
+    (with `error` and the `status_code` /api/chat would have returned).
+    """
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Job not found")
+        
+    try:
+        job = await chat_jobs.get(job_id)
+    except Exception as e:
+        logger.error(f"Error loading chat job {job_id}: {str(e)}")
+        raise HTTPException(status_code=500, detail="Error retrieving job")
+        
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return public_job(job)
+
 # Widget endpoints
 @app.post("/api/chat/widget/session", response_model=str)
 async def create_widget_session(request: CreateWidgetSessionRequest):
@@ -367,25 +682,25 @@ async def create_widget_session(request: CreateWidgetSessionRequest):
     """
     try:
         # Verify chatbot exists
-        response = supabase.table("chatbots").select("id").eq("id", request.chatbot_id).execute()
-        if not response.data or len(response.data) == 0:
+        if not await chatbot_cache.get(request.chatbot_id):
             raise HTTPException(status_code=404, detail="Chatbot not found")
             
         # Generate a new session ID
         session_id = str(uuid.uuid4())
         
         # Store the session in the database
-        supabase.table("sessions").insert({
+        await storage.create_sessions([{
             "session_id": session_id,
             "chatbot_id": request.chatbot_id,
             "created_at": datetime.utcnow().isoformat(),
             "last_activity": datetime.utcnow().isoformat(),
             "is_active": True,
             "is_widget": True
-        }).execute()
+        }])
+        session_cache.put(session_id, request.chatbot_id)
         
         logger.info(f"Created new widget session: {session_id} for chatbot: {request.chatbot_id}")
-        return ChatResponse(response="Widget session created successfully", session_id=session_id)
+        return session_id
         
     except HTTPException as he:
         raise he
@@ -394,102 +709,101 @@ async def create_widget_session(request: CreateWidgetSessionRequest):
         raise HTTPException(status_code=500, detail="Internal server error")
 
 @app.post("/api/chat/widget", response_model=str)
-async def widget_chat(request: WidgetChatRequest):
+@profiler.wrap(lambda request: chatbot_cache.peek(session_cache.get(request.session_id) or ""))
+async def widget_chat(request: WidgetChatRequest, x_profile_token: Optional[str] = Header(None, include_in_schema=False)):
     """
     Process a chat message from the widget and return the assistant's response.
     
     - **session_id**: ID of the chat session
     - **message**: User's message content
+    - **stream**: Stream the reply as Server-Sent Events instead of returning it at once
     """
     try:
-        # Get chatbot ID from session
-        chatbot_id = await get_chatbot_id_from_session(request.session_id)
-        if not chatbot_id:
-            raise HTTPException(status_code=404, detail="Session not found")
-            
-        # Get the chatbot model
-        model_name = await get_chatbot_model(chatbot_id)
-        if not model_name:
-            raise HTTPException(status_code=500, detail="Chatbot configuration error")
+        # Turn away a session that is over its limit before touching the database
+        chatbot_id = session_cache.get(request.session_id)
+        await rate_limiter.peek_session(
+            request.session_id,
+            chatbot=chatbot_cache.peek(chatbot_id) if chatbot_id else None
+        )
+        
+        # Fetch the conversation history while the session and model are resolved
+        async def load_history() -> List[dict]:
+            with metrics.stage("widget_chat", "history"):
+                return await history_cache.get_or_load(request.session_id, fetch_conversation_history)
+                
+        history_task = asyncio.ensure_future(load_history())
+        try:
+            # Get chatbot ID from session
+            with metrics.stage("widget_chat", "session"):
+                chatbot_id = await get_chatbot_id_from_session(request.session_id)
+            if not chatbot_id:
+                raise HTTPException(status_code=404, detail="Session not found")
+                
+            # Get the chatbot model
+            with metrics.stage("widget_chat", "model"):
+                chatbot = await get_chatbot_config(chatbot_id)
+            model_name = chatbot.get("model_name")
+            if not model_name:
+                raise HTTPException(status_code=500, detail="Chatbot configuration error")
+                
+            # Charge the session and chatbot limits once the session is known to belong to the chatbot
+            with metrics.stage("widget_chat", "rate_limit"):
+                await rate_limiter.check(chatbot_id, session_id=request.session_id, chatbot=chatbot)
+        except BaseException:
+            history_task.cancel()
+            raise
             
         # Get conversation history
-        prev_messages = supabase.table("conversations")\
-            .select("role", "content")\
-            .eq("session_id", request.session_id)\
-            .order("timestamp")\
-            .execute().data
+        prev_messages = await history_task
             
-        # Prepare messages for the LLM
-        messages = [
-            {"role": msg["role"], "content": msg["content"]}
-            for msg in prev_messages
-        ]
+        # Prepare messages for the LLM, keeping recent turns within the token budget
+        with metrics.stage("widget_chat", "context"):
+            messages = await context_builder.build(
+                request.session_id,
+                chatbot,
+                prev_messages,
+                [{"role": "user", "content": request.message}]
+            )
         
-        # Add the new user message
-        messages.append({"role": "user", "content": request.message})
+        # Stream the reply as Server-Sent Events; the turn is saved once the stream ends
+        if request.stream:
+            logger.debug("Streaming request to OpenRouter with model: %s", model_name)
+            try:
+                completions.check_available(chatbot, priority=WIDGET)
+            except UpstreamError as e:
+                logger.warning(f"Rejecting stream, AI service unavailable: {e.detail}")
+                raise upstream_http_error(e)
+            stream = completions.stream(chatbot, messages, title="AI Chatbot Widget", priority=WIDGET)
+            started = time.perf_counter()
+            
+            async def finish_stream(reply: str):
+                metrics.observe("widget_chat", "upstream", time.perf_counter() - started, stream.model or "cache")
+                with metrics.stage("widget_chat", "persistence"):
+                    await save_chat_turn(request.session_id, [request.message], reply, stream.model)
+                    
+            return sse_response(stream, finish_stream)
         
         # Call OpenRouter API
         try:
-            headers = {
-                "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                "HTTP-Referer": "https://pros.tools",
-                "X-Title": "AI Chatbot Widget"
-            }
-            
-            payload = {
-                "model": model_name,
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
-            
-            logger.info(f"Sending request to OpenRouter with model: {model_name}")
-            logger.debug(f"Request headers: {headers}")
-            logger.debug(f"Request payload: {payload}")
-            
-            openrouter_response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
-            
-            logger.debug(f"OpenRouter response status: {openrouter_response.status_code}")
-            logger.debug(f"OpenRouter response headers: {dict(openrouter_response.headers)}")
-            logger.debug(f"OpenRouter response body: {openrouter_response.text}")
+            logger.debug("Sending request to OpenRouter with model: %s", model_name)
             
-            openrouter_response.raise_for_status()
-            ai_response = openrouter_response.json()["choices"][0]["message"]["content"]
+            with metrics.stage("widget_chat", "upstream", model_name) as stage:
+                completion = await completions.complete(
+                    chatbot,
+                    messages,
+                    title="AI Chatbot Widget",
+                    priority=WIDGET
+                )
+                stage.model = completion.model or "cache"
+            ai_response = completion.reply
             
-        except requests.exceptions.RequestException as e:
-            error_detail = str(e)
-            if hasattr(e, 'response') and e.response is not None:
-                error_detail += f"\nResponse status: {e.response.status_code}"
-                error_detail += f"\nResponse body: {e.response.text}"
-            logger.error(f"OpenRouter API error: {error_detail}")
-            raise HTTPException(status_code=500, detail=f"Error communicating with AI service: {error_detail}")
-        
-        # Save user message to database
-        supabase.table("conversations").insert({
-            "session_id": request.session_id,
-            "role": "user",
-            "content": request.message,
-            "timestamp": datetime.utcnow().isoformat()
-        }).execute()
-        
-        # Save AI response to database
-        supabase.table("conversations").insert({
-            "session_id": request.session_id,
-            "role": "assistant",
-            "content": ai_response,
-            "timestamp": datetime.utcnow().isoformat()
-        }).execute()
-        
-        # Update session last activity
-        supabase.table("sessions")\
-            .update({"last_activity": datetime.utcnow().isoformat()})\
-            .eq("session_id", request.session_id)\
-            .execute()
+        except UpstreamError as e:
+            logger.error(f"OpenRouter API error: {e.detail}")
+            raise upstream_http_error(e)
+        
+        # Save the turn to the database
+        with metrics.stage("widget_chat", "persistence"):
+            await save_chat_turn(request.session_id, [request.message], ai_response, completion.model)
         
         return ai_response
         
@@ -499,6 +813,103 @@ async def widget_chat(request: WidgetChatRequest):
         logger.error(f"Error in widget chat: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.websocket("/api/chat/widget/ws")
+async def widget_chat_socket(
+    websocket: WebSocket,
+    session_id: Optional[str] = None,
+    chatbot_id: Optional[str] = None
+):
+    """
+    Chat with the widget over a WebSocket.
+    
+    - **session_id**: Continue an existing session
+    - **chatbot_id**: Start a new session for this chatbot (when no session_id is given)
+    
+    The session, model and history are resolved once per connection. The server first
+    sends `{"type": "session", "session_id": ...}`. Each client frame `{"message": "..."}`
+    is answered with `delta` frames followed by `done`, or an `error` frame (with
+    `retry_after` when the message should be retried later). If the session cannot be
+    opened, the connection is closed with code 4000 + the HTTP status (e.g. 4404).
+    """
+    await websocket.accept()
+    try:
+        # Resolve the session, model and history once for the whole connection
+        if session_id:
+            history_task = asyncio.ensure_future(
+                history_cache.get_or_load(session_id, fetch_conversation_history)
+            )
+            try:
+                chatbot_id = await get_chatbot_id_from_session(session_id)
+                chatbot = await get_chatbot_config(chatbot_id)
+            except BaseException:
+                history_task.cancel()
+                raise
+            history = await history_task
+        elif chatbot_id:
+            session_id = await create_widget_session(CreateWidgetSessionRequest(chatbot_id=chatbot_id))
+            chatbot = await get_chatbot_config(chatbot_id)
+            history = []
+        else:
+            raise HTTPException(status_code=400, detail="session_id or chatbot_id is required")
+            
+        model_name = chatbot.get("model_name")
+        if not model_name:
+            raise HTTPException(status_code=500, detail="Chatbot configuration error")
+    except HTTPException as he:
+        await websocket.close(code=4000 + he.status_code, reason=str(he.detail))
+        return
+    except Exception as e:
+        logger.error(f"Error opening widget socket: {str(e)}")
+        await websocket.close(code=4500, reason="Internal server error")
+        return
+        
+    logger.info(f"Widget socket opened for session: {session_id}")
+    try:
+        await websocket.send_json({"type": "session", "session_id": session_id})
+        
+        async for message in receive_chat_messages(websocket):
+            # Same per-message checks as the HTTP endpoint, minus the lookups
+            try:
+                await rate_limiter.check(chatbot_id, session_id=session_id, chatbot=chatbot)
+                completions.check_available(chatbot, priority=WIDGET)
+            except HTTPException as he:
+                error = {"type": "error", "detail": he.detail}
+                if he.headers and "Retry-After" in he.headers:
+                    error["retry_after"] = int(he.headers["Retry-After"])
+                await websocket.send_json(error)
+                continue
+            except UpstreamError as e:
+                logger.warning(f"Rejecting message, AI service unavailable: {e.detail}")
+                await websocket.send_json({"type": "error", **upstream_error_event(e)})
+                continue
+                
+            # Prepare messages for the LLM from the connection's history
+            messages = await context_builder.build(
+                session_id,
+                chatbot,
+                history,
+                [{"role": "user", "content": message}]
+            )
+            
+            # Stream the reply; the turn is saved in the background once it is complete
+            stream = completions.stream(chatbot, messages, title="AI Chatbot Widget", priority=WIDGET)
+            reply = await relay_chat_socket(
+                websocket,
+                stream,
+                lambda reply: save_chat_turn(session_id, [message], reply, stream.model)
+            )
+            if reply is not None:
+                history = history + [
+                    {"role": "user", "content": message},
+                    {"role": "assistant", "content": reply}
+                ]
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        logger.error(f"Error in widget socket: {str(e)}", exc_info=True)
+        await websocket.close(code=1011)
+    logger.info(f"Widget socket closed for session: {session_id}")
+
 # Add this at the end of the file
 if __name__ == "__main__":
     import uvicorn
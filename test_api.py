@@ -11,6 +11,8 @@ load_dotenv()
 BASE_URL = "http://localhost:8000"
 TEST_API_KEY = os.getenv("TEST_API_KEY", "c8bc40f2-e83d-4e92-ac2b-d5bd6444da0a")
 TEST_ASSISTANT_ID = os.getenv("TEST_ASSISTANT_ID", "e97f4988-4f70-470b-b2e5-aca28ddbcff0")
+# Run the server with RATE_LIMIT_CHATBOT_PER_MINUTE set to this for test_bad_keys_keep_chatbot_limit
+TEST_CHATBOT_LIMIT = int(os.getenv("TEST_RATE_LIMIT_CHATBOT_PER_MINUTE", "5"))
 
 def test_health_check():
     """Test the health check endpoint."""
@@ -48,6 +50,49 @@ def test_chat(session_id):
     assert "response" in response.json()
     print(f"✅ Chat response: {response.json()['response'][:50]}...")
 
+def test_chat_stream(session_id):
+    """Test streaming a chat reply as Server-Sent Events."""
+    data = {
+        "api_key": TEST_API_KEY,
+        "session_id": session_id,
+        "type": "message",
+        "assistant_id": TEST_ASSISTANT_ID,
+        "messages": [
+            {"role": "user", "content": "Tell me a short joke."}
+        ],
+        "stream": True
+    }
+    response = requests.post(f"{BASE_URL}/api/chat", json=data, stream=True)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [line for line in response.iter_lines(decode_unicode=True) if line.startswith("data:")]
+    assert events[-1] == "data: [DONE]"
+    print(f"✅ Streamed chat response in {len(events) - 1} chunks")
+
+def test_bad_keys_keep_chatbot_limit(session_id):
+    """Test that requests with a bad API key do not use up the chatbot's rate limit."""
+    for _ in range(TEST_CHATBOT_LIMIT):
+        data = {
+            "api_key": "not-the-key",
+            "session_id": session_id,
+            "type": "message",
+            "assistant_id": TEST_ASSISTANT_ID,
+            "messages": [
+                {"role": "user", "content": "Hello?"}
+            ]
+        }
+        response = requests.post(f"{BASE_URL}/api/chat", json=data)
+        assert response.status_code == 403
+    data = {
+        "api_key": TEST_API_KEY,
+        "assistant_id": TEST_ASSISTANT_ID,
+        "count": 1
+    }
+    response = requests.post(f"{BASE_URL}/api/chat/session/bulk", json=data)
+    assert response.status_code != 429
+    test_chat(session_id)
+    print(f"✅ {TEST_CHATBOT_LIMIT} bad-key requests left the chatbot's rate limit untouched")
+
 def test_widget_session():
     """Test creating a widget session."""
     data = {
@@ -82,6 +127,8 @@ if __name__ == "__main__":
     print("\n🔍 Testing regular chat flow...")
     session_id = test_create_session()
     test_chat(session_id)
+    test_chat_stream(session_id)
+    test_bad_keys_keep_chatbot_limit(test_create_session())
     
     # Test widget flow
     print("\n🔍 Testing widget flow...")